@@ -0,0 +1,158 @@
+import os
+import argparse
+from collections import OrderedDict
+
+import numpy as np
+
+from .seq_index import get_sequence_rel_dir
+from .mask_store import get_frame_mask_planes
+from .mask_stats import get_mask_bbox
+from .sphere_mask import get_mask_circles
+
+
+def get_circle_sidecar_path(store_root, data_type, seq_id):
+    ## one small file per sequence: {store_root}/Rendered_Traj_Results{_multi}/{static}/{seq_id}.npz
+    return os.path.join(store_root, get_sequence_rel_dir(data_type), f"{seq_id}.npz")
+
+
+def build_sequence_circles(seq_mask_dir, obj_num):
+    """
+    Enclosing circles (see fmc.data.sphere_mask.get_mask_circles) and bounding boxes of every mask plane
+    of every frame of one sequence, planes in the mask store order. Frames without masks are left out.
+    """
+    frame_numbers, bboxes, circles = [], [], []
+    mask_hw = None
+
+    frame_dir_list = []
+    if os.path.isdir(seq_mask_dir):
+        frame_dir_list = sorted([i for i in os.listdir(seq_mask_dir) if i.isdigit()], key=int)
+
+    for frame_dir in frame_dir_list:
+        frame_mask_dir = os.path.join(seq_mask_dir, frame_dir)
+        if not os.path.isfile(os.path.join(frame_mask_dir, "total.png")):
+            continue
+
+        planes = get_frame_mask_planes(frame_mask_dir, obj_num)
+        if mask_hw is None:
+            mask_hw = planes.shape[1:]
+        assert planes.shape[1:] == mask_hw, f"mask size differs in {frame_mask_dir}"
+        frame_numbers.append(int(frame_dir))
+        bboxes.append([get_mask_bbox(plane) for plane in planes])
+        circles.append(get_mask_circles([plane[..., np.newaxis] for plane in planes]).numpy())
+
+    plane_num = 1 if obj_num == 1 else 1 + obj_num
+    return dict(
+        mask_hw=np.array(mask_hw or (0, 0), dtype=np.int64),
+        frame_numbers=np.array(frame_numbers, dtype=np.int32),
+        bboxes=np.array(bboxes, dtype=np.int32).reshape(-1, plane_num, 4),
+        circles=np.array(circles, dtype=np.float32).reshape(-1, plane_num, 4),
+    )
+
+
+def build_circle_store(dataset, output_root):
+    """
+    Write one circle sidecar per sequence of `dataset`, so sphere masks and object visibility
+    need no mask decoding at training time.
+    """
+    seq_num = 0
+    for idx in range(len(dataset.dataset)):
+        data_type = dataset.data_type_list[idx]
+        seq_id = dataset.seq_id_list[idx]
+        obj_num = dataset.seq_meta_data_map[data_type][seq_id].get_obj_num()
+
+        seq_mask_dir = os.path.join(dataset.mask_root, get_sequence_rel_dir(data_type), seq_id)
+        sidecar_path = get_circle_sidecar_path(output_root, data_type, seq_id)
+        os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+        np.savez(sidecar_path, **build_sequence_circles(seq_mask_dir, obj_num))
+        seq_num += 1
+    return seq_num
+
+
+class SequenceCircles(object):
+    """
+    Circles and bounding boxes of one sequence, as written by `build_sequence_circles`.
+    """
+
+    def __init__(self, sidecar_path):
+        with np.load(sidecar_path) as data:
+            self.mask_hw = tuple(int(i) for i in data["mask_hw"])
+            self.frame_numbers = data["frame_numbers"]
+            self.bboxes = data["bboxes"]
+            self.circles = data["circles"]
+
+    def _get_frame_pos(self, frame_num):
+        pos = np.searchsorted(self.frame_numbers, frame_num)
+        if pos < len(self.frame_numbers) and self.frame_numbers[pos] == frame_num:
+            return pos
+        return -1
+
+    def get_frame_bboxes(self, frame_num):
+        ## int [planes,4] like MaskStats.get_frame_bboxes, None when the frame has no sidecar entry
+        pos = self._get_frame_pos(frame_num)
+        return self.bboxes[pos] if pos >= 0 else None
+
+    def get_obj_circles(self, frame_num, obj_idx_list):
+        """
+        float32 [K,4] circles of the given objects of one frame, same as get_mask_circles on their masks.
+        Single object sequences only have the total plane.
+        """
+        pos = self._get_frame_pos(frame_num)
+        assert pos >= 0, f"frame {frame_num} is not in the circle sidecar"
+        circles = self.circles[pos]
+        plane_idx_list = [0 if len(circles) == 1 else 1 + obj_idx for obj_idx in obj_idx_list]
+        return circles[plane_idx_list]
+
+
+class CircleStore(object):
+    """
+    Lazily loaded per sequence circle sidecars written by `build_circle_store`, the last few
+    sequences are kept per process.
+    """
+
+    def __init__(self, store_root, max_cached=64):
+        self.store_root = store_root
+        self.max_cached = max_cached
+        self._sequences = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_sequences"] = OrderedDict()
+        return state
+
+    def get_sequence(self, data_type, seq_id):
+        """
+        SequenceCircles of one sequence, None when it has no sidecar.
+        """
+        key = (data_type, seq_id)
+        if key in self._sequences:
+            self._sequences.move_to_end(key)
+            return self._sequences[key]
+
+        sidecar_path = get_circle_sidecar_path(self.store_root, data_type, seq_id)
+        sequence = SequenceCircles(sidecar_path) if os.path.isfile(sidecar_path) else None
+        self._sequences[key] = sequence
+        while len(self._sequences) > self.max_cached:
+            self._sequences.popitem(last=False)
+        return sequence
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("circle_store_root", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    seq_num = build_circle_store(dataset, args.output)
+    print(f"wrote circle sidecars of {seq_num} sequences under {args.output}")
+
+
+if __name__ == "__main__":
+    main()
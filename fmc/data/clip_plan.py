@@ -0,0 +1,269 @@
+import os
+import math
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from .seq_index import get_sequence_key
+from .utils import get_sample_interval, get_tgt_fps_min
+
+
+CLIP_PLAN_MODE = "clip"
+FRAME_PLAN_MODE = "frame"
+
+
+def get_valid_start_list(seen_flags, interval, sample_num):
+    """
+    Start offsets (relative to the clip) whose sample_num frames, `interval` apart, all show an object.
+    """
+    start_num = len(seen_flags) - (sample_num - 1) * interval
+    if start_num <= 0:
+        return np.zeros(0, dtype=np.int64)
+    valid = np.ones(start_num, dtype=bool)
+    for i in range(sample_num):
+        valid &= seen_flags[i * interval:i * interval + start_num]
+    return np.flatnonzero(valid)
+
+
+def get_clip_seen_flags(seen_frame_flags, clip_start, clip_end):
+    ## seen_frame_flags: (frame_numbers, seen) of the sequence, or None when nothing is known about it
+    if seen_frame_flags is None:
+        return np.ones(clip_end - clip_start, dtype=bool)
+    frame_numbers, seen = seen_frame_flags
+    clip_seen = np.ones(clip_end - clip_start, dtype=bool)
+    in_clip = (frame_numbers >= clip_start) & (frame_numbers < clip_end)
+    clip_seen[frame_numbers[in_clip] - clip_start] = seen[in_clip]
+    return clip_seen
+
+
+def get_seen_frame_flags(dataset, idx, appearance_percentage=0.0015):
+    mask_stats = getattr(dataset, "mask_stats", None)
+    if mask_stats is None:
+        return None
+    row = mask_stats.get_row(dataset.data_type_list[idx], dataset.seq_id_list[idx])
+    if row < 0:
+        return None
+    return mask_stats.get_seen_frame_flags(row, appearance_percentage)
+
+
+def build_clip_plan(dataset, output_path, sample_num=16):
+    """
+    Enumerate the (sequence, clip range, fps) draws of UnrealTrajVideoDataset.sample_clip_from_image_folder
+    that have at least one start frame with an object in every sampled frame. Also records the share of
+    the original random draws (clip, fps, start) that would have been rejected.
+    """
+    ori_fps = dataset.ori_fps
+    keys, row_offsets = [], [0]
+    clip_ranges, tgt_fps_list, valid_counts = [], [], []
+    accept_prob_list = []
+
+    for idx in range(len(dataset.dataset)):
+        seen_frame_flags = get_seen_frame_flags(dataset, idx)
+
+        clip_accept_prob_list = []
+        row_num = len(tgt_fps_list)
+        for clip_start, clip_end in dataset.get_clip_time_list(idx):
+            video_length = clip_end - clip_start
+            tgt_fps_min = get_tgt_fps_min(ori_fps, video_length, sample_num)
+            if tgt_fps_min is None:
+                continue
+            clip_seen = get_clip_seen_flags(seen_frame_flags, clip_start, clip_end)
+
+            fps_accept_prob_list = []
+            valid_start_num_map = {}
+            for tgt_fps in range(tgt_fps_min, ori_fps + 1):
+                interval = get_sample_interval(ori_fps, tgt_fps, video_length, sample_num)
+                if interval not in valid_start_num_map:
+                    valid_start_num_map[interval] = len(get_valid_start_list(clip_seen, interval, sample_num))
+                valid_start_num = valid_start_num_map[interval]
+                fps_accept_prob_list.append(valid_start_num / (video_length - (sample_num - 1) * interval))
+                if valid_start_num > 0:
+                    clip_ranges.append([clip_start, clip_end])
+                    tgt_fps_list.append(tgt_fps)
+                    valid_counts.append(valid_start_num)
+            clip_accept_prob_list.append(np.mean(fps_accept_prob_list))
+
+        accept_prob_list.append(np.mean(clip_accept_prob_list) if clip_accept_prob_list else 0.0)
+        if len(tgt_fps_list) > row_num:
+            keys.append(get_sequence_key(dataset.data_type_list[idx], dataset.seq_id_list[idx]))
+            row_offsets.append(len(tgt_fps_list))
+
+    rejection_rate = 1.0 - float(np.mean(accept_prob_list)) if accept_prob_list else 0.0
+    save_plan(
+        output_path,
+        mode=CLIP_PLAN_MODE,
+        sample_num=sample_num,
+        keys=keys,
+        row_offsets=row_offsets,
+        clip_ranges=np.array(clip_ranges, dtype=np.int32).reshape(-1, 2),
+        tgt_fps=np.array(tgt_fps_list, dtype=np.int32),
+        valid_counts=np.array(valid_counts, dtype=np.int32),
+        rejection_rate=rejection_rate,
+    )
+    return len(keys), len(tgt_fps_list), rejection_rate
+
+
+def build_frame_plan(dataset, output_path):
+    """
+    Image (lora) version of `build_clip_plan`: one row per (sequence, frame) with an object in view.
+    """
+    keys, row_offsets, frame_list = [], [0], []
+    accept_prob_list = []
+
+    for idx in range(len(dataset.dataset)):
+        total_frames = len(dataset.load_img_list(idx)[:-1])
+        seen = get_clip_seen_flags(get_seen_frame_flags(dataset, idx), 0, total_frames)
+
+        seen_frames = np.flatnonzero(seen)
+        accept_prob_list.append(len(seen_frames) / total_frames if total_frames > 0 else 0.0)
+        if len(seen_frames) > 0:
+            frame_list.extend(seen_frames.tolist())
+            keys.append(get_sequence_key(dataset.data_type_list[idx], dataset.seq_id_list[idx]))
+            row_offsets.append(len(frame_list))
+
+    rejection_rate = 1.0 - float(np.mean(accept_prob_list)) if accept_prob_list else 0.0
+    save_plan(
+        output_path,
+        mode=FRAME_PLAN_MODE,
+        sample_num=1,
+        keys=keys,
+        row_offsets=row_offsets,
+        frames=np.array(frame_list, dtype=np.int32),
+        rejection_rate=rejection_rate,
+    )
+    return len(keys), len(frame_list), rejection_rate
+
+
+def save_plan(output_path, keys, row_offsets, rejection_rate, **kwargs):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    np.savez(
+        output_path,
+        keys=np.array(keys),
+        row_offsets=np.array(row_offsets, dtype=np.int64),
+        rejection_rate=np.float64(rejection_rate),
+        **kwargs,
+    )
+
+
+class ClipPlan(object):
+    """
+    Rows written by `build_clip_plan` / `build_frame_plan`, restricted to the sequences of `dataset`.
+    Rows of one sequence are contiguous, `seq_row_offsets[i]:seq_row_offsets[i+1]` belong to `seq_idx_list[i]`.
+    """
+
+    def __init__(self, plan_path, dataset):
+        with np.load(plan_path) as data:
+            self.mode = str(data["mode"])
+            self.sample_num = int(data["sample_num"])
+            self.rejection_rate = float(data["rejection_rate"])
+            keys = [str(i) for i in data["keys"]]
+            row_offsets = data["row_offsets"]
+            columns = {name: data[name] for name in ["clip_ranges", "tgt_fps", "frames"] if name in data}
+
+        idx_map = {get_sequence_key(data_type, seq_id): idx for idx, (data_type, seq_id) in enumerate(zip(dataset.data_type_list, dataset.seq_id_list))}
+
+        seq_idx_list, row_list = [], []
+        for key, start, end in zip(keys, row_offsets[:-1], row_offsets[1:]):
+            if key not in idx_map:
+                continue
+            seq_idx_list.append(idx_map[key])
+            row_list.append(np.arange(start, end))
+        rows = np.concatenate(row_list) if row_list else np.zeros(0, dtype=np.int64)
+
+        self.seq_idx_list = np.array(seq_idx_list, dtype=np.int64)
+        self.seq_row_offsets = np.concatenate([[0], np.cumsum([len(i) for i in row_list])]).astype(np.int64)
+        self.row_seq_idx = np.repeat(self.seq_idx_list, np.diff(self.seq_row_offsets))
+        self.columns = {name: column[rows] for name, column in columns.items()}
+
+    def __len__(self):
+        return len(self.row_seq_idx)
+
+    def get_seq_num(self):
+        return len(self.seq_idx_list)
+
+    def get_row(self, row):
+        ## (dataset idx, {column: value})
+        return int(self.row_seq_idx[row]), {name: column[row] for name, column in self.columns.items()}
+
+
+class ClipPlanSampler(Sampler):
+    """
+    Yields plan rows, one per planned sequence and epoch, so every draw is valid. Like DistributedSampler,
+    the epoch order only depends on seed and epoch and is split evenly across ranks.
+    """
+
+    def __init__(self, clip_plan, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False):
+        self.clip_plan = clip_plan
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        seq_num = clip_plan.get_seq_num()
+        if self.drop_last and seq_num % self.num_replicas != 0:
+            self.num_samples = math.ceil((seq_num - self.num_replicas) / self.num_replicas)
+        else:
+            self.num_samples = math.ceil(seq_num / self.num_replicas)
+        self.total_size = self.num_samples * self.num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+
+        seq_num = self.clip_plan.get_seq_num()
+        if self.shuffle:
+            seq_order = torch.randperm(seq_num, generator=g).numpy()
+        else:
+            seq_order = np.arange(seq_num)
+
+        ## a uniform row of each sequence, the rows of a sequence are its valid (clip, fps) or frames
+        row_start = self.clip_plan.seq_row_offsets[seq_order]
+        row_num = self.clip_plan.seq_row_offsets[seq_order + 1] - row_start
+        row_pick = (torch.rand(seq_num, generator=g, dtype=torch.float64).numpy() * row_num).astype(np.int64)
+        rows = (row_start + np.minimum(row_pick, row_num - 1)).tolist()
+
+        if not self.drop_last:
+            padding_size = self.total_size - len(rows)
+            if padding_size <= len(rows):
+                rows += rows[:padding_size]
+            else:
+                rows += (rows * math.ceil(padding_size / len(rows)))[:padding_size]
+        else:
+            rows = rows[:self.total_size]
+
+        return iter(rows[self.rank:self.total_size:self.num_replicas])
+
+    def __len__(self):
+        return self.num_samples
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("clip_plan_path", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    if hasattr(dataset, "get_clip_time_list"):
+        seq_num, row_num, rejection_rate = build_clip_plan(dataset, args.output)
+    else:
+        seq_num, row_num, rejection_rate = build_frame_plan(dataset, args.output)
+    print(f"planned {row_num} rows over {seq_num} sequences to {args.output}, {rejection_rate:.2%} of random draws were rejected")
+
+
+if __name__ == "__main__":
+    main()
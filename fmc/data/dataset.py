@@ -17,15 +17,29 @@ import csv
 import cv2
 
 from .utils import *
+from .seq_index import SequenceIndex
+from .shard import PackedShardReader,resolve_file,load_json_file
+from .pose_store import PoseStore
+from .mask_store import MaskStore
+from .mask_stats import MaskStats
+from .circle_store import CircleStore
+from .clip_plan import ClipPlan,get_valid_start_list,get_clip_seen_flags,get_seen_frame_flags
+from .meta import CameraMeta,to_sequence_meta,build_sequence_meta_map
+from .shared_meta import pack_dataset_metadata
+from .latent_cache import LatentCache,get_frame_number
+from .sphere_mask import get_mask_circles,render_gaussian_circle_masks
 from copy import deepcopy
 import imageio
 from nltk.stem import WordNetLemmatizer,PorterStemmer
 from einops import rearrange
 
 def get_background_description(hdri_json_data,cam_seq_data):
-    comment_dict=csv_param_to_dict(cam_seq_data["Comment"], str)
-    scene_type=comment_dict["scene_type"]
-    hdri_id=comment_dict["hdri"]
+    if isinstance(cam_seq_data,CameraMeta):
+        scene_type,hdri_id=cam_seq_data.scene_type,cam_seq_data.hdri_id
+    else:
+        comment_dict=csv_param_to_dict(cam_seq_data["Comment"], str)
+        scene_type=comment_dict["scene_type"]
+        hdri_id=comment_dict["hdri"]
     
     descriptions=hdri_json_data[hdri_id].get("descriptions",[])
     if len(descriptions)==0:
@@ -248,16 +262,11 @@ def get_seen_object_and_action_description_val(annotation_data,asset_json_data,s
 def get_seen_object_and_action_description_v3(mask_root,asset_json_data,seq_meta_data,time_idx,appearance_percentage=0.005,**kwargs):
     obj_description_list,action_description_list,action_type_list=[],[],[]
     
-    cam_seq_data=seq_meta_data["camera"]
-    objs_seq_data=seq_meta_data["objects"]
+    seq_meta=to_sequence_meta(seq_meta_data)
     
-    obj_num=len(objs_seq_data)
+    obj_num=seq_meta.get_obj_num()
     
-    obj_id_list=[]
-    for obj_idx in range(obj_num):
-        obj_seq_data=objs_seq_data[str(obj_idx)]
-        obj_comment_dict=csv_param_to_dict(obj_seq_data["Comment"], str)
-        obj_id_list.append(obj_comment_dict["obj_id"])
+    obj_id_list=[seq_meta.get_obj_id(obj_idx) for obj_idx in range(obj_num)]
         
     seen_obj_id_list,seen_obj_idx_list=[],[]
 
@@ -266,24 +275,51 @@ def get_seen_object_and_action_description_v3(mask_root,asset_json_data,seq_meta
     obj_mask_list=[]
     num = 0
     
-    total_mask_path = os.path.join(mask_root, "total.png")
-    total_mask = Image.open(total_mask_path)#.convert('L')
-    total_mask = np.array(total_mask)
-    total_mask = (total_mask > 0).astype(bool)
-    total_mask = total_mask[..., np.newaxis]  # Add third dimension
+    reader=kwargs.get("reader")
+    ## bool [planes,h,w] from MaskStore, object planes are already combined with the total mask
+    mask_planes=kwargs.get("mask_planes")
+    ## [planes,4] bounding boxes from MaskStats, visibility is decided on them and hidden objects are not decoded
+    plane_bboxes=kwargs.get("plane_bboxes")
+    mask_hw=kwargs.get("mask_hw")
+    ## False with plane_bboxes: only visibility is decided, no mask png is decoded and no mask is returned
+    load_obj_masks=kwargs.get("load_obj_masks",True) or plane_bboxes is None
+    
+    if not load_obj_masks:
+        total_mask = None
+    elif mask_planes is not None:
+        total_mask = mask_planes[0][..., np.newaxis]
+    else:
+        total_mask_path = os.path.join(mask_root, "total.png")
+        total_mask = Image.open(resolve_file(total_mask_path,reader))#.convert('L')
+        total_mask = np.array(total_mask)
+        total_mask = (total_mask > 0).astype(bool)
+        total_mask = total_mask[..., np.newaxis]  # Add third dimension
     
     AREA_PERCENTAGE=appearance_percentage
     
     if obj_num==1:
-        if is_normal_size(total_mask,percentage=AREA_PERCENTAGE):
+        if plane_bboxes is not None:
+            is_seen=is_normal_size_from_bbox(plane_bboxes[0],mask_hw,percentage=AREA_PERCENTAGE)
+        else:
+            is_seen=is_normal_size(total_mask,percentage=AREA_PERCENTAGE)
+        if is_seen:
             obj_mask_list.append(total_mask)
             seen_obj_id_list.append(obj_id_list[0])
             seen_obj_idx_list.append(0)
     
     else:
         for i in range(obj_num):
+            if plane_bboxes is not None and not is_normal_size_from_bbox(plane_bboxes[1+i],mask_hw,percentage=AREA_PERCENTAGE):
+                obj_mask_list.append(None)
+                continue
+            if not load_obj_masks:
+                obj_mask_list.append(True)
+                continue
+            if mask_planes is not None:
+                obj_mask_list.append(mask_planes[1+i][..., np.newaxis])
+                continue
             obj_mask_path = os.path.join(mask_root, f"{i}.png")
-            obj_mask = Image.open(obj_mask_path)#.convert('L')
+            obj_mask = Image.open(resolve_file(obj_mask_path,reader))#.convert('L')
             obj_mask = np.array(obj_mask)
             obj_mask = (obj_mask > 0).astype(bool)
             obj_mask = obj_mask[..., np.newaxis]  # Add third dimension
@@ -302,7 +338,11 @@ def get_seen_object_and_action_description_v3(mask_root,asset_json_data,seq_meta
 
         for idx in range(obj_num):
             obj_mask=obj_mask_list[idx]
-            if is_normal_size(obj_mask,percentage=AREA_PERCENTAGE):#percentage=0.015
+            if plane_bboxes is not None:
+                is_seen=obj_mask is not None
+            else:
+                is_seen=is_normal_size(obj_mask,percentage=AREA_PERCENTAGE)#percentage=0.015
+            if is_seen:
                 is_obj_in_image_list[idx]=True
                 obj_mask_list[idx]=obj_mask
             else:
@@ -347,7 +387,8 @@ def get_seen_object_and_action_description_v3(mask_root,asset_json_data,seq_meta
         #     pass
         obj_mask_list=new_obj_mask_list  
             
-
+    if not load_obj_masks:
+        obj_mask_list=[]
     
     
     for _,seen_obj_id in enumerate(seen_obj_id_list):
@@ -355,22 +396,13 @@ def get_seen_object_and_action_description_v3(mask_root,asset_json_data,seq_meta
         # time_range=cam_time_range_list[seg_idx]
         seen_obj_idx=obj_id_list.index(seen_obj_id)
         assert seen_obj_idx!=-1
-        time_range_list=eval(objs_seq_data[str(seen_obj_idx)]["Time_Range_List"])
+        obj_meta=seq_meta.objects[seen_obj_idx]
         
-        obj_seg_idx=-1
-        for seg_idx,time_range in enumerate(time_range_list):
-            start,end=time_range
-            if start<=time_idx and end>=time_idx:
-                obj_seg_idx=seg_idx
-                break
+        obj_seg_idx=obj_meta.get_segment_idx(time_idx)
         assert obj_seg_idx!=-1
         
-        obj_comment_dict=csv_param_to_dict(objs_seq_data[str(seen_obj_idx)]["Comment"], str)
-        animation_name_list=eval(obj_comment_dict["animation_name_list"])
-        _action_type_list=eval(obj_comment_dict["action_type_list"])
-        
-        animation_name=animation_name_list[obj_seg_idx]
-        action_type=_action_type_list[obj_seg_idx]
+        animation_name=obj_meta.animation_name_list[obj_seg_idx]
+        action_type=obj_meta.action_type_list[obj_seg_idx]
         
         action_description=asset_json_data[seen_obj_id]["animation"][animation_name].get("description","")
         
@@ -974,6 +1006,53 @@ def ray_condition(K, c2w, H, W, device, flip_flag=None):
 
 
 
+def load_seq_index(dataset,seq_index_path):
+    ## sequences whose masks are incomplete would fail in __getitem__, drop them up front
+    seq_index=SequenceIndex(seq_index_path)
+    
+    keep_idx_list,seq_index_row_list=[],[]
+    for idx in range(len(dataset.dataset)):
+        row=seq_index.get_row(dataset.data_type_list[idx],dataset.seq_id_list[idx])
+        if row>=0 and not seq_index.is_mask_complete(row):
+            continue
+        keep_idx_list.append(idx)
+        seq_index_row_list.append(row)
+    
+    dataset.dataset=[dataset.dataset[idx] for idx in keep_idx_list]
+    dataset.data_type_list=[dataset.data_type_list[idx] for idx in keep_idx_list]
+    dataset.seq_id_list=[dataset.seq_id_list[idx] for idx in keep_idx_list]
+    dataset.length=len(dataset.dataset)
+    
+    return seq_index,seq_index_row_list
+
+
+def get_reduce_factor(image_size,sample_size):
+    ## largest integer factor that keeps the decoded frame at least as large as sample_size, image_size is (w,h)
+    w,h=image_size
+    return max(1,min(w//sample_size[1],h//sample_size[0]))
+
+
+def decode_frames(img_path_list,reader=None,buffer=None,sample_size=None):
+    """
+    Decode frames into one uint8 [T,H,W,3] array. `buffer` is reused when its shape matches;
+    with `sample_size`, frames are box-reduced by an integer factor while decoding.
+    """
+    for t,img_path in enumerate(img_path_list):
+        image=Image.open(resolve_file(img_path,reader))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if sample_size is not None:
+            reduce_factor=get_reduce_factor(image.size,sample_size)
+            if reduce_factor>1:
+                image=image.reduce(reduce_factor)
+        
+        if t==0:
+            shape=(len(img_path_list),image.size[1],image.size[0],3)
+            if buffer is None or buffer.shape!=shape:
+                buffer=np.empty(shape,dtype=np.uint8)
+        buffer[t]=np.asarray(image)
+    
+    return buffer
 
 
 class UnrealTrajLoraDataset(Dataset):
@@ -1913,6 +1992,11 @@ class UnrealTrajLoraDataset(Dataset):
         sample_size=[256, 384],
         is_image=True,
         use_flip=True,
+        seq_index_path=None,
+        mask_stats_path=None,
+        clip_plan_path=None,
+        share_metadata=False,
+        latent_cache_root=None,
     ):
         # self.root_path = root_path
         self.data_root=data_root
@@ -2001,9 +2085,34 @@ class UnrealTrajLoraDataset(Dataset):
         
         self.mask_transforms = transforms.Compose(mask_transforms)
 
+        ## pre-encoded VAE latents (mean, std) replace the pixels, see fmc/data/latent_cache.py
+        self.use_flip=use_flip
+        self.latent_cache=None
+        if latent_cache_root is not None:
+            self.latent_cache=LatentCache(latent_cache_root,sample_size)
+        
+        ## parsed once here, samples only read attributes of the SequenceMeta records
+        self.seq_meta_data_map=build_sequence_meta_map(self._get_csv_meta_data_map(),seq_list=zip(self.data_type_list,self.seq_id_list))
+        
+        self.seq_index=None
+        self.seq_index_row_list=[]
+        if seq_index_path is not None:
+            self.seq_index,self.seq_index_row_list=load_seq_index(self,seq_index_path)
         
+        self.mask_stats=None
+        if mask_stats_path is not None:
+            self.mask_stats=MaskStats(mask_stats_path)
         
-        self.seq_meta_data_map=self._get_csv_meta_data_map()
+        ## rows are (sequence, frame) pairs with an object in view, see fmc/data/clip_plan.py
+        self.clip_plan=None
+        if clip_plan_path is not None:
+            assert is_image, "the frame plan only covers image sampling"
+            self.clip_plan=ClipPlan(clip_plan_path,self)
+        
+        ## numpy-backed metadata, forked workers keep sharing its pages instead of copying them on refcount writes
+        self.metadata_nbytes=None
+        if share_metadata:
+            self.metadata_nbytes=pack_dataset_metadata(self)
     
     
     def _get_csv_meta_data_map(self):
@@ -2056,6 +2165,8 @@ class UnrealTrajLoraDataset(Dataset):
         video_dict = self.dataset[idx]
         # video_path = os.path.join(self.root_path, video_dict['clip_path'])
         video_path=video_dict['clip_path']
+        if self.seq_index is not None and self.seq_index_row_list[idx]>=0:
+            return self.seq_index.get_frame_path_list(self.seq_index_row_list[idx],video_path)
         frame_files = sorted(
             [
                 os.path.join(video_path, f)
@@ -2079,7 +2190,7 @@ class UnrealTrajLoraDataset(Dataset):
 
         seq_meta_data=self.seq_meta_data_map[data_type][seq_id]
         
-        background_description=get_background_description(self.hdri_json_data,seq_meta_data["camera"])
+        background_description=get_background_description(self.hdri_json_data,seq_meta_data.camera)
         if "static" in data_type:
             static_type="static"
         else:
@@ -2122,8 +2233,7 @@ class UnrealTrajLoraDataset(Dataset):
         #     img.save(os.path.join(save_dir,f"{time_idx}-{mask_idx}.png"))
         
         
-        comment_dict=csv_param_to_dict(seq_meta_data["camera"]["Comment"], str)
-        scene_type=comment_dict["scene_type"]
+        scene_type=seq_meta_data.camera.scene_type
     
         if len(seen_obj_idx_list)>0:
             camera_pose_description_list=get_camera_pose_description_v2(annotation_data,seen_obj_idx_list,time_idx)
@@ -2146,12 +2256,14 @@ class UnrealTrajLoraDataset(Dataset):
         return total_description,total_mask,obj_mask_list
 
 
-    def get_batch(self, idx):
+    def get_batch(self, idx, plan_row=None):
         img_path_list = self.load_img_list(idx)[:-1]
         total_frames = len(img_path_list)
 
 
-        if self.is_image:
+        if plan_row is not None:
+            frame_indice = int(plan_row["frames"])
+        elif self.is_image:
             frame_indice = random.randint(0, total_frames - 1)
         else:
             if isinstance(self.sample_stride, int):
@@ -2171,11 +2283,14 @@ class UnrealTrajLoraDataset(Dataset):
         caption,total_mask,obj_mask_list=self.get_text_prompt_and_mask_list(idx,frame_indice)
         
         img_path=img_path_list[frame_indice]
-        image=Image.open(img_path_list[frame_indice])
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        pixel_values = torch.from_numpy(np.array(image)).permute(2, 0, 1).contiguous()
-        pixel_values = pixel_values / 255.
+        if self.latent_cache is not None:
+            pixel_values=self.get_cached_latents(idx,[get_frame_number(img_path)])[0]
+        else:
+            image=Image.open(img_path_list[frame_indice])
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            pixel_values = torch.from_numpy(np.array(image)).permute(2, 0, 1).contiguous()
+            pixel_values = pixel_values / 255.
         
         total_mask=torch.from_numpy(total_mask).permute(2, 0, 1).contiguous()
         new_obj_mask_list=[]
@@ -2187,20 +2302,35 @@ class UnrealTrajLoraDataset(Dataset):
 
         return img_path,pixel_values, caption,total_mask,obj_mask_list
 
+    def get_cached_latents(self,idx,frame_numbers):
+        ## [T,2,4,h,w] latent mean and std, the flip variant stands in for RandomHorizontalFlip
+        row=self.latent_cache.get_row(self.data_type_list[idx],self.seq_id_list[idx])
+        flip=self.use_flip and random.random()<0.5
+        return torch.from_numpy(self.latent_cache.get_latents(row,frame_numbers,flip=flip))
+
     def __len__(self):
+        if self.clip_plan is not None:
+            return len(self.clip_plan)
         return self.length
 
 
     def __getitem__(self, idx):
-        while True:
-            img_path,image, image_caption,total_mask,obj_mask_list = self.get_batch(idx)
-            if image_caption!="":
-                break
-            else:
-                idx = random.randint(0, self.length - 1)
-                continue
+        if self.clip_plan is not None:
+            ## idx is a plan row (see ClipPlanSampler), every row has an object in view so it always has a caption
+            seq_idx,plan_row=self.clip_plan.get_row(idx)
+            img_path,image, image_caption,total_mask,obj_mask_list = self.get_batch(seq_idx,plan_row=plan_row)
+            assert image_caption!="", f"clip plan row {idx} of sequence {self.seq_id_list[seq_idx]} has an empty caption"
+        else:
+            while True:
+                img_path,image, image_caption,total_mask,obj_mask_list = self.get_batch(idx)
+                if image_caption!="":
+                    break
+                else:
+                    idx = random.randint(0, len(self) - 1)
+                    continue
     
-        image = self.pixel_transforms(image)
+        if self.latent_cache is None:
+            image = self.pixel_transforms(image)
         
         total_mask=self.mask_transforms(total_mask)
         new_obj_mask_list=[]
@@ -2208,7 +2338,10 @@ class UnrealTrajLoraDataset(Dataset):
             new_obj_mask_list.append(self.mask_transforms(obj_mask))
         obj_mask_list=new_obj_mask_list
         # sample = dict(img_path=img_path,image=image, caption=image_caption,total_mask=total_mask,obj_mask_list=obj_mask_list)
-        sample = dict(img_path=img_path,image=image, caption=image_caption)
+        if self.latent_cache is not None:
+            sample = dict(img_path=img_path,latent_dist=image, caption=image_caption)
+        else:
+            sample = dict(img_path=img_path,image=image, caption=image_caption)
 
         return sample
 
@@ -4657,6 +4790,18 @@ class UnrealTrajVideoDataset(Dataset):
         cam_translation_rescale_factor=1,
         obj_translation_rescale_factor=1,
         use_sphere_mask=False,
+        seq_index_path=None,
+        shard_root=None,
+        reduced_decode=False,
+        pose_store_root=None,
+        mask_store_root=None,
+        mask_stats_path=None,
+        clip_plan_path=None,
+        share_metadata=False,
+        latent_cache_root=None,
+        render_sphere_mask_in_worker=True,
+        circle_store_root=None,
+        load_obj_masks=True,
     ):
         # self.root_path = root_path
         self.tokenizer=tokenizer
@@ -4675,6 +4820,8 @@ class UnrealTrajVideoDataset(Dataset):
         self.allow_change_tgt= allow_change_tgt
         
         self.use_sphere_mask=use_sphere_mask
+        ## False leaves the Gaussian sphere masks to fmc.data.sphere_mask.render_circle_mask_list_list after collate
+        self.render_sphere_mask_in_worker=render_sphere_mask_in_worker
         
         self.seq_csv_root=seq_csv_root
         self.hdri_json_file_path=hdri_json_file_path
@@ -4735,6 +4882,7 @@ class UnrealTrajVideoDataset(Dataset):
         self.length=len(self.dataset)
             
         sample_size = tuple(sample_size) if not isinstance(sample_size, int) else (sample_size, sample_size)
+        self.sample_size=sample_size
         if use_flip:
             pixel_transforms = [transforms.Resize(sample_size),
                                 transforms.RandomHorizontalFlip(),
@@ -4754,7 +4902,57 @@ class UnrealTrajVideoDataset(Dataset):
         
         self.mask_transforms = transforms.Compose(mask_transforms)
 
-        self.seq_meta_data_map=self._get_csv_meta_data_map()
+        ## pre-encoded VAE latents (mean, std) replace the pixels, see fmc/data/latent_cache.py
+        self.use_flip=use_flip
+        self.latent_cache=None
+        if latent_cache_root is not None:
+            self.latent_cache=LatentCache(latent_cache_root,sample_size)
+
+        ## parsed once here, samples only read attributes of the SequenceMeta records
+        self.seq_meta_data_map=build_sequence_meta_map(self._get_csv_meta_data_map(),seq_list=zip(self.data_type_list,self.seq_id_list))
+        
+        self.seq_index=None
+        self.seq_index_row_list=[]
+        if seq_index_path is not None:
+            self.seq_index,self.seq_index_row_list=load_seq_index(self,seq_index_path)
+        
+        self.shard_reader=None
+        if shard_root is not None:
+            self.shard_reader=PackedShardReader(shard_root,data_root,lable_root,mask_root)
+        
+        ## decode straight to a size close to sample_size, pixel_transforms still resizes to the exact size
+        self.reduced_decode_size=sample_size if reduced_decode else None
+        self._frame_buffer=None
+        
+        self.pose_store=None
+        if pose_store_root is not None:
+            self.pose_store=PoseStore(pose_store_root)
+        
+        self.mask_store=None
+        if mask_store_root is not None:
+            self.mask_store=MaskStore(mask_store_root)
+        
+        self.mask_stats=None
+        if mask_stats_path is not None:
+            self.mask_stats=MaskStats(mask_stats_path)
+        
+        ## per sequence enclosing circles and bounding boxes, see fmc/data/circle_store.py
+        self.circle_store=None
+        if circle_store_root is not None:
+            self.circle_store=CircleStore(circle_store_root)
+        ## False drops obj_mask_list (only the masked loss and the non-sphere features need it), frames
+        ## whose boxes and, with use_sphere_mask, circles are stored are then not decoded at all
+        self.load_obj_masks=load_obj_masks
+        
+        ## rows are (sequence, clip range, fps) draws with at least one valid start frame, see fmc/data/clip_plan.py
+        self.clip_plan=None
+        if clip_plan_path is not None:
+            self.clip_plan=ClipPlan(clip_plan_path,self)
+        
+        ## numpy-backed metadata, forked workers keep sharing its pages instead of copying them on refcount writes
+        self.metadata_nbytes=None
+        if share_metadata:
+            self.metadata_nbytes=pack_dataset_metadata(self)
     
     
     def _get_csv_meta_data_map(self):
@@ -4803,6 +5001,10 @@ class UnrealTrajVideoDataset(Dataset):
     def load_img_list(self, idx):
         video_dict = self.dataset[idx]
         video_path=video_dict['clip_path']
+        if self.seq_index is not None and self.seq_index_row_list[idx]>=0:
+            return self.seq_index.get_frame_path_list(self.seq_index_row_list[idx],video_path)
+        if self.shard_reader is not None:
+            return self.shard_reader.list_frame_files(video_path)
         frame_files = sorted(
             [
                 os.path.join(video_path, f)
@@ -4811,19 +5013,41 @@ class UnrealTrajVideoDataset(Dataset):
             ]
         )
         return frame_files
-
-    def get_text_prompt_and_mask_list(self,idx,frame_idx_list):
+    
+    def has_seen_object_in_all_frames(self,idx,frame_idx_list,appearance_percentage=0.0015):
+        ## decided from MaskStats only, without stats every clip is accepted here and checked on the masks
+        if self.mask_stats is None:
+            return True
+        row=self.mask_stats.get_row(self.data_type_list[idx],self.seq_id_list[idx])
+        if row<0:
+            return True
+        for time_idx in frame_idx_list:
+            plane_bboxes=self.mask_stats.get_frame_bboxes(row,time_idx)
+            if plane_bboxes is None:
+                return True
+            obj_bboxes=plane_bboxes if len(plane_bboxes)==1 else plane_bboxes[1:]
+            if not any(is_normal_size_from_bbox(bbox,self.mask_stats.mask_hw,percentage=appearance_percentage) for bbox in obj_bboxes):
+                return False
+        return True
+    
+    def load_annotation_data(self,idx):
+        if self.pose_store is not None:
+            row=self.pose_store.get_row(self.data_type_list[idx],self.seq_id_list[idx])
+            if row>=0:
+                return self.pose_store.get_annotation_data(row)
+        return load_json_file(self.dataset[idx]["annotation_file_path"],self.shard_reader)
+
+    def get_text_prompt_and_mask_list(self,idx,frame_idx_list,annotation_data=None):
         data_type=self.data_type_list[idx]
         label_data=self.dataset[idx]
         seq_id=self.seq_id_list[idx]
-        annotation_file_path=label_data["annotation_file_path"]
-        with open(annotation_file_path,"r") as f:
-            annotation_data=json.load(f)
+        if annotation_data is None:
+            annotation_data=self.load_annotation_data(idx)
         
         # seq_id=self.seq_id_list[idx]
         seq_meta_data=self.seq_meta_data_map[data_type][seq_id]
         
-        background_description=get_background_description(self.hdri_json_data,seq_meta_data["camera"])
+        background_description=get_background_description(self.hdri_json_data,seq_meta_data.camera)
         if "static" in data_type:
             static_type="static"
         else:
@@ -4841,10 +5065,30 @@ class UnrealTrajVideoDataset(Dataset):
             "data_type":data_type,
             "seq_id":seq_id,
             "max_num":None,
+            "reader":self.shard_reader,
         }
         
+        mask_store_row=self.mask_store.get_row(data_type,seq_id) if self.mask_store is not None else -1
+        mask_stats_row=self.mask_stats.get_row(data_type,seq_id) if self.mask_stats is not None else -1
+        seq_circles=self.circle_store.get_sequence(data_type,seq_id) if self.circle_store is not None else None
+        
         seen_obj_id_list_list,seen_obj_idx_list_list,total_mask_list,obj_mask_list_list,object_description_list_list,action_description_list_list,action_type_list_list=[],[],[],[],[],[],[]
+        circle_list=[]
         for time_idx in frame_idx_list:
+            ## per frame, so a frame missing from the stores never sees the previous frame's boxes
+            kwargs["plane_bboxes"]=None
+            kwargs["mask_hw"]=None
+            if self.mask_store is not None:
+                kwargs["mask_planes"]=self.mask_store.get_frame_planes(mask_store_row,time_idx)
+            if self.mask_stats is not None:
+                kwargs["plane_bboxes"]=self.mask_stats.get_frame_bboxes(mask_stats_row,time_idx)
+                kwargs["mask_hw"]=self.mask_stats.mask_hw
+            circle_bboxes=seq_circles.get_frame_bboxes(time_idx) if seq_circles is not None else None
+            if circle_bboxes is not None:
+                kwargs["plane_bboxes"]=circle_bboxes
+                kwargs["mask_hw"]=seq_circles.mask_hw
+            ## frames missing from the circle store still need their masks for the circles
+            kwargs["load_obj_masks"]=self.load_obj_masks or (self.use_sphere_mask and circle_bboxes is None)
             # exr_file_path=os.path.join(self.data_root,f"Rendered_Traj_Results{multi_suffix}",static_type,seq_id,"exr",f"{time_idx:04}.exr") ##traj_dataset/Rendered_Traj_Results
             # seen_obj_id_list,seen_obj_idx_list,total_mask,obj_mask_list,object_description_list,action_description_list,action_type_list=get_seen_object_and_action_description_v2(exr_file_path,self.asset_json_data,seq_meta_data,time_idx,appearance_percentage=0.0015,**kwargs)
             mask_root=os.path.join(self.mask_root,f"Rendered_Traj_Results{multi_suffix}",static_type,seq_id,str(time_idx))
@@ -4857,38 +5101,30 @@ class UnrealTrajVideoDataset(Dataset):
             action_description_list_list.append(action_description_list)
             action_type_list_list.append(action_type_list)
             
+            if self.use_sphere_mask and seen_obj_idx_list:
+                if circle_bboxes is not None:
+                    circle_list.append(torch.from_numpy(seq_circles.get_obj_circles(time_idx,seen_obj_idx_list)))
+                else:
+                    circle_list.append(get_mask_circles(obj_mask_list))
+            
 
-        annotation_file_path=label_data["annotation_file_path"]
-        with open(annotation_file_path,"r") as f:
-            annotation_data=json.load(f)
         objs_dict=annotation_data["objects"]
     
+        ## poses of all (frame, seen object) pairs in one batched call, then split per frame
+        obj_row_list=[objs_dict[str(seen_obj_idx)][time_idx] for seen_obj_idx_list,time_idx in zip(seen_obj_idx_list_list,frame_idx_list) for seen_obj_idx in seen_obj_idx_list]
         objs_info_np_list=[]
-        for seen_obj_idx_list,time_idx in zip(seen_obj_idx_list_list,frame_idx_list):
-            obj_info_list=[]
-            for seen_obj_idx in seen_obj_idx_list:
-                seen_obj_idx=str(seen_obj_idx)
-                obj_xyz,obj_euler_rot=objs_dict[seen_obj_idx][time_idx][-3:],objs_dict[seen_obj_idx][time_idx][3:6]
-                obj_rot=transform_euler_to_matrix_v2(obj_euler_rot[2],obj_euler_rot[1],obj_euler_rot[0]) ##,roll, pitch , yaw
-                
-                ##transform to RealEstate-10K. [x,y,z] in realestate -> [y,-z,x] in unreal
-                
-                obj_rot=np.array(obj_rot)
-                # obj_rot=np.array([obj_rot[:,1],-obj_rot[:,2],obj_rot[:,0]])
-                
-                obj_info=np.eye(4)
-                
-                obj_info[:3,:3]=obj_rot
-                obj_info[:3,3]=np.array(obj_xyz)
-                obj_info_list.append(obj_info)
-                
-            if obj_info_list:
-                objs_info_np_list.append(np.stack(obj_info_list))
+        if obj_row_list:
+            obj_np=np.asarray(obj_row_list,dtype=np.float64)
+            obj_info_np=create_pose_matrix_batch(obj_np[:,-3:],obj_np[:,[5,4,3]]) ##,roll, pitch , yaw
+            start=0
+            for seen_obj_idx_list in seen_obj_idx_list_list:
+                if seen_obj_idx_list:
+                    objs_info_np_list.append(obj_info_np[start:start+len(seen_obj_idx_list)])
+                start+=len(seen_obj_idx_list)
         
         # mask_root="temp_mask_motion"
         
-        comment_dict=csv_param_to_dict(seq_meta_data["camera"]["Comment"], str)
-        scene_type=comment_dict["scene_type"]
+        scene_type=seq_meta_data.camera.scene_type
         
         
         is_empty=any([len(seen_obj_id_list)==0 for seen_obj_id_list in seen_obj_id_list_list])
@@ -5149,7 +5385,7 @@ class UnrealTrajVideoDataset(Dataset):
             descriptor_template=random.choice(UnrealTrajVideoDataset.DESCRIPTOR_TEMPLATE)
             background_description=descriptor_template.format(sentence=background_description)      
         
-        return total_description,background_description,obj_sentence_list_list,obj_adj_sentence_list_list,objs_info_np_list,total_mask_list,obj_mask_list_list,object_description_list_list
+        return total_description,background_description,obj_sentence_list_list,obj_adj_sentence_list_list,objs_info_np_list,total_mask_list,obj_mask_list_list,object_description_list_list,circle_list
 
 
 
@@ -5164,7 +5400,7 @@ class UnrealTrajVideoDataset(Dataset):
         return enter_obj_idx_list, exit_obj_idx_list
 
     @classmethod
-    def sample_clip_from_image_folder(cls,ori_folder, ori_fps, time_duration, clip_time_list,start_frame=None, sample_num=16):
+    def sample_clip_from_image_folder(cls,ori_folder, ori_fps, time_duration, clip_time_list,start_frame=None, sample_num=16, frame_path_list=None, reader=None, load_images=True, tgt_fps=None):
         candidate_list=[]
         
         tgt_fps_min_list=[]
@@ -5173,18 +5409,15 @@ class UnrealTrajVideoDataset(Dataset):
             start,end=time_list
             video_length=end-start
             # interval = round(ori_fps / tgt_fps)
-            if video_length<sample_num:
+            tgt_fps_min=get_tgt_fps_min(ori_fps,video_length,sample_num)
+            if tgt_fps_min is None:
                 continue
-            max_interval = math.floor((video_length- 1)/(sample_num - 1))
-            
-            assert max_interval>0
             candidate_list.append(time_list)
-            tgt_fps_min=math.ceil(ori_fps/max_interval)
             tgt_fps_min_list.append(tgt_fps_min)
 
             
         if not candidate_list:
-            return None,None,False
+            return None,None,None,None,False
         
         chosen_idx=random.randint(0,len(tgt_fps_min_list)-1)
         candidate=candidate_list[chosen_idx]
@@ -5193,18 +5426,17 @@ class UnrealTrajVideoDataset(Dataset):
         
         
         tgt_fps_min=tgt_fps_min_list[chosen_idx]    
-        tgt_fps=random.randint(tgt_fps_min,ori_fps)
+        if tgt_fps is None:
+            tgt_fps=random.randint(tgt_fps_min,ori_fps)
         
         
         
-        interval = round(ori_fps / tgt_fps)
-        if (video_length - (sample_num - 1) * interval - 1<0):
-            interval = math.floor(ori_fps / tgt_fps)
+        interval = get_sample_interval(ori_fps,tgt_fps,video_length,sample_num)
             
 
-            
-        frame_path_list = [os.path.join(ori_folder, i) for i in os.listdir(ori_folder)]
-        frame_path_list = [i for i in frame_path_list if os.path.isfile(i)]
+        if frame_path_list is None:
+            frame_path_list = [os.path.join(ori_folder, i) for i in os.listdir(ori_folder)]
+            frame_path_list = [i for i in frame_path_list if os.path.isfile(i)]
         frame_path_list=sorted(frame_path_list)[:-1]
         
         final_frame_path_list = []
@@ -5231,18 +5463,20 @@ class UnrealTrajVideoDataset(Dataset):
         for idx in frame_indices:
             frame_path = final_frame_path_list[idx]
             # if os.path.exists(frame_path):
-            img = imageio.imread(frame_path)
-            images.append(img)
+            if load_images:
+                img = imageio.imread(resolve_file(frame_path,reader))
+                images.append(img)
             img_path_list.append(frame_path)
         frame_indices=[int(os.path.basename(img_path_list[i]).split("_")[1].split(".")[0]) for i in range(len(img_path_list))]
         return tgt_fps,img_path_list,frame_indices, images,True
 
     @classmethod
-    def sample_video_from_image_folder(cls,ori_folder, ori_fps, time_duration, tgt_fps, start_frame=None, sample_num=16):
+    def sample_video_from_image_folder(cls,ori_folder, ori_fps, time_duration, tgt_fps, start_frame=None, sample_num=16, frame_path_list=None, reader=None, load_images=True):
         interval = round(ori_fps / tgt_fps)
 
-        frame_path_list = [os.path.join(ori_folder, i) for i in os.listdir(ori_folder)]
-        frame_path_list = [i for i in frame_path_list if os.path.isfile(i)]
+        if frame_path_list is None:
+            frame_path_list = [os.path.join(ori_folder, i) for i in os.listdir(ori_folder)]
+            frame_path_list = [i for i in frame_path_list if os.path.isfile(i)]
         frame_path_list=sorted(frame_path_list)[:-1]
         
         final_frame_path_list = []
@@ -5269,143 +5503,102 @@ class UnrealTrajVideoDataset(Dataset):
         for idx in frame_indices:
             frame_path = final_frame_path_list[idx]
             # if os.path.exists(frame_path):
-            img = imageio.imread(frame_path)
-            images.append(img)
+            if load_images:
+                img = imageio.imread(resolve_file(frame_path,reader))
+                images.append(img)
             img_path_list.append(frame_path)
 
         return img_path_list,frame_indices, images
 
     
     def get_clip_time_list(self,idx):
+        if self.seq_index is not None and self.seq_index_row_list[idx]>=0:
+            return self.seq_index.get_clip_time_list(self.seq_index_row_list[idx])
+        
         data_type=self.data_type_list[idx]
 
         seq_id=self.seq_id_list[idx]
         seq_meta_data=self.seq_meta_data_map[data_type][seq_id]
         
+        return [list(time_range) for time_range in seq_meta_data.camera.clip_time_list]
         
-        clip_time_list=[]
-        
-        comment_dict=csv_param_to_dict(seq_meta_data["camera"]["Comment"], str)
-        tgt_obj_id_list=eval(comment_dict["tgt_obj_id_list"])
-        
-        cam_time_range_list=eval(seq_meta_data["camera"]["Time_Range_List"])
-        
-        prev_tgt_id=None
-        for time_range,tgt_id in zip(cam_time_range_list,tgt_obj_id_list):
-            if prev_tgt_id is None or tgt_id !=prev_tgt_id:
-                clip_time_list.append(time_range)
-            else:
-                assert clip_time_list[-1][-1]==time_range[0]
-                clip_time_list[-1][-1]=time_range[-1]
-                
-            prev_tgt_id=tgt_id
-        
-        return clip_time_list
-        
-    def get_batch(self, idx):
+    def sample_planned_start_frame(self,idx,clip_start,clip_end,tgt_fps,sample_num=16):
+        ## a uniform start among those whose frames all show an object
+        video_length=clip_end-clip_start
+        interval=get_sample_interval(self.ori_fps,tgt_fps,video_length,sample_num)
+        clip_seen=get_clip_seen_flags(get_seen_frame_flags(self,idx),clip_start,clip_end)
+        valid_start_list=get_valid_start_list(clip_seen,interval,sample_num)
+        return int(random.choice(valid_start_list))
+    
+    def get_batch(self, idx, plan_row=None):
         video_dict = self.dataset[idx]
 
         video_path=video_dict['clip_path']
+        
+        frame_path_list=self.load_img_list(idx) if (self.seq_index is not None or self.shard_reader is not None) else None
 
-        if self.allow_change_tgt:
+        if plan_row is not None:
+            clip_start,clip_end=[int(i) for i in plan_row["clip_ranges"]]
+            tgt_fps=int(plan_row["tgt_fps"])
+            start_frame=self.sample_planned_start_frame(idx,clip_start,clip_end,tgt_fps)
+            tgt_fps,img_path_list,frame_list, _ ,found= self.sample_clip_from_image_folder(
+                video_path, self.ori_fps, self.time_duration,[[clip_start,clip_end]],start_frame=start_frame,sample_num=16, frame_path_list=frame_path_list, reader=self.shard_reader, load_images=False, tgt_fps=tgt_fps
+            )
+        elif self.allow_change_tgt:
             tgt_fps=random.choice(self.tgt_fps_list)
-            img_path_list,frame_list, images = self.sample_video_from_image_folder(
-                video_path, self.ori_fps, self.time_duration, tgt_fps,  sample_num=16
+            img_path_list,frame_list, _ = self.sample_video_from_image_folder(
+                video_path, self.ori_fps, self.time_duration, tgt_fps,  sample_num=16, frame_path_list=frame_path_list, reader=self.shard_reader, load_images=False
             )
+            found=True
         else:
             clip_time_list=self.get_clip_time_list(idx)
-            tgt_fps,img_path_list,frame_list, images ,found= self.sample_clip_from_image_folder(
-                video_path, self.ori_fps, self.time_duration,clip_time_list,sample_num=16
+            tgt_fps,img_path_list,frame_list, _ ,found= self.sample_clip_from_image_folder(
+                video_path, self.ori_fps, self.time_duration,clip_time_list,sample_num=16, frame_path_list=frame_path_list, reader=self.shard_reader, load_images=False
             )
-            if not found:
-                return "",None, "",None,None,None,None,None
-            
-            
-        camera_info_np,intrinsics=self.get_camera_info_np(self.dataset[idx],frame_list)
-        caption,background_description,obj_sentence_list_list,obj_adj_sentence_list_list,objs_info_np_list,total_mask_list,obj_mask_list_list,object_description_list_list=self.get_text_prompt_and_mask_list(idx,frame_list)
+        if not found:
+            return "",None, "",None,None,None,None,None,None,None,None,None,None,None,None
         
-        pixel_values=[]
-        for img_path in img_path_list:
-            image=Image.open(img_path)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            pixel_value = torch.from_numpy(np.array(image)).permute(2, 0, 1).contiguous()
-            pixel_values.append(pixel_value / 255.)
+        if not self.has_seen_object_in_all_frames(idx,frame_list):
+            ## the caption would be empty, reject before decoding frames and masks
+            return "",None, "",None,None,None,None,None,None,None,None,None,None,None,None
+            
+        annotation_data=self.load_annotation_data(idx)
+        camera_info_np,intrinsics=self.get_camera_info_np(self.dataset[idx],frame_list,annotation_data=annotation_data)
+        caption,background_description,obj_sentence_list_list,obj_adj_sentence_list_list,objs_info_np_list,total_mask_list,obj_mask_list_list,object_description_list_list,circle_list=self.get_text_prompt_and_mask_list(idx,frame_list,annotation_data=annotation_data)
         
-        pixel_values=torch.stack(pixel_values,axis=0)
+        if self.latent_cache is not None:
+            pixel_values=self.get_cached_latents(idx,frame_list)
+        else:
+            ## the buffer is reused across samples of this worker, the float conversion below copies out of it
+            self._frame_buffer=decode_frames(img_path_list,self.shard_reader,self._frame_buffer,self.reduced_decode_size)
+            pixel_values=torch.from_numpy(self._frame_buffer).permute(0, 3, 1, 2).to(torch.float32,memory_format=torch.contiguous_format).div_(255.)
         
         
         new_total_mask_list=[]
         
         for total_mask in total_mask_list:
+            if total_mask is None:
+                break
             total_mask=torch.from_numpy(total_mask).permute(2, 0, 1).contiguous()
             new_total_mask_list.append(total_mask)
         
-        total_mask=torch.stack(new_total_mask_list,axis=0)
+        ## frames read from the circle store only have no total mask
+        total_mask=torch.stack(new_total_mask_list,axis=0) if len(new_total_mask_list)==len(total_mask_list) else None
         
         # sphere
         circle_mask_list_list=[]
         
-        
         if self.use_sphere_mask:
-            # temp_save_dir="circle_mask"
-            for time_idx,obj_mask_list in enumerate(obj_mask_list_list):
-                circle_mask_list=[]
-                for mask_idx,mask in enumerate(obj_mask_list):
-                    y, x = np.nonzero(mask[...,0])
-                    gaussian_mask=mask[...,0]
-                    if len(x) > 0 and len(y) > 0:
-                        center, radius = cv2.minEnclosingCircle((np.column_stack((x, y))).astype(np.float32))
-                        circle_mask = np.zeros_like(mask).astype(np.uint8)
-                        # cv2.circle(circle_mask, (int(center[0]), int(center[1])), int(radius), 1, 0)
-                        # Draw a filled circle instead of just the outline
-                        cv2.circle(circle_mask, (int(center[0]), int(center[1])), int(radius), 1, -1)
-                        circle_mask=(circle_mask>0)
-                        # Generate a Gaussian circle mask
-                        y, x = np.ogrid[:mask.shape[0], :mask.shape[1]]
-                        dist_from_center = np.sqrt((x - center[0])**2 + (y - center[1])**2)
-                        
-                        # Create a Gaussian distribution
-                        # sigma = radius / 3  # Adjust this value to control the softness of the edge
-                        sigma = radius / 2  # Adjust this value to control the softness of the edge
-                        # sigma = 10
-                        # sigma = radius**2
-                        gaussian_mask = np.exp(-0.5 * (dist_from_center / sigma)**2)
-                        
-                        
-                        # Normalize the Gaussian mask
-                        gaussian_mask = gaussian_mask / gaussian_mask.max()
-
-                        
-                        gaussian_mask=circle_mask[...,0]*gaussian_mask
-
-                        # _circle_mask=gaussian_mask
-                        
-                        # img = Image.fromarray((_circle_mask*255).astype(np.uint8))
-
-                        # img.save(os.path.join(temp_save_dir,f"{time_idx}-{mask_idx}.png"))
-                        
-                        # ord_mask=mask[...,0]
-                        
-                        # img = Image.fromarray((ord_mask).astype(np.uint8)*255)
-
-                        # img.save(os.path.join(temp_save_dir,f"mask-{time_idx}-{mask_idx}.png"))
-                        
-                        
-                        # img = Image.fromarray((circle_mask[...,0]).astype(np.uint8)*255)
-
-                        # img.save(os.path.join(temp_save_dir,f"circle-mask-{time_idx}-{mask_idx}.png"))
-                        # pass
-                    circle_mask_list.append(torch.from_numpy(gaussian_mask[...,None]).permute(2, 0, 1).contiguous())
-                
-                # circle_mask_list_list.append(circle_mask_list)
-                if circle_mask_list:
-                    circle_mask_list_list.append(torch.stack(circle_mask_list))
-                    
+            ## enclosing circles of every frame, the Gaussian masks of all objects are rendered in one call at sample_size
+            if self.render_sphere_mask_in_worker and circle_list:
+                circle_masks=render_gaussian_circle_masks(torch.cat(circle_list),self.sample_size)
+                circle_mask_list_list=list(circle_masks[:,None].split([len(circles) for circles in circle_list]))
 
         circle_mask_list=circle_mask_list_list
         
         new_obj_mask_list_list=[]
+        if not self.load_obj_masks:
+            obj_mask_list_list=[]
         for obj_mask_list in obj_mask_list_list:
             new_obj_mask_list=[]
             for obj_mask in obj_mask_list:
@@ -5422,59 +5615,57 @@ class UnrealTrajVideoDataset(Dataset):
         for obj_info in objs_info_np_list:
             objs_info_list.append(torch.from_numpy(obj_info))
         
-        return video_path,pixel_values, caption,background_description,torch.from_numpy(camera_info_np),objs_info_list,total_mask,obj_mask_list,frame_list,torch.from_numpy(intrinsics),circle_mask_list,obj_sentence_list_list,obj_adj_sentence_list_list,object_description_list_list
+        return video_path,pixel_values, caption,background_description,torch.from_numpy(camera_info_np),objs_info_list,total_mask,obj_mask_list,frame_list,torch.from_numpy(intrinsics),circle_mask_list,obj_sentence_list_list,obj_adj_sentence_list_list,object_description_list_list,circle_list
+
+    def get_cached_latents(self,idx,frame_numbers):
+        ## [T,2,4,h,w] latent mean and std, the flip variant stands in for RandomHorizontalFlip
+        row=self.latent_cache.get_row(self.data_type_list[idx],self.seq_id_list[idx])
+        flip=self.use_flip and random.random()<0.5
+        return torch.from_numpy(self.latent_cache.get_latents(row,frame_numbers,flip=flip))
 
     @classmethod
-    def get_camera_info_np(cls,label_data,frame_idx_list):
-        annotation_file_path=label_data["annotation_file_path"]
-        with open(annotation_file_path,"r") as f:
-            annotation_data=json.load(f)
+    def get_camera_info_np(cls,label_data,frame_idx_list,reader=None,annotation_data=None):
+        if annotation_data is None:
+            annotation_data=load_json_file(label_data["annotation_file_path"],reader)
         cam_dict=annotation_data["camera"]
-    
-        cam_info_list=[]
         
-        intrinsics=[]
-        for time_idx in frame_idx_list:
-            cam_xyz,cam_euler_rot=cam_dict[time_idx][:3],cam_dict[time_idx][3:6]
-            cam_rot=transform_euler_to_matrix_v2(cam_euler_rot[2],cam_euler_rot[1],cam_euler_rot[0]) ##,roll, pitch , yaw
-            
-            cam_rot=np.array(cam_rot)
-
-            cam_info=np.eye(4)
-            
-            cam_info[:3,:3]=cam_rot
-            cam_info[:3,3]=np.array(cam_xyz)
- 
-            cam_info_list.append(cam_info)
-            
-            
-            intrinsic=cam_dict[time_idx][-3:-1]+[0,0]
-            intrinsics.append(intrinsic)
-            
+        ## one row per frame: xyz, euler (yaw, pitch, roll), ..., two intrinsics, ...
+        cam_np=np.asarray([cam_dict[time_idx] for time_idx in frame_idx_list],dtype=np.float64)
+        cam_info_np=create_pose_matrix_batch(cam_np[:,:3],cam_np[:,[5,4,3]]) ##,roll, pitch , yaw
         
-        cam_info_np=np.stack(cam_info_list)
-        intrinsics=np.stack(intrinsics)
+        intrinsics=np.zeros((len(cam_np),4))
+        intrinsics[:,:2]=cam_np[:,-3:-1]
         return cam_info_np,intrinsics
             
             
     def __len__(self):
+        if self.clip_plan is not None:
+            return len(self.clip_plan)
         return self.length
 
 
     def __getitem__(self, idx):
-        while True:
-            video_path,video, video_caption,background_description,camera_info,obj_info_list,total_mask,obj_mask_list,frame_list,intrinsics,circle_mask_list,obj_sentence_list_list,obj_adj_sentence_list_list,object_description_list_list = self.get_batch(idx)
-            if video_caption!="":
-                break
-            else:
-                idx = random.randint(0, self.length - 1)
-                continue
+        if self.clip_plan is not None:
+            ## idx is a plan row (see ClipPlanSampler), every row is a clip with an object in view so it always has a caption
+            seq_idx,plan_row=self.clip_plan.get_row(idx)
+            video_path,video, video_caption,background_description,camera_info,obj_info_list,total_mask,obj_mask_list,frame_list,intrinsics,circle_mask_list,obj_sentence_list_list,obj_adj_sentence_list_list,object_description_list_list,circle_list = self.get_batch(seq_idx,plan_row=plan_row)
+            assert video_caption!="", f"clip plan row {idx} of sequence {self.seq_id_list[seq_idx]} has an empty caption"
+        else:
+            while True:
+                video_path,video, video_caption,background_description,camera_info,obj_info_list,total_mask,obj_mask_list,frame_list,intrinsics,circle_mask_list,obj_sentence_list_list,obj_adj_sentence_list_list,object_description_list_list,circle_list = self.get_batch(idx)
+                if video_caption!="":
+                    break
+                else:
+                    idx = random.randint(0, len(self) - 1)
+                    continue
 
-        video = self.pixel_transforms(video)
+        if self.latent_cache is None:
+            video = self.pixel_transforms(video)
 
-        video = rearrange(video, "t c h w-> c t h w") ## t c h w-> c t h w
+            video = rearrange(video, "t c h w-> c t h w") ## t c h w-> c t h w
 
-        total_mask=self.mask_transforms(total_mask)
+        if total_mask is not None:
+            total_mask=self.mask_transforms(total_mask)
         
         new_obj_mask_list=[]
         for obj_mask in obj_mask_list:
@@ -5506,7 +5697,11 @@ class UnrealTrajVideoDataset(Dataset):
         # Repeat this new camera info for all frames
         camera_info[0]=new_first_camera_info
         
-        sample = dict(video_path=video_path,pixel_values=video, caption=video_caption,background_description=background_description,camera_info=camera_info,obj_info_list=obj_info_list,obj_mask_list=obj_mask_list,frame_list=frame_list,intrinsics=intrinsics,circle_mask_list=circle_mask_list,obj_sentence_list=obj_sentence_list_list,obj_adj_sentence_list=obj_adj_sentence_list_list,object_description_list=object_description_list_list)
+        sample = dict(video_path=video_path,caption=video_caption,background_description=background_description,camera_info=camera_info,obj_info_list=obj_info_list,obj_mask_list=obj_mask_list,frame_list=frame_list,intrinsics=intrinsics,circle_mask_list=circle_mask_list,circle_list=circle_list,obj_sentence_list=obj_sentence_list_list,obj_adj_sentence_list=obj_adj_sentence_list_list,object_description_list=object_description_list_list)
+        if self.latent_cache is not None:
+            sample["latent_dist"]=video
+        else:
+            sample["pixel_values"]=video
         # sample = dict(video_path=video_path,pixel_values=video, caption=video_caption,camera_info=camera_info,obj_info_list=obj_info_list)
 
         return sample
@@ -5516,7 +5711,7 @@ class UnrealTrajVideoDataset(Dataset):
     def get_ref_matrix(cls,camera_info,obj_info_list,cam_translation_rescale_factor,obj_translation_rescale_factor):
         ##get camera to obj
         
-        new_camera_info=create_relative_matrix_of_cam_list(camera_info,cam_translation_rescale_factor)
+        new_camera_info=create_relative_matrix_of_cam_batch(camera_info,cam_translation_rescale_factor)
         
         new_obj_info_list=[]
         
@@ -5532,7 +5727,9 @@ class UnrealTrajVideoDataset(Dataset):
     def collate_fn(cls,batch):
         # Collate function for DataLoader
         video_paths = [item['video_path'] for item in batch]
-        pixel_values = torch.stack([item['pixel_values'] for item in batch])
+        ## latent cache samples carry [f,2,c,h,w] latent distributions instead of pixels
+        pixel_values = torch.stack([item['pixel_values'] for item in batch]) if 'pixel_values' in batch[0] else None
+        latent_dists = torch.stack([item['latent_dist'] for item in batch]) if 'latent_dist' in batch[0] else None
         captions = [item['caption'] for item in batch]
         background_captions = [item['background_description'] for item in batch]
         camera_infos = torch.stack([item['camera_info'] for item in batch])
@@ -5544,6 +5741,8 @@ class UnrealTrajVideoDataset(Dataset):
         
         circle_mask_list_list=[item['circle_mask_list'] for item in batch]
         
+        circle_list_list=[item['circle_list'] for item in batch]
+        
         obj_sentence_list_list=[item['obj_sentence_list'] for item in batch]
         
         obj_adj_sentence_list_list=[item['obj_adj_sentence_list'] for item in batch]
@@ -5554,6 +5753,7 @@ class UnrealTrajVideoDataset(Dataset):
         return {
             'video_paths': video_paths,
             'videos': pixel_values,
+            'latent_dists': latent_dists,
             'captions': captions,
             'background_captions': background_captions,
             'camera_infos': camera_infos,
@@ -5562,7 +5762,35 @@ class UnrealTrajVideoDataset(Dataset):
             'frame_list_list':frame_list_list,
             "intrinsics":intrinsics,
             "circle_mask_list_list":circle_mask_list_list,
+            "circle_list_list":circle_list_list,
             "obj_sentence_list_list":obj_sentence_list_list,
             "obj_adj_sentence_list_list":obj_adj_sentence_list_list,
             "object_description_list_list":object_description_list_list,
         }
+    
+    @classmethod
+    def padded_collate_fn(cls,batch,max_objects=None):
+        """
+        collate_fn with the ragged object lists replaced by zero padded [B,F,O,...] tensors, one buffer per field:
+        obj_infos [B,F,O,12], obj_masks / circle_masks [B,F,O,H,W], circles [B,F,O,4], obj_counts [B,F], obj_valid [B,F,O].
+        O is max_objects (fixed shapes) or the largest object count of the batch. Fields without data are None.
+        Use functools.partial(UnrealTrajVideoDataset.padded_collate_fn, max_objects=...) as the DataLoader collate_fn.
+        """
+        collated=cls.collate_fn(batch)
+        obj_infos,obj_masks,obj_counts,obj_valid=pad_object_conditions(collated.pop('obj_info_list_list'),collated.pop('obj_mask_list_list'),max_objects)
+        num_objects=obj_valid.shape[-1]
+        
+        circle_masks=pad_object_list_list(collated.pop('circle_mask_list_list'),num_objects)
+        if circle_masks is not None:
+            circle_masks=circle_masks[:,:,:,0]
+        circles=pad_object_list_list(collated.pop('circle_list_list'),num_objects)
+        
+        collated.update({
+            'obj_infos':obj_infos,
+            'obj_masks':obj_masks,
+            'circle_masks':circle_masks,
+            'circles':circles,
+            'obj_counts':obj_counts,
+            'obj_valid':obj_valid,
+        })
+        return collated
@@ -0,0 +1,187 @@
+import os
+import argparse
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+import torchvision.transforms.functional as F
+
+from .seq_index import get_sequence_key
+
+
+LATENT_CACHE_META_NAME = "latent_cache.npz"
+LATENT_NAME = "latents.f16"
+FLIP_LATENT_NAME = "latents_flip.f16"
+
+
+def get_latent_cache_dir(cache_root, sample_size):
+    ## one sub directory per training sample_size, e.g. 256x384
+    sample_size = [sample_size, sample_size] if isinstance(sample_size, int) else list(sample_size)
+    return os.path.join(cache_root, f"{sample_size[0]}x{sample_size[1]}")
+
+
+def get_frame_number(frame_path):
+    ## frames are stored as {seq_id}_{frame}.png
+    return int(os.path.basename(frame_path).split("_")[1].split(".")[0])
+
+
+@torch.no_grad()
+def encode_latent_dist(vae, pixel_values):
+    ## pixel_values [T,3,H,W] in [-1,1] -> float16 [T,2,4,h,w], mean and std of the latent distribution
+    latent_dist = vae.encode(pixel_values).latent_dist
+    return torch.stack([latent_dist.mean, latent_dist.std], dim=1).to(torch.float16).cpu().numpy()
+
+
+def build_latent_cache(dataset, vae, output_root, sample_size, use_flip=False, batch_size=16, device="cuda"):
+    """
+    Encode every frame of every sequence of `dataset` with the frozen `vae` at `sample_size`, with the
+    same resize and normalization as the dataset's pixel_transforms. Only the mean and std of the
+    latent distribution are stored (float16), with `use_flip` also those of the horizontally flipped frame.
+    """
+    from .dataset import decode_frames
+
+    cache_dir = get_latent_cache_dir(output_root, sample_size)
+    os.makedirs(cache_dir, exist_ok=True)
+    sample_size = (sample_size, sample_size) if isinstance(sample_size, int) else tuple(sample_size)
+    pixel_transforms = transforms.Compose([
+        transforms.Resize(sample_size),
+        transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5], inplace=True),
+    ])
+
+    keys = []
+    frame_offsets, frame_numbers = [0], []
+    latent_shape = None
+    shard_reader = getattr(dataset, "shard_reader", None)
+
+    latent_f = open(os.path.join(cache_dir, LATENT_NAME), "wb")
+    flip_latent_f = open(os.path.join(cache_dir, FLIP_LATENT_NAME), "wb") if use_flip else None
+    try:
+        for idx in range(len(dataset.dataset)):
+            ## both datasets skip the last frame of a sequence, frames are kept in frame number order for the lookup
+            frame_path_list = sorted(dataset.load_img_list(idx)[:-1], key=get_frame_number)
+            for start in range(0, len(frame_path_list), batch_size):
+                chunk = frame_path_list[start:start + batch_size]
+                frames = decode_frames(chunk, shard_reader)
+                pixel_values = torch.from_numpy(frames).permute(0, 3, 1, 2).to(torch.float32).div_(255.)
+                pixel_values = pixel_transforms(pixel_values).to(device=device, dtype=vae.dtype)
+
+                latents = encode_latent_dist(vae, pixel_values)
+                if latent_shape is None:
+                    latent_shape = latents.shape[1:]
+                latent_f.write(latents.tobytes())
+                if use_flip:
+                    flip_latent_f.write(encode_latent_dist(vae, F.hflip(pixel_values)).tobytes())
+
+                frame_numbers.extend(get_frame_number(frame_path) for frame_path in chunk)
+
+            frame_offsets.append(len(frame_numbers))
+            keys.append(get_sequence_key(dataset.data_type_list[idx], dataset.seq_id_list[idx]))
+    finally:
+        latent_f.close()
+        if flip_latent_f is not None:
+            flip_latent_f.close()
+
+    np.savez(
+        os.path.join(cache_dir, LATENT_CACHE_META_NAME),
+        keys=np.array(keys),
+        sample_size=np.array(sample_size, dtype=np.int64),
+        latent_shape=np.array(latent_shape or (2, 4, 0, 0), dtype=np.int64),
+        has_flip=np.bool_(use_flip),
+        frame_offsets=np.array(frame_offsets, dtype=np.int64),
+        frame_numbers=np.array(frame_numbers, dtype=np.int32),
+    )
+    return len(keys), len(frame_numbers)
+
+
+class LatentCache(object):
+    """
+    Read-only view of the latents written by `build_latent_cache` for one sample_size.
+    The latent files are memory-mapped lazily in each process.
+    """
+
+    def __init__(self, cache_root, sample_size):
+        self.cache_dir = get_latent_cache_dir(cache_root, sample_size)
+        with np.load(os.path.join(self.cache_dir, LATENT_CACHE_META_NAME)) as data:
+            keys = data["keys"]
+            self.latent_shape = tuple(int(i) for i in data["latent_shape"])
+            self.has_flip = bool(data["has_flip"])
+            self.frame_offsets = data["frame_offsets"]
+            self.frame_numbers = data["frame_numbers"]
+        self.key_to_row = {str(key): row for row, key in enumerate(keys)}
+
+        self._latents = None
+        self._flip_latents = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_latents"] = None
+        state["_flip_latents"] = None
+        return state
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def _load(self, flip):
+        if flip:
+            if self._flip_latents is None:
+                self._flip_latents = np.memmap(os.path.join(self.cache_dir, FLIP_LATENT_NAME), dtype=np.float16, mode="r").reshape(-1, *self.latent_shape)
+            return self._flip_latents
+        if self._latents is None:
+            self._latents = np.memmap(os.path.join(self.cache_dir, LATENT_NAME), dtype=np.float16, mode="r").reshape(-1, *self.latent_shape)
+        return self._latents
+
+    def get_row(self, data_type, seq_id):
+        return self.key_to_row.get(get_sequence_key(data_type, seq_id), -1)
+
+    def get_latents(self, row, frame_numbers, flip=False):
+        """
+        float16 [T,2,4,h,w] mean and std of the given frames of one sequence.
+        """
+        assert row >= 0, "sequence is not in the latent cache"
+        assert not flip or self.has_flip, "the latent cache was built without flip variants"
+        start, end = self.frame_offsets[row], self.frame_offsets[row + 1]
+        pos = start + np.searchsorted(self.frame_numbers[start:end], frame_numbers)
+        assert np.all(pos < end) and np.all(self.frame_numbers[np.minimum(pos, end - 1)] == frame_numbers), "frame is not in the latent cache"
+        return np.array(self._load(flip)[pos])
+
+
+def sample_latents(latent_dist, scaling_factor=0.18215):
+    ## same as vae.encode(x).latent_dist.sample() * scaling_factor, latent_dist is [...,2,c,h,w] (mean, std)
+    mean, std = latent_dist.unbind(dim=-4)
+    return (mean + std * torch.randn_like(mean)) * scaling_factor
+
+
+def main():
+    from omegaconf import OmegaConf
+    from diffusers import AutoencoderKL
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--sample_size", type=int, nargs=2, action="append", default=None, help="h w, repeatable, defaults to the training sample_size")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("latent_cache_root", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    sample_size_list = args.sample_size
+    if sample_size_list is None:
+        sample_size_list = [params.get("sample_size", [256, 384])]
+    use_flip = params.get("use_flip", True)
+
+    vae = AutoencoderKL.from_pretrained(config.pretrained_model_path, subfolder="vae").to(args.device)
+    vae.requires_grad_(False)
+    vae.eval()
+
+    for sample_size in sample_size_list:
+        seq_num, frame_num = build_latent_cache(dataset, vae, args.output, sample_size, use_flip=use_flip, batch_size=args.batch_size, device=args.device)
+        print(f"encoded {frame_num} frames of {seq_num} sequences at {sample_size} under {args.output}{' with flip variants' if use_flip else ''}")
+
+
+if __name__ == "__main__":
+    main()
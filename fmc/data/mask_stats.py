@@ -0,0 +1,171 @@
+import os
+import argparse
+
+import numpy as np
+
+from .seq_index import get_sequence_key, get_sequence_rel_dir
+from .mask_store import get_frame_mask_planes
+
+
+def get_mask_bbox(mask):
+    ## [min_row, max_row, min_col, max_col], -1 for an empty mask
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return [-1, -1, -1, -1]
+    cols = np.flatnonzero(mask.any(axis=0))
+    return [rows[0], rows[-1], cols[0], cols[-1]]
+
+
+def build_mask_stats(dataset, output_path):
+    """
+    Record the bounding box and pixel area of every mask plane (same planes and order as the mask store)
+    of every frame, at the rendered resolution, so visibility can be decided without decoding masks.
+    """
+    keys = []
+    frame_offsets, frame_numbers, plane_offsets, plane_counts = [0], [], [], []
+    bboxes, areas = [], []
+    mask_hw = None
+
+    for idx in range(len(dataset.dataset)):
+        data_type = dataset.data_type_list[idx]
+        seq_id = dataset.seq_id_list[idx]
+        obj_num = dataset.seq_meta_data_map[data_type][seq_id].get_obj_num()
+
+        seq_mask_dir = os.path.join(dataset.mask_root, get_sequence_rel_dir(data_type), seq_id)
+        frame_dir_list = []
+        if os.path.isdir(seq_mask_dir):
+            frame_dir_list = sorted([i for i in os.listdir(seq_mask_dir) if i.isdigit()], key=int)
+
+        for frame_dir in frame_dir_list:
+            frame_numbers.append(int(frame_dir))
+            plane_offsets.append(len(bboxes))
+
+            frame_mask_dir = os.path.join(seq_mask_dir, frame_dir)
+            if not os.path.isfile(os.path.join(frame_mask_dir, "total.png")):
+                plane_counts.append(0)
+                continue
+
+            planes = get_frame_mask_planes(frame_mask_dir, obj_num)
+            if mask_hw is None:
+                mask_hw = planes.shape[1:]
+            assert planes.shape[1:] == mask_hw, f"mask size differs in {frame_mask_dir}"
+            for plane in planes:
+                bboxes.append(get_mask_bbox(plane))
+                areas.append(int(plane.sum()))
+            plane_counts.append(len(planes))
+
+        frame_offsets.append(len(frame_numbers))
+        keys.append(get_sequence_key(data_type, seq_id))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    np.savez(
+        output_path,
+        keys=np.array(keys),
+        mask_hw=np.array(mask_hw or (0, 0), dtype=np.int64),
+        frame_offsets=np.array(frame_offsets, dtype=np.int64),
+        frame_numbers=np.array(frame_numbers, dtype=np.int32),
+        plane_offsets=np.array(plane_offsets, dtype=np.int64),
+        plane_counts=np.array(plane_counts, dtype=np.int16),
+        bboxes=np.array(bboxes, dtype=np.int32).reshape(-1, 4),
+        areas=np.array(areas, dtype=np.int64),
+    )
+    return len(keys)
+
+
+class MaskStats(object):
+    """
+    Per (sequence, frame, plane) bounding boxes and areas written by `build_mask_stats`.
+    """
+
+    def __init__(self, stats_path):
+        with np.load(stats_path) as data:
+            keys = data["keys"]
+            self.mask_hw = tuple(int(i) for i in data["mask_hw"])
+            self.frame_offsets = data["frame_offsets"]
+            self.frame_numbers = data["frame_numbers"]
+            self.plane_offsets = data["plane_offsets"]
+            self.plane_counts = data["plane_counts"]
+            self.bboxes = data["bboxes"]
+            self.areas = data["areas"]
+        self.key_to_row = {str(key): row for row, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def get_row(self, data_type, seq_id):
+        return self.key_to_row.get(get_sequence_key(data_type, seq_id), -1)
+
+    def _get_frame_pos(self, row, frame_num):
+        start, end = self.frame_offsets[row], self.frame_offsets[row + 1]
+        pos = start + np.searchsorted(self.frame_numbers[start:end], frame_num)
+        if pos < end and self.frame_numbers[pos] == frame_num:
+            return pos
+        return -1
+
+    def get_frame_bboxes(self, row, frame_num):
+        """
+        int [planes,4] bounding boxes of one frame, None when the frame has no stats.
+        """
+        if row < 0:
+            return None
+        pos = self._get_frame_pos(row, frame_num)
+        if pos < 0 or self.plane_counts[pos] == 0:
+            return None
+        start = self.plane_offsets[pos]
+        return self.bboxes[start:start + self.plane_counts[pos]]
+
+    def get_frame_areas(self, row, frame_num):
+        if row < 0:
+            return None
+        pos = self._get_frame_pos(row, frame_num)
+        if pos < 0 or self.plane_counts[pos] == 0:
+            return None
+        start = self.plane_offsets[pos]
+        return self.areas[start:start + self.plane_counts[pos]]
+
+    def get_seen_frame_flags(self, row, appearance_percentage=0.0015):
+        """
+        (frame_numbers, seen) of one sequence, seen is True when at least one object passes is_normal_size.
+        Frames without stats are reported as seen, they are checked on the masks at runtime.
+        """
+        start, end = self.frame_offsets[row], self.frame_offsets[row + 1]
+        frame_numbers = self.frame_numbers[start:end]
+        if end == start:
+            return frame_numbers, np.ones(0, dtype=bool)
+
+        counts = self.plane_counts[start:end].astype(np.int64)
+        offsets = self.plane_offsets[start:end]
+        plane_start = offsets[0]
+        bboxes = self.bboxes[plane_start:offsets[-1] + counts[-1]]
+
+        bbox_areas = np.where(bboxes[:, 0] >= 0, (bboxes[:, 1] - bboxes[:, 0] + 1) * (bboxes[:, 3] - bboxes[:, 2] + 1), 0)
+        visible_cum = np.concatenate([[0], np.cumsum(bbox_areas > self.mask_hw[0] * self.mask_hw[1] * appearance_percentage)])
+
+        ## single object frames have only the total plane, multi object frames are judged on their object planes
+        rel_offsets = offsets - plane_start
+        obj_start = np.where(counts > 1, rel_offsets + 1, rel_offsets)
+        obj_end = rel_offsets + counts
+        seen = np.where(counts > 0, visible_cum[obj_end] - visible_cum[obj_start] > 0, True)
+        return frame_numbers, seen
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("mask_stats_path", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    seq_num = build_mask_stats(dataset, args.output)
+    print(f"recorded mask stats of {seq_num} sequences to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import os
+import argparse
+
+import numpy as np
+from PIL import Image
+
+from .seq_index import get_sequence_key, get_sequence_rel_dir
+
+
+MASK_STORE_META_NAME = "mask_store.npz"
+MASK_PLANE_NAME = "masks.bits"
+
+
+def load_mask_png(mask_path):
+    return np.array(Image.open(mask_path)) > 0
+
+
+def resize_mask(mask, mask_size):
+    ## mask_size is (h,w), nearest keeps the mask binary
+    if mask_size is None or tuple(mask.shape[:2]) == tuple(mask_size):
+        return mask
+    mask_img = Image.fromarray(mask.astype(np.uint8) * 255)
+    mask_img = mask_img.resize((mask_size[1], mask_size[0]), Image.NEAREST)
+    return np.array(mask_img) > 0
+
+
+def get_frame_mask_planes(frame_mask_dir, obj_num, mask_size=None):
+    """
+    Planes in the order get_seen_object_and_action_description_v3 uses them:
+    [total] for single object sequences, [total, 0 & total, 1 & total, ...] otherwise.
+    """
+    total_mask = load_mask_png(os.path.join(frame_mask_dir, "total.png"))
+    plane_list = [total_mask]
+    if obj_num > 1:
+        for i in range(obj_num):
+            obj_mask = load_mask_png(os.path.join(frame_mask_dir, f"{i}.png"))
+            plane_list.append(obj_mask & total_mask)
+    return np.stack([resize_mask(plane, mask_size) for plane in plane_list])
+
+
+def build_mask_store(dataset, output_root, mask_size=None):
+    """
+    Pack the per-frame masks of every sequence of `dataset` as np.packbits bit planes into one file.
+    Frames without masks on disk get no planes and are read from the png files at runtime.
+    """
+    os.makedirs(output_root, exist_ok=True)
+
+    keys = []
+    frame_offsets, frame_numbers, plane_offsets, plane_counts = [0], [], [], []
+    plane_h, plane_w = None, None
+    plane_num = 0
+
+    with open(os.path.join(output_root, MASK_PLANE_NAME), "wb") as f:
+        for idx in range(len(dataset.dataset)):
+            data_type = dataset.data_type_list[idx]
+            seq_id = dataset.seq_id_list[idx]
+            obj_num = dataset.seq_meta_data_map[data_type][seq_id].get_obj_num()
+
+            seq_mask_dir = os.path.join(dataset.mask_root, get_sequence_rel_dir(data_type), seq_id)
+            frame_dir_list = []
+            if os.path.isdir(seq_mask_dir):
+                frame_dir_list = sorted([i for i in os.listdir(seq_mask_dir) if i.isdigit()], key=int)
+
+            for frame_dir in frame_dir_list:
+                frame_numbers.append(int(frame_dir))
+                plane_offsets.append(plane_num)
+
+                frame_mask_dir = os.path.join(seq_mask_dir, frame_dir)
+                if not os.path.isfile(os.path.join(frame_mask_dir, "total.png")):
+                    plane_counts.append(0)
+                    continue
+
+                planes = get_frame_mask_planes(frame_mask_dir, obj_num, mask_size)
+                if plane_h is None:
+                    plane_h, plane_w = planes.shape[1:]
+                assert planes.shape[1:] == (plane_h, plane_w), f"mask size differs in {frame_mask_dir}, set mask_size"
+                for plane in planes:
+                    f.write(np.packbits(plane.reshape(-1)).tobytes())
+                plane_counts.append(len(planes))
+                plane_num += len(planes)
+
+            frame_offsets.append(len(frame_numbers))
+            keys.append(get_sequence_key(data_type, seq_id))
+
+    np.savez(
+        os.path.join(output_root, MASK_STORE_META_NAME),
+        keys=np.array(keys),
+        plane_h=np.int64(plane_h or 0),
+        plane_w=np.int64(plane_w or 0),
+        frame_offsets=np.array(frame_offsets, dtype=np.int64),
+        frame_numbers=np.array(frame_numbers, dtype=np.int32),
+        plane_offsets=np.array(plane_offsets, dtype=np.int64),
+        plane_counts=np.array(plane_counts, dtype=np.int16),
+    )
+    return len(keys)
+
+
+class MaskStore(object):
+    """
+    Read-only view of the bit planes written by `build_mask_store`. The plane file is memory-mapped
+    lazily in each process, only the planes of the requested frame are unpacked.
+    """
+
+    def __init__(self, store_root):
+        self.store_root = store_root
+        with np.load(os.path.join(store_root, MASK_STORE_META_NAME)) as data:
+            keys = data["keys"]
+            self.plane_h = int(data["plane_h"])
+            self.plane_w = int(data["plane_w"])
+            self.frame_offsets = data["frame_offsets"]
+            self.frame_numbers = data["frame_numbers"]
+            self.plane_offsets = data["plane_offsets"]
+            self.plane_counts = data["plane_counts"]
+        self.key_to_row = {str(key): row for row, key in enumerate(keys)}
+        self.plane_bytes = (self.plane_h * self.plane_w + 7) // 8
+
+        self._planes = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_planes"] = None
+        return state
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def _load(self):
+        if self._planes is None:
+            self._planes = np.memmap(os.path.join(self.store_root, MASK_PLANE_NAME), dtype=np.uint8, mode="r")
+        return self._planes
+
+    def get_row(self, data_type, seq_id):
+        return self.key_to_row.get(get_sequence_key(data_type, seq_id), -1)
+
+    def _get_frame_pos(self, row, frame_num):
+        start, end = self.frame_offsets[row], self.frame_offsets[row + 1]
+        pos = start + np.searchsorted(self.frame_numbers[start:end], frame_num)
+        if pos < end and self.frame_numbers[pos] == frame_num:
+            return pos
+        return -1
+
+    def get_frame_planes(self, row, frame_num):
+        """
+        bool [planes,h,w] for one frame, None when the frame was not packed.
+        """
+        if row < 0:
+            return None
+        pos = self._get_frame_pos(row, frame_num)
+        if pos < 0 or self.plane_counts[pos] == 0:
+            return None
+
+        plane_count = int(self.plane_counts[pos])
+        start = int(self.plane_offsets[pos]) * self.plane_bytes
+        packed = self._load()[start:start + plane_count * self.plane_bytes].reshape(plane_count, self.plane_bytes)
+        planes = np.unpackbits(packed, axis=1)[:, :self.plane_h * self.plane_w]
+        return planes.reshape(plane_count, self.plane_h, self.plane_w).astype(bool)
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--mask_size", type=int, nargs=2, default=None, help="h w, defaults to the training sample_size")
+    parser.add_argument("--full_resolution", action="store_true", help="keep the rendered mask size")
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("mask_store_root", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    mask_size = args.mask_size
+    if mask_size is None and not args.full_resolution:
+        sample_size = params.get("sample_size", [256, 384])
+        mask_size = [sample_size, sample_size] if isinstance(sample_size, int) else list(sample_size)
+
+    seq_num = build_mask_store(dataset, args.output, mask_size=mask_size)
+    print(f"packed masks of {seq_num} sequences under {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import sys
+
+from .utils import csv_param_to_dict, get_clip_time_list_from_meta
+
+
+class StringTable(object):
+    """
+    Interns strings as consecutive integers, shared by all records of a dataset.
+    """
+    __slots__ = ("strings", "index")
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.index = {}
+        for s in strings:
+            self.encode(s)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def encode(self, s):
+        idx = self.index.get(s)
+        if idx is None:
+            idx = len(self.strings)
+            self.index[s] = idx
+            self.strings.append(s)
+        return idx
+
+    def decode(self, idx):
+        return self.strings[idx]
+
+
+class CameraMeta(object):
+    __slots__ = ("scene_type", "hdri_id", "clip_time_list")
+
+    def __init__(self, scene_type, hdri_id, clip_time_list):
+        self.scene_type = scene_type
+        self.hdri_id = hdri_id
+        self.clip_time_list = clip_time_list
+
+
+class ObjectMeta(object):
+    __slots__ = ("obj_id", "time_range_list", "animation_name_list", "action_type_list")
+
+    def __init__(self, obj_id, time_range_list, animation_name_list, action_type_list):
+        self.obj_id = obj_id
+        self.time_range_list = time_range_list
+        self.animation_name_list = animation_name_list
+        self.action_type_list = action_type_list
+
+    def get_segment_idx(self, time_idx):
+        ## first animation segment whose (inclusive) time range holds time_idx, -1 if none
+        for seg_idx, (start, end) in enumerate(self.time_range_list):
+            if start <= time_idx and end >= time_idx:
+                return seg_idx
+        return -1
+
+
+class SequenceMeta(object):
+    """
+    Parsed form of one sequence of the traj csv files. Object ids are indices into `id_table`,
+    the other strings are interned.
+    """
+    __slots__ = ("camera", "objects", "id_table")
+
+    def __init__(self, camera, objects, id_table):
+        self.camera = camera
+        self.objects = objects
+        self.id_table = id_table
+
+    def get_obj_num(self):
+        return len(self.objects)
+
+    def get_obj_id(self, obj_idx):
+        return self.id_table.decode(self.objects[obj_idx].obj_id)
+
+
+def parse_camera_meta(cam_seq_data):
+    comment_dict = csv_param_to_dict(cam_seq_data["Comment"], str)
+    clip_time_list = tuple(tuple(time_range) for time_range in get_clip_time_list_from_meta(cam_seq_data))
+    return CameraMeta(
+        scene_type=sys.intern(comment_dict["scene_type"]),
+        hdri_id=sys.intern(comment_dict["hdri"]),
+        clip_time_list=clip_time_list,
+    )
+
+
+def parse_object_meta(obj_seq_data, id_table):
+    obj_comment_dict = csv_param_to_dict(obj_seq_data["Comment"], str)
+    return ObjectMeta(
+        obj_id=id_table.encode(obj_comment_dict["obj_id"]),
+        time_range_list=tuple(tuple(time_range) for time_range in eval(obj_seq_data["Time_Range_List"])),
+        animation_name_list=tuple(sys.intern(i) for i in eval(obj_comment_dict["animation_name_list"])),
+        action_type_list=tuple(sys.intern(i) for i in eval(obj_comment_dict["action_type_list"])),
+    )
+
+
+def parse_sequence_meta(seq_meta_data, id_table=None):
+    if id_table is None:
+        id_table = StringTable()
+    objs_seq_data = seq_meta_data["objects"]
+    objects = tuple(parse_object_meta(objs_seq_data[str(obj_idx)], id_table) for obj_idx in range(len(objs_seq_data)))
+    return SequenceMeta(parse_camera_meta(seq_meta_data["camera"]), objects, id_table)
+
+
+def to_sequence_meta(seq_meta_data):
+    ## validation passes the raw csv rows, training passes parsed records
+    if isinstance(seq_meta_data, SequenceMeta):
+        return seq_meta_data
+    return parse_sequence_meta(seq_meta_data)
+
+
+def build_sequence_meta_map(seq_meta_data_map, seq_list=None, id_table=None):
+    """
+    {data_type: {seq_id: raw csv rows}} -> {data_type: {seq_id: SequenceMeta}} sharing one id table.
+    `seq_list` of (data_type, seq_id) restricts parsing to the sequences a dataset uses.
+    """
+    if id_table is None:
+        id_table = StringTable()
+    if seq_list is None:
+        seq_list = [(data_type, seq_id) for data_type, seq_meta_data_dict in seq_meta_data_map.items() for seq_id in seq_meta_data_dict]
+
+    seq_meta_map = {data_type: {} for data_type in seq_meta_data_map}
+    for data_type, seq_id in seq_list:
+        seq_meta_map[data_type][seq_id] = parse_sequence_meta(seq_meta_data_map[data_type][seq_id], id_table)
+    return seq_meta_map
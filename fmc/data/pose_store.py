@@ -0,0 +1,146 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+from .seq_index import get_sequence_key
+
+
+POSE_STORE_META_NAME = "pose_store.npz"
+CAMERA_POSE_NAME = "camera.f32"
+OBJECT_POSE_NAME = "objects.f32"
+
+
+def build_pose_store(dataset, output_root):
+    """
+    Convert the camera and object tracks of every annotation file of `dataset` into two flat
+    float32 arrays, camera [frames, camera_fields] and objects [frames, object_fields], with
+    per-sequence / per-object frame offsets.
+    """
+    os.makedirs(output_root, exist_ok=True)
+
+    keys = []
+    cam_offsets, obj_seq_offsets, obj_offsets, obj_keys = [0], [0], [0], []
+    cam_fields, obj_fields = None, None
+
+    with open(os.path.join(output_root, CAMERA_POSE_NAME), "wb") as cam_f, open(os.path.join(output_root, OBJECT_POSE_NAME), "wb") as obj_f:
+        for idx in range(len(dataset.dataset)):
+            with open(dataset.dataset[idx]["annotation_file_path"], "r") as f:
+                annotation_data = json.load(f)
+
+            cam_np = np.array(annotation_data["camera"], dtype=np.float32)
+            if cam_fields is None:
+                cam_fields = cam_np.shape[1]
+            assert cam_np.ndim == 2 and cam_np.shape[1] == cam_fields
+            cam_f.write(cam_np.tobytes())
+            cam_offsets.append(cam_offsets[-1] + len(cam_np))
+
+            for obj_key, obj_track in annotation_data["objects"].items():
+                obj_np = np.array(obj_track, dtype=np.float32)
+                if obj_fields is None:
+                    obj_fields = obj_np.shape[1]
+                assert obj_np.ndim == 2 and obj_np.shape[1] == obj_fields
+                obj_f.write(obj_np.tobytes())
+                obj_offsets.append(obj_offsets[-1] + len(obj_np))
+                obj_keys.append(obj_key)
+            obj_seq_offsets.append(len(obj_keys))
+
+            keys.append(get_sequence_key(dataset.data_type_list[idx], dataset.seq_id_list[idx]))
+
+    np.savez(
+        os.path.join(output_root, POSE_STORE_META_NAME),
+        keys=np.array(keys),
+        cam_fields=np.int64(cam_fields or 0),
+        obj_fields=np.int64(obj_fields or 0),
+        cam_offsets=np.array(cam_offsets, dtype=np.int64),
+        obj_seq_offsets=np.array(obj_seq_offsets, dtype=np.int64),
+        obj_offsets=np.array(obj_offsets, dtype=np.int64),
+        obj_keys=np.array(obj_keys),
+    )
+    return len(keys)
+
+
+class PoseStore(object):
+    """
+    Read-only, memory-mapped view of the arrays written by `build_pose_store`. The pose arrays are
+    mapped lazily in each process, so dataloader workers share the page cache instead of holding a copy.
+    """
+
+    def __init__(self, store_root):
+        self.store_root = store_root
+        with np.load(os.path.join(store_root, POSE_STORE_META_NAME)) as data:
+            keys = data["keys"]
+            self.cam_fields = int(data["cam_fields"])
+            self.obj_fields = int(data["obj_fields"])
+            self.cam_offsets = data["cam_offsets"]
+            self.obj_seq_offsets = data["obj_seq_offsets"]
+            self.obj_offsets = data["obj_offsets"]
+            self.obj_keys = [str(i) for i in data["obj_keys"]]
+        self.key_to_row = {str(key): row for row, key in enumerate(keys)}
+
+        self._cam_poses = None
+        self._obj_poses = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_cam_poses"] = None
+        state["_obj_poses"] = None
+        return state
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def _load(self):
+        if self._cam_poses is None:
+            self._cam_poses = self._memmap(CAMERA_POSE_NAME, self.cam_fields)
+            self._obj_poses = self._memmap(OBJECT_POSE_NAME, self.obj_fields)
+
+    def _memmap(self, name, fields):
+        path = os.path.join(self.store_root, name)
+        if fields == 0 or os.path.getsize(path) == 0:
+            return np.zeros((0, fields), dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode="r").reshape(-1, fields)
+
+    def get_row(self, data_type, seq_id):
+        return self.key_to_row.get(get_sequence_key(data_type, seq_id), -1)
+
+    def get_camera_poses(self, row):
+        self._load()
+        return self._cam_poses[self.cam_offsets[row]:self.cam_offsets[row + 1]]
+
+    def get_object_poses(self, row):
+        self._load()
+        objs_dict = {}
+        for k in range(self.obj_seq_offsets[row], self.obj_seq_offsets[row + 1]):
+            objs_dict[self.obj_keys[k]] = self._obj_poses[self.obj_offsets[k]:self.obj_offsets[k + 1]]
+        return objs_dict
+
+    def get_annotation_data(self, row):
+        ## same layout as the annotation json, rows are float32 arrays instead of lists
+        return {
+            "camera": self.get_camera_poses(row),
+            "objects": self.get_object_poses(row),
+        }
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("pose_store_root", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    seq_num = build_pose_store(dataset, args.output)
+    print(f"stored poses of {seq_num} sequences under {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import os
+import argparse
+
+import numpy as np
+
+
+def get_sequence_key(data_type, seq_id):
+    return f"{data_type}/{seq_id}"
+
+
+def get_sequence_rel_dir(data_type):
+    ## single_dynamic -> Rendered_Traj_Results/dynamic, multi_static -> Rendered_Traj_Results_multi/static
+    single_type, static_type = data_type.split("_")
+    multi_suffix = "_multi" if single_type == "multi" else ""
+    return os.path.join(f"Rendered_Traj_Results{multi_suffix}", static_type)
+
+
+def list_frame_files(clip_path):
+    return sorted(
+        [
+            f
+            for f in os.listdir(clip_path)
+            if os.path.isfile(os.path.join(clip_path, f)) and f.endswith(".png") and "-" not in f
+        ]
+    )
+
+
+def _get_frame_name_template(frame_files):
+    ## frame files are named {prefix}_{frame}.png, find the prefix and zero padding that reproduce them
+    prefix_list, frame_num_list = [], []
+    for frame_file in frame_files:
+        prefix, frame_num = os.path.splitext(frame_file)[0].split("_")
+        prefix_list.append(prefix)
+        frame_num_list.append(frame_num)
+
+    if len(set(prefix_list)) != 1:
+        return None, -1, []
+
+    prefix = prefix_list[0]
+    frame_numbers = [int(i) for i in frame_num_list]
+    for pad in sorted(set(len(i) for i in frame_num_list)) + [0]:
+        if all(f"{n:0{pad}d}" == s for n, s in zip(frame_numbers, frame_num_list)):
+            return prefix, pad, frame_numbers
+
+    return prefix, -1, frame_numbers
+
+
+def build_sequence_index(dataset, output_path):
+    """
+    Walk every sequence of `dataset` once and record what `__getitem__` would otherwise
+    recompute from the file system: frame count and name template, clip time ranges and
+    per-frame mask availability.
+    """
+    keys, prefixes, pads = [], [], []
+    frame_offsets, frame_numbers, has_mask = [0], [], []
+    clip_offsets, clip_ranges = [0], []
+
+    for idx in range(len(dataset.dataset)):
+        data_type = dataset.data_type_list[idx]
+        seq_id = dataset.seq_id_list[idx]
+        clip_path = dataset.dataset[idx]["clip_path"]
+
+        frame_files = list_frame_files(clip_path)
+        prefix, pad, _frame_numbers = _get_frame_name_template(frame_files)
+
+        seq_mask_dir = os.path.join(dataset.mask_root, get_sequence_rel_dir(data_type), seq_id)
+        for frame_num in _frame_numbers:
+            has_mask.append(os.path.isfile(os.path.join(seq_mask_dir, str(frame_num), "total.png")))
+
+        clip_time_list = dataset.seq_meta_data_map[data_type][seq_id].camera.clip_time_list
+
+        keys.append(get_sequence_key(data_type, seq_id))
+        prefixes.append(prefix if prefix is not None else "")
+        pads.append(pad)
+        frame_numbers.extend(_frame_numbers)
+        frame_offsets.append(len(frame_numbers))
+        clip_ranges.extend(clip_time_list)
+        clip_offsets.append(len(clip_ranges))
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    np.savez(
+        output_path,
+        keys=np.array(keys),
+        prefixes=np.array(prefixes),
+        pads=np.array(pads, dtype=np.int8),
+        frame_offsets=np.array(frame_offsets, dtype=np.int64),
+        frame_numbers=np.array(frame_numbers, dtype=np.int32),
+        has_mask=np.array(has_mask, dtype=bool),
+        clip_offsets=np.array(clip_offsets, dtype=np.int64),
+        clip_ranges=np.array(clip_ranges, dtype=np.int32).reshape(-1, 2),
+    )
+    return len(keys)
+
+
+class SequenceIndex(object):
+    """
+    Read-only view of the file written by `build_sequence_index`. Rows are looked up by
+    (data_type, seq_id), so one index can serve datasets built with different sequence numbers.
+    """
+
+    def __init__(self, index_path):
+        with np.load(index_path) as data:
+            keys = data["keys"]
+            self.prefixes = data["prefixes"]
+            self.pads = data["pads"]
+            self.frame_offsets = data["frame_offsets"]
+            self.frame_numbers = data["frame_numbers"]
+            self.has_mask = data["has_mask"]
+            self.clip_offsets = data["clip_offsets"]
+            self.clip_ranges = data["clip_ranges"]
+        self.key_to_row = {str(key): row for row, key in enumerate(keys)}
+
+    def __len__(self):
+        return len(self.key_to_row)
+
+    def get_row(self, data_type, seq_id):
+        return self.key_to_row.get(get_sequence_key(data_type, seq_id), -1)
+
+    def get_frame_numbers(self, row):
+        return self.frame_numbers[self.frame_offsets[row]:self.frame_offsets[row + 1]]
+
+    def get_frame_num(self, row):
+        return int(self.frame_offsets[row + 1] - self.frame_offsets[row])
+
+    def get_frame_path_list(self, row, clip_path):
+        ## same order as the sorted directory listing the index was built from
+        pad = int(self.pads[row])
+        if pad < 0:
+            return [os.path.join(clip_path, f) for f in list_frame_files(clip_path)]
+        prefix = self.prefixes[row]
+        return [os.path.join(clip_path, f"{prefix}_{frame_num:0{pad}d}.png") for frame_num in self.get_frame_numbers(row)]
+
+    def get_clip_time_list(self, row):
+        clip_ranges = self.clip_ranges[self.clip_offsets[row]:self.clip_offsets[row + 1]]
+        return [[int(start), int(end)] for start, end in clip_ranges]
+
+    def is_mask_complete(self, row):
+        return bool(np.all(self.has_mask[self.frame_offsets[row]:self.frame_offsets[row + 1]]))
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("seq_index_path", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    seq_num = build_sequence_index(dataset, args.output)
+    print(f"indexed {seq_num} sequences to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import io
+import os
+import json
+import struct
+import argparse
+from collections import OrderedDict
+
+from .seq_index import get_sequence_rel_dir, list_frame_files
+
+
+SHARD_MAGIC = b"SFMCSHD1"
+SHARD_INDEX_NAME = "shard_index.json"
+
+## member names are "{tag}/{path relative to the root of that tag}"
+SHARD_TAGS = ("data", "label", "mask")
+
+
+def _get_member_seq_key(tag, rel_path):
+    ## Rendered_Traj_Results{multi_suffix}/{static_type}/{seq_id}[/...] or .../{seq_id}.json for labels
+    parts = rel_path.replace(os.sep, "/").split("/")
+    if tag == "label":
+        if len(parts) != 3:
+            return None
+        return "/".join(parts[:2] + [os.path.splitext(parts[2])[0]])
+    if len(parts) < 3:
+        return None
+    return "/".join(parts[:3])
+
+
+def _iter_sequence_files(data_root, lable_root, mask_root, data_type, seq_id):
+    rel_dir = get_sequence_rel_dir(data_type)
+
+    clip_path = os.path.join(data_root, rel_dir, seq_id)
+    for frame_file in list_frame_files(clip_path):
+        yield "data", os.path.join(rel_dir, seq_id, frame_file), os.path.join(clip_path, frame_file)
+
+    yield "label", os.path.join(rel_dir, f"{seq_id}.json"), os.path.join(lable_root, rel_dir, f"{seq_id}.json")
+
+    seq_mask_dir = os.path.join(mask_root, rel_dir, seq_id)
+    if not os.path.isdir(seq_mask_dir):
+        return
+    for frame_dir in sorted(os.listdir(seq_mask_dir)):
+        frame_mask_dir = os.path.join(seq_mask_dir, frame_dir)
+        if not os.path.isdir(frame_mask_dir):
+            continue
+        for mask_file in sorted(os.listdir(frame_mask_dir)):
+            yield "mask", os.path.join(rel_dir, seq_id, frame_dir, mask_file), os.path.join(frame_mask_dir, mask_file)
+
+
+def write_shard(shard_path, member_list):
+    """
+    member_list: [(member_name, file_path)]. The payload is written in the given order so that
+    reading a whole sequence is a single sequential scan.
+    """
+    table = OrderedDict()
+    offset = 0
+    for member_name, file_path in member_list:
+        length = os.path.getsize(file_path)
+        table[member_name] = [offset, length]
+        offset += length
+
+    table_bytes = json.dumps(table).encode("utf-8")
+    with open(shard_path, "wb") as f:
+        f.write(SHARD_MAGIC)
+        f.write(struct.pack("<Q", len(table_bytes)))
+        f.write(table_bytes)
+        for _, file_path in member_list:
+            with open(file_path, "rb") as src:
+                f.write(src.read())
+
+
+def read_shard_table(f):
+    magic = f.read(len(SHARD_MAGIC))
+    if magic != SHARD_MAGIC:
+        raise ValueError(f"not a SynFMC shard file: {getattr(f, 'name', f)}")
+    table_len, = struct.unpack("<Q", f.read(8))
+    table = json.loads(f.read(table_len).decode("utf-8"))
+    payload_start = len(SHARD_MAGIC) + 8 + table_len
+    return table, payload_start
+
+
+def pack_shards(dataset, output_root, group_size=1):
+    """
+    Pack frames, masks and the annotation file of every sequence of `dataset` into shard files
+    under `output_root`, `group_size` sequences per shard, and write the sequence -> shard index.
+    """
+    os.makedirs(output_root, exist_ok=True)
+
+    shard_name_list = []
+    seq_shard_map = {}
+    seq_list = list(zip(dataset.data_type_list, dataset.seq_id_list))
+    for group_start in range(0, len(seq_list), group_size):
+        shard_name = f"shard_{len(shard_name_list):06d}.sfmc"
+        member_list = []
+        for data_type, seq_id in seq_list[group_start:group_start + group_size]:
+            for tag, rel_path, file_path in _iter_sequence_files(dataset.data_root, dataset.lable_root, dataset.mask_root, data_type, seq_id):
+                member_list.append((f"{tag}/{rel_path.replace(os.sep, '/')}", file_path))
+            seq_shard_map[os.path.join(get_sequence_rel_dir(data_type), seq_id).replace(os.sep, "/")] = len(shard_name_list)
+
+        write_shard(os.path.join(output_root, shard_name), member_list)
+        shard_name_list.append(shard_name)
+
+    with open(os.path.join(output_root, SHARD_INDEX_NAME), "w") as f:
+        json.dump({"shards": shard_name_list, "sequences": seq_shard_map}, f)
+
+    return len(shard_name_list)
+
+
+class PackedShardReader(object):
+    """
+    Serves reads of files under data_root / lable_root / mask_root from packed shards. Paths that are
+    not packed are read from the file system, so callers can use it for every read.
+    Open shard files are cached per process (dataloader workers never share a file offset).
+    """
+
+    def __init__(self, shard_root, data_root, lable_root, mask_root, max_open_shards=4):
+        self.shard_root = shard_root
+        self.roots = {
+            "data": os.path.normpath(data_root),
+            "label": os.path.normpath(lable_root),
+            "mask": os.path.normpath(mask_root),
+        }
+        self.max_open_shards = max_open_shards
+
+        with open(os.path.join(shard_root, SHARD_INDEX_NAME), "r") as f:
+            shard_index = json.load(f)
+        self.shard_name_list = shard_index["shards"]
+        self.seq_shard_map = shard_index["sequences"]
+
+        self._pid = None
+        self._open_shards = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pid"] = None
+        state["_open_shards"] = OrderedDict()
+        return state
+
+    def _locate(self, path):
+        path = os.path.normpath(path)
+        for tag in SHARD_TAGS:
+            root = self.roots[tag]
+            if path.startswith(root + os.sep):
+                rel_path = os.path.relpath(path, root).replace(os.sep, "/")
+                seq_key = _get_member_seq_key(tag, rel_path)
+                if seq_key is not None and seq_key in self.seq_shard_map:
+                    return self.seq_shard_map[seq_key], f"{tag}/{rel_path}"
+        return None, None
+
+    def _get_shard(self, shard_idx):
+        if self._pid != os.getpid():
+            self.close()
+            self._pid = os.getpid()
+
+        if shard_idx in self._open_shards:
+            self._open_shards.move_to_end(shard_idx)
+            return self._open_shards[shard_idx]
+
+        f = open(os.path.join(self.shard_root, self.shard_name_list[shard_idx]), "rb")
+        table, payload_start = read_shard_table(f)
+        self._open_shards[shard_idx] = (f, table, payload_start)
+        while len(self._open_shards) > self.max_open_shards:
+            _, (old_f, _, _) = self._open_shards.popitem(last=False)
+            old_f.close()
+        return self._open_shards[shard_idx]
+
+    def close(self):
+        for f, _, _ in self._open_shards.values():
+            f.close()
+        self._open_shards = OrderedDict()
+
+    def read_bytes(self, path):
+        shard_idx, member_name = self._locate(path)
+        if shard_idx is not None:
+            f, table, payload_start = self._get_shard(shard_idx)
+            if member_name in table:
+                offset, length = table[member_name]
+                f.seek(payload_start + offset)
+                return f.read(length)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def open(self, path):
+        return io.BytesIO(self.read_bytes(path))
+
+    def list_frame_files(self, clip_path):
+        ## locate a placeholder file inside the clip folder to find the shard and member prefix
+        shard_idx, member_name = self._locate(os.path.join(clip_path, "_"))
+        if shard_idx is None:
+            return [os.path.join(clip_path, f) for f in list_frame_files(clip_path)]
+        _, table, _ = self._get_shard(shard_idx)
+        member_dir = member_name[:-1]
+        frame_files = [
+            name[len(member_dir):] for name in table
+            if name.startswith(member_dir) and "/" not in name[len(member_dir):]
+        ]
+        frame_files = sorted(f for f in frame_files if f.endswith(".png") and "-" not in f)
+        return [os.path.join(clip_path, f) for f in frame_files]
+
+
+def resolve_file(path, reader=None):
+    ## PIL and imageio accept both a path and a file object
+    if reader is None:
+        return path
+    return reader.open(path)
+
+
+def load_json_file(path, reader=None):
+    if reader is None:
+        with open(path, "r") as f:
+            return json.load(f)
+    return json.loads(reader.read_bytes(path))
+
+
+def main():
+    from omegaconf import OmegaConf
+    from fmc.utils.util import get_obj_from_str
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="configs/obj.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--group_size", type=int, default=1)
+    args = parser.parse_args()
+
+    config = OmegaConf.load(args.config)
+    params = OmegaConf.to_container(config.train_data.params)
+    params.pop("shard_root", None)
+    dataset = get_obj_from_str(config.train_data.target)(**params)
+
+    shard_num = pack_shards(dataset, args.output, group_size=args.group_size)
+    print(f"packed {len(dataset.seq_id_list)} sequences into {shard_num} shards under {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import json
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from .meta import CameraMeta, ObjectMeta, SequenceMeta
+
+
+class StringArray(Sequence):
+    """
+    Strings packed into one utf-8 byte buffer plus offsets. Both are plain numpy arrays, so forked
+    dataloader workers keep sharing their pages; a str object only exists while it is being used.
+    """
+
+    def __init__(self, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.data = np.frombuffer(b"".join(encoded), dtype=np.uint8).copy()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def decode(self, idx):
+        ## drop-in for StringTable.decode
+        return self[idx]
+
+    def get_nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes
+
+
+class PackedMap(Mapping):
+    """
+    Read-only str -> value mapping. Keys live in a sorted fixed-width bytes array (binary search),
+    values are serialised with `encode` into a StringArray and rebuilt with `decode` on access.
+    """
+
+    def __init__(self, mapping, encode=json.dumps, decode=json.loads):
+        key_list = sorted(mapping.keys())
+        self.keys_np = np.array([k.encode("utf-8") for k in key_list], dtype=bytes) if key_list else np.zeros(0, dtype="S1")
+        self.values = StringArray([encode(mapping[k]) for k in key_list])
+        self.decode_value = decode
+
+    def _find(self, key):
+        if not isinstance(key, str):
+            return -1
+        key_bytes = key.encode("utf-8")
+        pos = int(np.searchsorted(self.keys_np, key_bytes))
+        if pos < len(self.keys_np) and self.keys_np[pos] == key_bytes:
+            return pos
+        return -1
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self.decode_value(self.values[pos])
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        for key in self.keys_np:
+            yield key.decode("utf-8")
+
+    def __len__(self):
+        return len(self.keys_np)
+
+    def get_nbytes(self):
+        return self.keys_np.nbytes + self.values.get_nbytes()
+
+
+class PackedRecordList(Sequence):
+    """
+    List of {column: str} dicts (e.g. `dataset.dataset`) stored column-wise as StringArrays.
+    """
+
+    def __init__(self, record_list):
+        self.column_names = list(record_list[0].keys()) if len(record_list) > 0 else []
+        self.columns = {name: StringArray([record[name] for record in record_list]) for name in self.column_names}
+        self.length = len(record_list)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        return {name: self.columns[name][idx] for name in self.column_names}
+
+    def get_nbytes(self):
+        return sum(column.get_nbytes() for column in self.columns.values())
+
+
+def encode_sequence_meta(seq_meta):
+    camera = seq_meta.camera
+    return json.dumps([
+        camera.scene_type,
+        camera.hdri_id,
+        camera.clip_time_list,
+        [[obj.obj_id, obj.time_range_list, obj.animation_name_list, obj.action_type_list] for obj in seq_meta.objects],
+    ])
+
+
+def get_sequence_meta_decoder(id_table):
+    def decode_sequence_meta(record):
+        scene_type, hdri_id, clip_time_list, objects = json.loads(record)
+        camera = CameraMeta(scene_type, hdri_id, tuple(tuple(i) for i in clip_time_list))
+        objects = tuple(
+            ObjectMeta(obj_id, tuple(tuple(i) for i in time_range_list), tuple(animation_name_list), tuple(action_type_list))
+            for obj_id, time_range_list, animation_name_list, action_type_list in objects
+        )
+        return SequenceMeta(camera, objects, id_table)
+    return decode_sequence_meta
+
+
+def pack_sequence_meta_map(seq_meta_map):
+    """
+    {data_type: {seq_id: SequenceMeta}} -> {data_type: PackedMap}, the object id table becomes a StringArray.
+    """
+    id_table = None
+    for seq_meta_dict in seq_meta_map.values():
+        for seq_meta in seq_meta_dict.values():
+            id_table = seq_meta.id_table
+            break
+        if id_table is not None:
+            break
+    packed_id_table = StringArray(id_table.strings if id_table is not None else [])
+
+    decode = get_sequence_meta_decoder(packed_id_table)
+    return {
+        data_type: PackedMap(seq_meta_dict, encode=encode_sequence_meta, decode=decode)
+        for data_type, seq_meta_dict in seq_meta_map.items()
+    }
+
+
+def pack_dataset_metadata(dataset):
+    """
+    Replace the per-sequence python structures of a dataset by their packed forms, returns the packed size in bytes.
+    """
+    dataset.dataset = PackedRecordList(dataset.dataset)
+    dataset.data_type_list = StringArray(dataset.data_type_list)
+    dataset.seq_id_list = StringArray(dataset.seq_id_list)
+    dataset.hdri_json_data = PackedMap(dataset.hdri_json_data)
+    dataset.asset_json_data = PackedMap(dataset.asset_json_data)
+    dataset.seq_meta_data_map = pack_sequence_meta_map(dataset.seq_meta_data_map)
+
+    nbytes = dataset.dataset.get_nbytes() + dataset.data_type_list.get_nbytes() + dataset.seq_id_list.get_nbytes()
+    nbytes += dataset.hdri_json_data.get_nbytes() + dataset.asset_json_data.get_nbytes()
+    nbytes += sum(seq_meta_map.get_nbytes() for seq_meta_map in dataset.seq_meta_data_map.values())
+    return nbytes
@@ -0,0 +1,62 @@
+import cv2
+import numpy as np
+import torch
+
+
+def get_mask_circle(mask):
+    """
+    (center x, center y, radius) in pixels of the minimum enclosing circle of a [H,W] mask, None when empty.
+    Only the outer contour points are passed to cv2, the enclosing circle of the full pixel set is the same.
+    """
+    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if len(contours) == 0:
+        return None
+    center, radius = cv2.minEnclosingCircle(np.concatenate(contours).astype(np.float32))
+    return (center[0], center[1], radius)
+
+
+def get_mask_circles(mask_list):
+    """
+    float32 [K,4] circles of the [H,W,1] object masks of one frame, as (center x, center y, radius x, radius y)
+    relative to the mask width / height, so they can be rendered at any size. Empty masks get radius 0.
+    """
+    circles = []
+    for mask in mask_list:
+        h, w = mask.shape[:2]
+        circle = get_mask_circle(mask[..., 0])
+        if circle is None:
+            circles.append((0.0, 0.0, 0.0, 0.0))
+        else:
+            cx, cy, radius = circle
+            circles.append(((cx + 0.5) / w, (cy + 0.5) / h, radius / w, radius / h))
+    return torch.tensor(circles, dtype=torch.float32).reshape(-1, 4)
+
+
+def render_gaussian_circle_masks(circles, out_hw, dtype=torch.float32):
+    """
+    circles [...,4] from `get_mask_circles` -> [...,out_h,out_w] masks: a Gaussian with sigma = radius / 2
+    around the center, cut at the circle, zero for radius 0. Same masks the per-object cv2 loop drew at
+    render resolution before mask_transforms resized them, without the intermediate full-size maps.
+    Works on any device, e.g. in the dataloader worker or on the training device after collate.
+    """
+    device = circles.device
+    circles = circles.to(torch.float32)
+
+    ys = ((torch.arange(out_hw[0], device=device, dtype=torch.float32) + 0.5) / out_hw[0])[:, None]
+    xs = (torch.arange(out_hw[1], device=device, dtype=torch.float32) + 0.5) / out_hw[1]
+
+    cx, cy = circles[..., 0, None, None], circles[..., 1, None, None]
+    rx, ry = circles[..., 2, None, None], circles[..., 3, None, None]
+    ## squared distance in units of the radius, sigma = radius / 2
+    dist_sq = ((xs - cx) / rx.clamp(min=1e-6)) ** 2 + ((ys - cy) / ry.clamp(min=1e-6)) ** 2
+    gaussian = torch.exp(-2 * dist_sq)
+    inside = (dist_sq <= 1) & (rx > 0)
+    return (gaussian * inside).to(dtype)
+
+
+def render_circle_mask_list_list(circle_list_list, out_hw, device=None, dtype=torch.float32):
+    ## batch['circle_list_list'] (per sample, per frame [K,4]) -> [K,1,h,w] masks like batch['circle_mask_list_list']
+    return [
+        [render_gaussian_circle_masks(circles.to(device), out_hw, dtype)[:, None] for circles in circle_list]
+        for circle_list in circle_list_list
+    ]
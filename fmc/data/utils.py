@@ -107,7 +107,20 @@ def is_normal_size(
             return True
         else:
             return False
-            
+
+
+def is_normal_size_from_bbox(
+        bbox,mask_hw,percentage=0.015
+    ):  ## same test as is_normal_size, bbox is [min_row, max_row, min_col, max_col] with -1 for an empty mask
+
+        min_row, max_row, min_col, max_col = bbox
+        if min_row < 0:
+            cur_area = 0
+        else:
+            cur_area = (max_row - min_row + 1) * (max_col - min_col + 1)
+
+        return cur_area > mask_hw[0] * mask_hw[1] * percentage
+
 
 
 def asseble_mask_list(mask_list):
@@ -198,3 +211,185 @@ def create_relative_matrix_of_two_torch_matrix(RT1,RT2,scale_T = 1):
     RT2 = RT2.reshape(RT2.shape[0], -1)
     # RT2=RT2.reshape(-1)
     return RT2
+
+
+
+## batched versions of the scalar helpers above, they take numpy arrays or torch tensors and keep the type
+
+def _get_array_lib(x):
+    return torch if isinstance(x, torch.Tensor) else np
+
+
+def norm_batch(v):
+    ## [...,3] -> [...]
+    lib=_get_array_lib(v)
+    return lib.sqrt((v**2).sum(-1))
+
+
+def dot_batch(v1,v2):
+    return (v1*v2).sum(-1)
+
+
+def cross_batch(v1,v2):
+    lib=_get_array_lib(v1)
+    return lib.stack([
+        v1[...,1] * v2[...,2] - v1[...,2] * v2[...,1],  # x
+        v1[...,2] * v2[...,0] - v1[...,0] * v2[...,2],  # y
+        v1[...,0] * v2[...,1] - v1[...,1] * v2[...,0],  # z
+    ],-1)
+
+
+def _stack_matrix(lib,rows):
+    return lib.stack([lib.stack(row,-1) for row in rows],-2)
+
+
+def transform_euler_to_matrix_batch(roll_pitch_yaw):
+    """
+    [...,3] (roll, pitch, yaw) in degrees -> [...,3,3], same as transform_euler_to_matrix per row.
+    """
+    lib=_get_array_lib(roll_pitch_yaw)
+    radian=roll_pitch_yaw*(math.pi)/180
+    x,y,z=radian[...,0],radian[...,1],radian[...,2]
+    cx,sx,cy,sy,cz,sz=lib.cos(x),lib.sin(x),lib.cos(y),lib.sin(y),lib.cos(z),lib.sin(z)
+
+    return _stack_matrix(lib,[
+        [cy*cz,-cy*sz,-sy],
+        [sx*sy*cz+cx*sz,-sx*sy*sz+cx*cz,sx*cy],
+        [cx*sy*cz-sx*sz,-cx*sy*cz-sx*cz,cx*cy],
+    ])
+
+
+def transform_euler_to_matrix_v2_batch(roll_pitch_yaw):
+    """
+    [...,3] (roll, pitch, yaw) in degrees -> [...,3,3], same as transform_euler_to_matrix_v2 per row.
+    """
+    lib=_get_array_lib(roll_pitch_yaw)
+    radian=roll_pitch_yaw*(math.pi)/180
+    x,y,z=radian[...,0],radian[...,1],radian[...,2]
+    cx,sx,cy,sy,cz,sz=lib.cos(x),lib.sin(x),lib.cos(y),lib.sin(y),lib.cos(z),lib.sin(z)
+
+    return _stack_matrix(lib,[
+        [cy*cz,cz*sx*sy-cx*sz,-sx*sz-cx*cz*sy],
+        [cy*sz,cx*cz+sx*sy*sz,-cx*sz*sy+sx*cz],
+        [sy,-cy*sx,cx*cy],
+    ])
+
+
+def create_pose_matrix_batch(xyz,roll_pitch_yaw,euler_to_matrix=transform_euler_to_matrix_v2_batch):
+    ## [...,3] translations and euler angles -> [...,4,4] poses
+    lib=_get_array_lib(xyz)
+    if lib is torch:
+        pose=torch.zeros((*xyz.shape[:-1],4,4),dtype=xyz.dtype,device=xyz.device)
+    else:
+        pose=np.zeros((*xyz.shape[:-1],4,4))
+    pose[...,:3,:3]=euler_to_matrix(roll_pitch_yaw)
+    pose[...,:3,3]=xyz
+    pose[...,3,3]=1
+    return pose
+
+
+def create_relative_matrix_of_cam_batch(cam_info,scale_T = 1):
+    """
+    [N,4,4] (or [N,3,4]) camera poses -> [N,12] poses relative to the first one, one vectorized
+    create_relative_matrix_of_cam_list. Torch in, torch out (same dtype); numpy in, numpy out.
+    """
+    lib=_get_array_lib(cam_info)
+    R,T=cam_info[:,:3,:3],cam_info[:,:3,3]
+    R_inv=R.transpose(-1,-2) if lib is torch else R.transpose(0,2,1)
+
+    new_R=R_inv@R[0]
+    new_T=(R_inv@(T[0]-T)[...,None])[...,0]/scale_T
+    new_RT=(torch.cat if lib is torch else np.concatenate)([new_R,new_T[...,None]],-1)
+    ## the first camera is the identity by definition
+    new_RT[0]=0
+    new_RT[0,0,0]=new_RT[0,1,1]=new_RT[0,2,2]=1
+    return new_RT.reshape(new_RT.shape[0],-1)
+
+
+def get_clip_time_list_from_meta(cam_seq_data):
+    ## merge consecutive camera segments that track the same target object
+    clip_time_list=[]
+    
+    comment_dict=csv_param_to_dict(cam_seq_data["Comment"], str)
+    tgt_obj_id_list=eval(comment_dict["tgt_obj_id_list"])
+    
+    cam_time_range_list=eval(cam_seq_data["Time_Range_List"])
+    
+    prev_tgt_id=None
+    for time_range,tgt_id in zip(cam_time_range_list,tgt_obj_id_list):
+        if prev_tgt_id is None or tgt_id !=prev_tgt_id:
+            clip_time_list.append(time_range)
+        else:
+            assert clip_time_list[-1][-1]==time_range[0]
+            clip_time_list[-1][-1]=time_range[-1]
+            
+        prev_tgt_id=tgt_id
+    
+    return clip_time_list
+
+
+def get_sample_interval(ori_fps,tgt_fps,video_length,sample_num):
+    interval = round(ori_fps / tgt_fps)
+    if (video_length - (sample_num - 1) * interval - 1<0):
+        interval = math.floor(ori_fps / tgt_fps)
+    return interval
+
+
+def get_tgt_fps_min(ori_fps,video_length,sample_num):
+    ## lowest fps whose interval still fits sample_num frames into video_length, None when the clip is too short
+    if video_length<sample_num:
+        return None
+    max_interval = math.floor((video_length- 1)/(sample_num - 1))
+    assert max_interval>0
+    return math.ceil(ori_fps/max_interval)
+
+
+
+def pad_object_list_list(obj_list_list,num_objects=None):
+    """
+    Per sample, per frame [K,...] tensors or arrays -> zero padded [B,F,num_objects,...] tensor, None when all are empty.
+    num_objects defaults to the largest K, objects past it are dropped.
+    """
+    item_list=[obj for obj_list in obj_list_list for obj in obj_list if len(obj)>0]
+    if not item_list:
+        return None
+    first=torch.as_tensor(item_list[0])
+    if num_objects is None:
+        num_objects=max(len(obj) for obj in item_list)
+
+    B=len(obj_list_list)
+    F=max(len(obj_list) for obj_list in obj_list_list)
+    padded=torch.zeros([B,F,num_objects,*first.shape[1:]],dtype=first.dtype,device=first.device)
+    for b_idx,obj_list in enumerate(obj_list_list):
+        for f_idx,obj in enumerate(obj_list):
+            k=min(len(obj),num_objects)
+            padded[b_idx,f_idx,:k]=torch.as_tensor(obj[:k])
+    return padded
+
+
+def get_object_counts(obj_list_list,num_objects):
+    ## int64 [B,F] object count per frame (at most num_objects) and bool [B,F,num_objects] validity
+    obj_counts=torch.tensor([[min(len(obj),num_objects) for obj in obj_list] for obj_list in obj_list_list],dtype=torch.int64)
+    obj_valid=torch.arange(num_objects)<obj_counts[...,None]
+    return obj_counts,obj_valid
+
+
+def pad_object_conditions(obj_info_list_list,obj_mask_list_list,max_objects=None):
+    """
+    Per sample, per frame [K,12] poses and [K,1,H,W] masks -> padded
+    obj_infos float32 [B,F,O,12], obj_masks [B,F,O,H,W] (None without masks), obj_counts int64 [B,F], obj_valid bool [B,F,O].
+    O is the largest K of the batch, or max_objects; objects past max_objects are dropped.
+    """
+    if max_objects is None:
+        max_objects=max([len(obj_info) for obj_info_list in obj_info_list_list for obj_info in obj_info_list]+[0])
+    obj_counts,obj_valid=get_object_counts(obj_info_list_list,max_objects)
+
+    obj_infos=pad_object_list_list(obj_info_list_list,max_objects)
+    if obj_infos is None:
+        obj_infos=torch.zeros([*obj_valid.shape,12])
+    obj_infos=obj_infos.to(torch.float32)
+
+    obj_masks=pad_object_list_list(obj_mask_list_list,max_objects)
+    if obj_masks is not None:
+        obj_masks=obj_masks[:,:,:,0]
+    return obj_infos,obj_masks,obj_counts,obj_valid
@@ -11,12 +11,124 @@ from einops import rearrange
 
 logger = logging.getLogger(__name__)
 
+## torch.nn.functional.scaled_dot_product_attention is available from torch 2.0. environment.yaml still pins
+## torch 1.13.1, so there the chunked bmm path below is what runs until the pin moves
+SDPA_AVAILABLE = hasattr(torch.nn.functional, "scaled_dot_product_attention")
+## attention scores per bmm on the fallback path, longer queries are split into chunks of rows
+ATTENTION_CHUNK_ELEMENTS = 2 ** 27
+
+
+def compute_attention(attn, query, key, value, attention_mask=None, use_sdpa=True):
+    """
+    Multi-head attention of projected query [b, n, heads * d] and key / value [b, m, heads * d] -> [b, n, heads * d].
+    With use_sdpa the attention probabilities are never materialised; otherwise (or on torch < 2.0) this is
+    the original get_attention_scores + bmm path, run over chunks of query rows so at most
+    ATTENTION_CHUNK_ELEMENTS scores exist at a time.
+    Key / value may have a batch of b while query has b * f (f frames per text embedding, (b f) order).
+    """
+    if key.shape[0] != query.shape[0]:
+        ## frames share their key / value, attend with the frames folded into the query length
+        frame_num, query_length = query.shape[0] // key.shape[0], query.shape[1]
+        query = query.reshape(key.shape[0], frame_num * query_length, -1)
+        hidden_states = compute_attention(attn, query, key, value, attention_mask, use_sdpa)
+        return hidden_states.reshape(key.shape[0] * frame_num, query_length, -1)
+
+    if not (use_sdpa and SDPA_AVAILABLE):
+        query = attn.head_to_batch_dim(query)
+        key = attn.head_to_batch_dim(key)
+        value = attn.head_to_batch_dim(value)
+
+        chunk_size = max(ATTENTION_CHUNK_ELEMENTS // (query.shape[0] * key.shape[1]), 1)
+        hidden_states = []
+        for start in range(0, query.shape[1], chunk_size):
+            ## the additive mask is [b * heads, 1 or n, m]
+            chunk_mask = attention_mask
+            if attention_mask is not None and attention_mask.shape[1] > 1:
+                chunk_mask = attention_mask[:, start: start + chunk_size]
+            attention_probs = attn.get_attention_scores(query[:, start: start + chunk_size], key, chunk_mask)
+            hidden_states.append(torch.bmm(attention_probs, value))
+        hidden_states = hidden_states[0] if len(hidden_states) == 1 else torch.cat(hidden_states, dim=1)
+        return attn.batch_to_head_dim(hidden_states)
+
+    batch_size, heads = query.shape[0], attn.heads
+    head_dim = query.shape[-1] // heads
+    query = query.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+    key = key.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+    value = value.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+    ## sdpa scales by head_dim ** -0.5, fold a different attn.scale into the query
+    if attn.scale != head_dim ** -0.5:
+        query = query * (attn.scale * head_dim ** 0.5)
+    if attention_mask is not None:
+        ## prepare_attention_mask gives an additive [b * heads, 1 or n, m] mask
+        attention_mask = attention_mask.view(batch_size, heads, -1, attention_mask.shape[-1])
+
+    hidden_states = torch.nn.functional.scaled_dot_product_attention(query, key, value, attn_mask=attention_mask, dropout_p=0.0)
+    return hidden_states.transpose(1, 2).reshape(batch_size, -1, heads * head_dim)
+
+
+def get_lora_delta_weight(lora_layer):
+    ## dense [out, in] weight of a LoRALinearLayer, including the network_alpha / rank factor
+    delta = lora_layer.up.weight @ lora_layer.down.weight
+    if lora_layer.network_alpha is not None:
+        delta = delta * (lora_layer.network_alpha / lora_layer.rank)
+    return delta
+
+
+@torch.no_grad()
+def get_fused_qkv_params(attn, lora_layers=None, lora_scale=1.0):
+    """
+    Concatenated [3 * c, c] weight and bias (None without biases) of attn.to_q / to_k / to_v,
+    with the deltas of the given (q, k, v) LoRA layers merged in.
+    """
+    linears = [attn.to_q, attn.to_k, attn.to_v]
+    weights = [linear.weight for linear in linears]
+    if lora_layers is not None:
+        weights = [weight + lora_scale * get_lora_delta_weight(lora_layer).to(weight.dtype) for weight, lora_layer in zip(weights, lora_layers)]
+    weight = torch.cat(weights, dim=0)
+
+    bias = None
+    if any(linear.bias is not None for linear in linears):
+        bias = torch.cat([linear.bias if linear.bias is not None else weight.new_zeros(linear.out_features) for linear in linears])
+    return weight, bias
+
+
+def fuse_qkv_projections(model):
+    """
+    Fuse the q/k/v projections of every pose-conditioned self attention (query_condition and key_value_condition,
+    i.e. the temporal attention of the motion modules) in `model` into one GEMM. The fused weights are copies:
+    processors whose projections or LoRA layers still require grad are left alone. Returns the number fused.
+    """
+    fused_num = 0
+    for module in model.modules():
+        processor = getattr(module, "processor", None)
+        if hasattr(processor, "fuse_qkv") and processor.fuse_qkv(module):
+            fused_num += 1
+    return fused_num
+
+
+def unfuse_qkv_projections(model):
+    for module in model.modules():
+        processor = getattr(module, "processor", None)
+        if hasattr(processor, "unfuse_qkv"):
+            processor.unfuse_qkv()
+
+
+def set_attention_backend(model, use_sdpa):
+    ## switch every processor of this file inside `model` between sdpa and the bmm path
+    for module in model.modules():
+        processor = getattr(module, "processor", None)
+        if hasattr(processor, "use_sdpa"):
+            processor.use_sdpa = use_sdpa
+
 
 class AttnProcessor:
     r"""
     Default processor for performing attention-related computations.
     """
 
+    def __init__(self, use_sdpa=True):
+        self.use_sdpa = use_sdpa
+
     def __call__(
             self,
             attn: Attention,
@@ -58,13 +170,7 @@ class AttnProcessor:
         key = attn.to_k(encoder_hidden_states, *args)
         value = attn.to_v(encoder_hidden_states, *args)
 
-        query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
-
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
+        hidden_states = compute_attention(attn, query, key, value, attention_mask, self.use_sdpa)
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states, *args)
@@ -72,7 +178,7 @@ class AttnProcessor:
         hidden_states = attn.to_out[1](hidden_states)
 
         if input_ndim == 4:
-            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+            hidden_states = hidden_states.transpose(-1, -2).reshape(residual.shape)
 
         if attn.residual_connection:
             hidden_states = hidden_states + residual
@@ -94,11 +200,13 @@ class LoRAAttnProcessor(nn.Module):
             rank=4,
             network_alpha=None,
             lora_scale=1.0,
+            use_sdpa=True,
     ):
         super().__init__()
 
         self.rank = rank
         self.lora_scale = lora_scale
+        self.use_sdpa = use_sdpa
 
         self.to_q_lora = LoRALinearLayer(hidden_size, hidden_size, rank, network_alpha)
         self.to_k_lora = LoRALinearLayer(cross_attention_dim or hidden_size, hidden_size, rank, network_alpha)
@@ -145,13 +253,7 @@ class LoRAAttnProcessor(nn.Module):
         key = attn.to_k(encoder_hidden_states) + lora_scale * self.to_k_lora(encoder_hidden_states)
         value = attn.to_v(encoder_hidden_states) + lora_scale * self.to_v_lora(encoder_hidden_states)
 
-        query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
-
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
+        hidden_states = compute_attention(attn, query, key, value, attention_mask, self.use_sdpa)
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states) + lora_scale * self.to_out_lora(hidden_states)
@@ -159,7 +261,7 @@ class LoRAAttnProcessor(nn.Module):
         hidden_states = attn.to_out[1](hidden_states)
 
         if input_ndim == 4:
-            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+            hidden_states = hidden_states.transpose(-1, -2).reshape(residual.shape)
 
         if attn.residual_connection:
             hidden_states = hidden_states + residual
@@ -176,7 +278,8 @@ class PoseAdaptorAttnProcessor(nn.Module):
                  cross_attention_dim=None,  # dimension of the text embedding
                  query_condition=False,
                  key_value_condition=False,
-                 scale=1.0):
+                 scale=1.0,
+                 use_sdpa=True):
         super().__init__()
 
         self.hidden_size = hidden_size
@@ -185,6 +288,7 @@ class PoseAdaptorAttnProcessor(nn.Module):
         self.scale = scale
         self.query_condition = query_condition
         self.key_value_condition = key_value_condition
+        self.use_sdpa = use_sdpa
         assert hidden_size == pose_feature_dim
         if self.query_condition and self.key_value_condition:
             self.qkv_merge = nn.Linear(hidden_size, hidden_size)
@@ -198,6 +302,21 @@ class PoseAdaptorAttnProcessor(nn.Module):
             self.kv_merge = nn.Linear(hidden_size, hidden_size)
             init.zeros_(self.kv_merge.weight)
             init.zeros_(self.kv_merge.bias)
+        ## see fuse_qkv_projections, not saved in the state dict
+        self.register_buffer("fused_qkv_weight", None, persistent=False)
+        self.register_buffer("fused_qkv_bias", None, persistent=False)
+
+    def fuse_qkv(self, attn):
+        if not (self.query_condition and self.key_value_condition):
+            return False
+        linears = [attn.to_q, attn.to_k, attn.to_v]
+        if any(p.requires_grad for linear in linears for p in linear.parameters()):
+            return False
+        self.fused_qkv_weight, self.fused_qkv_bias = get_fused_qkv_params(attn)
+        return True
+
+    def unfuse_qkv(self):
+        self.fused_qkv_weight, self.fused_qkv_bias = None, None
 
     def forward(self,
                 attn,
@@ -236,6 +355,9 @@ class PoseAdaptorAttnProcessor(nn.Module):
             encoder_hidden_states = rearrange(encoder_hidden_states, 'b c h w -> b (h w) c')
         else:
             assert encoder_hidden_states.ndim == 3
+        if not self.query_condition and encoder_hidden_states.shape[0] != hidden_states.shape[0]:
+            ## the pose feature is merged per frame, so a broadcast text embedding is repeated here
+            encoder_hidden_states = encoder_hidden_states.repeat_interleave(hidden_states.shape[0] // encoder_hidden_states.shape[0], dim=0)
         if pose_feature.ndim == 5:
             pose_feature = rearrange(pose_feature, "b c f h w -> (b f) (h w) c")
         elif pose_feature.ndim == 4:
@@ -264,21 +386,14 @@ class PoseAdaptorAttnProcessor(nn.Module):
             query_hidden_state = hidden_states
 
         # original attention
-        query = attn.to_q(query_hidden_state)
-        key = attn.to_k(key_value_hidden_state)
-        value = attn.to_v(key_value_hidden_state)
-
-        query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
-
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        # if not is_cross:
-        #     print("attention_probs.shape from Pose", attention_probs.shape)
-        #     input("attention_probs.shape")
+        if self.fused_qkv_weight is not None:
+            query, key, value = torch.nn.functional.linear(query_hidden_state, self.fused_qkv_weight, self.fused_qkv_bias).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(query_hidden_state)
+            key = attn.to_k(key_value_hidden_state)
+            value = attn.to_v(key_value_hidden_state)
 
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
+        hidden_states = compute_attention(attn, query, key, value, attention_mask, self.use_sdpa)
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states)
@@ -304,7 +419,8 @@ class LORAPoseAdaptorAttnProcessor(nn.Module):
                  # lora keywords
                  rank=4,
                  network_alpha=None,
-                 lora_scale=1.0):
+                 lora_scale=1.0,
+                 use_sdpa=True):
         super().__init__()
 
         self.hidden_size = hidden_size
@@ -313,6 +429,7 @@ class LORAPoseAdaptorAttnProcessor(nn.Module):
         self.scale = scale
         self.query_condition = query_condition
         self.key_value_condition = key_value_condition
+        self.use_sdpa = use_sdpa
         assert hidden_size == pose_feature_dim
         if self.query_condition and self.key_value_condition:
             self.qkv_merge = nn.Linear(hidden_size, hidden_size)
@@ -333,6 +450,25 @@ class LORAPoseAdaptorAttnProcessor(nn.Module):
         self.to_k_lora = LoRALinearLayer(cross_attention_dim or hidden_size, hidden_size, rank, network_alpha)
         self.to_v_lora = LoRALinearLayer(cross_attention_dim or hidden_size, hidden_size, rank, network_alpha)
         self.to_out_lora = LoRALinearLayer(hidden_size, hidden_size, rank, network_alpha)
+        ## see fuse_qkv_projections, not saved in the state dict; the LoRA deltas are merged at fused_lora_scale
+        self.register_buffer("fused_qkv_weight", None, persistent=False)
+        self.register_buffer("fused_qkv_bias", None, persistent=False)
+        self.fused_lora_scale = None
+
+    def fuse_qkv(self, attn, lora_scale=1.0):
+        ## lora_scale is the `scale` the processor is called with, 1.0 unless passed in cross_attention_kwargs
+        if not (self.query_condition and self.key_value_condition):
+            return False
+        modules = [attn.to_q, attn.to_k, attn.to_v, self.to_q_lora, self.to_k_lora, self.to_v_lora]
+        if any(p.requires_grad for module in modules for p in module.parameters()):
+            return False
+        self.fused_qkv_weight, self.fused_qkv_bias = get_fused_qkv_params(attn, (self.to_q_lora, self.to_k_lora, self.to_v_lora), lora_scale)
+        self.fused_lora_scale = lora_scale
+        return True
+
+    def unfuse_qkv(self):
+        self.fused_qkv_weight, self.fused_qkv_bias = None, None
+        self.fused_lora_scale = None
 
     def __call__(self,
                  attn,
@@ -368,6 +504,9 @@ class LORAPoseAdaptorAttnProcessor(nn.Module):
             encoder_hidden_states = rearrange(encoder_hidden_states, 'b c h w -> b (h w) c')
         else:
             assert encoder_hidden_states.ndim == 3
+        if not self.query_condition and encoder_hidden_states.shape[0] != hidden_states.shape[0]:
+            ## the pose feature is merged per frame, so a broadcast text embedding is repeated here
+            encoder_hidden_states = encoder_hidden_states.repeat_interleave(hidden_states.shape[0] // encoder_hidden_states.shape[0], dim=0)
         if pose_feature.ndim == 5:
             pose_feature = rearrange(pose_feature, "b c f h w -> (b f) (h w) c")
         elif pose_feature.ndim == 4:
@@ -395,17 +534,14 @@ class LORAPoseAdaptorAttnProcessor(nn.Module):
             query_hidden_state = hidden_states
 
         # original attention
-        query = attn.to_q(query_hidden_state) + lora_scale * self.to_q_lora(query_hidden_state)
-        key = attn.to_k(key_value_hidden_state) + lora_scale * self.to_k_lora(key_value_hidden_state)
-        value = attn.to_v(key_value_hidden_state) + lora_scale * self.to_v_lora(key_value_hidden_state)
-
-        query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
+        if self.fused_qkv_weight is not None and lora_scale == self.fused_lora_scale:
+            query, key, value = torch.nn.functional.linear(query_hidden_state, self.fused_qkv_weight, self.fused_qkv_bias).chunk(3, dim=-1)
+        else:
+            query = attn.to_q(query_hidden_state) + lora_scale * self.to_q_lora(query_hidden_state)
+            key = attn.to_k(key_value_hidden_state) + lora_scale * self.to_k_lora(key_value_hidden_state)
+            value = attn.to_v(key_value_hidden_state) + lora_scale * self.to_v_lora(key_value_hidden_state)
 
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
+        hidden_states = compute_attention(attn, query, key, value, attention_mask, self.use_sdpa)
 
         # linear proj
         hidden_states = attn.to_out[0](hidden_states) + lora_scale * self.to_out_lora(hidden_states)
@@ -1,21 +1,103 @@
 import math
+import hashlib
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 from einops import rearrange
 
 
+def get_pose_cache_keys(camera_poses, intrinsics, is_null_list=None):
+    """
+    One key per sample from the relative poses [B,F,...] and intrinsics [B,F,4] the Plücker embedding is built from.
+    Pass the host side poses (e.g. batch["camera_infos"]) to avoid a device sync; samples flagged in is_null_list
+    are keyed as the zero poses they are replaced with.
+    """
+    poses = torch.as_tensor(camera_poses).detach().to("cpu", torch.float32).reshape(len(camera_poses), -1).numpy()
+    if is_null_list is not None and any(is_null_list):
+        poses = poses.copy()
+        poses[list(is_null_list)] = 0
+    intrinsics = torch.as_tensor(intrinsics).detach().to("cpu", torch.float32).reshape(len(poses), -1).numpy()
+    return [hashlib.sha1(pose.tobytes() + intrinsic.tobytes()).hexdigest() for pose, intrinsic in zip(poses, intrinsics)]
+
+
+class PoseFeatureCache(object):
+    """
+    LRU cache of frozen pose encoder outputs, per sample lists of [c f h w] features keyed by
+    `get_pose_cache_keys` and the embedding size. `device` is where the features are kept, the CPU by
+    default: one sample is ~28 MB in fp16 at 256x384x16, too much to pin many of them on the GPU.
+    """
+
+    def __init__(self, max_size=64, device="cpu"):
+        self.max_size = max_size
+        self.device = device
+        self.features = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.features)
+
+    def get(self, key):
+        if key in self.features:
+            self.features.move_to_end(key)
+            self.hits += 1
+            return self.features[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, features):
+        ## clone so a cached sample does not keep the whole batch tensor alive
+        self.features[key] = [feature.to(self.device) if self.device is not None else feature.clone() for feature in features]
+        while len(self.features) > self.max_size:
+            self.features.popitem(last=False)
+
+    def get_stats_msg(self):
+        lookups = self.hits + self.misses
+        return f"Pose cache hit rate: {self.hits / lookups if lookups > 0 else 0.0:.2%} ({len(self)} poses)"
+
+
 class CamObjPoseAdaptor(nn.Module):
-    def __init__(self, unet, pose_encoder):
+    def __init__(self, unet, pose_encoder, pose_feature_cache_kwargs=None):
         super().__init__()
         self.unet = unet
         self.pose_encoder = pose_encoder
+        ## only used while the pose encoder is frozen
+        self.pose_feature_cache = PoseFeatureCache(**pose_feature_cache_kwargs) if pose_feature_cache_kwargs is not None else None
+
+    def is_pose_encoder_frozen(self):
+        return not any(p.requires_grad for p in self.pose_encoder.parameters())
+
+    def encode_pose(self, pose_embedding, pose_cache_keys=None):
+        """
+        pose_embedding [b c f h w] -> list of [b c f h w] features. A frozen encoder runs without autograd
+        and, with a cache and keys, only on the samples whose features are not cached.
+        """
+        bs = pose_embedding.shape[0]
+        if not self.is_pose_encoder_frozen():
+            return [rearrange(x, '(b f) c h w -> b c f h w', b=bs) for x in self.pose_encoder(pose_embedding)]
+
+        with torch.no_grad():
+            if self.pose_feature_cache is None or pose_cache_keys is None:
+                return [rearrange(x, '(b f) c h w -> b c f h w', b=bs) for x in self.pose_encoder(pose_embedding)]
+
+            keys = [(key, *pose_embedding.shape[-2:]) for key in pose_cache_keys]
+            sample_features = [self.pose_feature_cache.get(key) for key in keys]
+            missing = [i for i, features in enumerate(sample_features) if features is None]
+            if missing:
+                missing_features = self.pose_encoder(pose_embedding[missing])
+                missing_features = [rearrange(x, '(b f) c h w -> b c f h w', b=len(missing)) for x in missing_features]
+                for j, i in enumerate(missing):
+                    sample_features[i] = [x[j] for x in missing_features]
+                    self.pose_feature_cache.put(keys[i], sample_features[i])
+
+            device = pose_embedding.device
+            return [torch.stack([features[level].to(device, non_blocking=True) for features in sample_features])
+                    for level in range(len(sample_features[0]))]
 
-    def forward(self, noisy_latents, timesteps, encoder_hidden_states, pose_embedding,traj_features):
+    def forward(self, noisy_latents, timesteps, encoder_hidden_states, pose_embedding,traj_features,pose_cache_keys=None):
         assert pose_embedding.ndim == 5
-        bs = pose_embedding.shape[0]            # b c f h w
-        pose_embedding_features = self.pose_encoder(pose_embedding)      # bf c h w
-        pose_embedding_features = [rearrange(x, '(b f) c h w -> b c f h w', b=bs)
-                                   for x in pose_embedding_features]
+        pose_embedding_features = self.encode_pose(pose_embedding, pose_cache_keys)
         noise_pred = self.unet(noisy_latents,
                                timesteps,
                                encoder_hidden_states,
@@ -1180,9 +1180,8 @@ class UNet3DConditionModelCamObjCond(UNet3DConditionModel):
             class_emb = self.class_embedding(class_labels).to(dtype=self.dtype)
             emb = emb + class_emb
 
-        # extend encoder_hidden_states
+        # encoder_hidden_states stays [b n c], the cross attention processors broadcast it over the (b f) frames
         video_length = sample.shape[2]
-        encoder_hidden_states = repeat(encoder_hidden_states, "b n c -> (b f) n c", f=video_length)
 
         # pre-process
         sample = self.conv_in(sample)           # b c f h w
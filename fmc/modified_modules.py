@@ -13,6 +13,21 @@ class UNet3DConditionOutput(BaseOutput):
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+
+def add_traj_feature(hidden_states, traj_feature):
+    """
+    hidden_states + traj_feature. A traj feature with a smaller batch only conditions the trailing samples:
+    classifier free guidance batches must be ordered (uncond, cond), as built by
+    pipeline_animation_cm_om.expand_cfg_batch, and the leading unconditional half is left untouched.
+    """
+    if traj_feature.shape[0] == hidden_states.shape[0]:
+        return hidden_states + traj_feature
+    uncond_num = hidden_states.shape[0] - traj_feature.shape[0]
+    ## one output allocation, like the plain add, the cond half is updated in place
+    output = hidden_states.clone()
+    output[uncond_num:] += traj_feature
+    return output
+
 # cmcm
 def Adapted_TemporalTransformerBlock_forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None, video_length=None, **kwargs):
     # import pdb; pdb.set_trace()
@@ -113,7 +128,7 @@ def Adapted_CrossAttnDownBlock3D_forward(self, hidden_states, temb=None, encoder
 
     
     if traj_features is not None:
-        hidden_states = hidden_states + traj_features[self.traj_fea_idx]
+        hidden_states = add_traj_feature(hidden_states, traj_features[self.traj_fea_idx])
         output_states = output_states[:-1] + (hidden_states,)
     
     if self.downsamplers is not None:
@@ -170,7 +185,7 @@ def Adapted_DownBlock3D_forward(self, hidden_states, temb=None, encoder_hidden_s
 
     # omcm
     if traj_features is not None:
-        hidden_states = hidden_states + traj_features[self.traj_fea_idx]
+        hidden_states = add_traj_feature(hidden_states, traj_features[self.traj_fea_idx])
         output_states = output_states[:-1] + (hidden_states,)
 
 
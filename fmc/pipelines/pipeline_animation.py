@@ -27,6 +27,7 @@ from diffusers.utils import deprecate, logging, BaseOutput
 
 from ..models.pose_adaptor import CameraPoseEncoder
 from ..models.unet import UNet3DConditionModel
+from ..utils.vae_decode import VAEDecoder
 
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
@@ -113,6 +114,7 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
             scheduler=scheduler,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.vae_decode_kwargs = {}
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -235,20 +237,14 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
 
         return text_embeddings
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
-        latents = 1 / 0.18215 * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(self.vae.decode(latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
+    def set_vae_decode_config(self, **vae_decode_kwargs):
+        ## frame_chunk_size / tile_latent_size / tile_overlap / memory_budget_mb of fmc.utils.vae_decode.VAEDecoder
+        self.vae_decode_kwargs = vae_decode_kwargs
+
+    def decode_latents(self, latents, output_writer=None):
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.cpu().float().numpy()
-        return video
+        vae_decoder = VAEDecoder(self.vae, **self.vae_decode_kwargs)
+        return vae_decoder.decode(latents, output_writer=output_writer)
 
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -462,21 +458,6 @@ class CameraCtrlPipeline(AnimationPipeline):
             pose_encoder=pose_encoder
         )
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
-        latents = 1 / 0.18215 * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(self.vae.decode(latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.cpu().float().numpy()
-        return video
-
     def _encode_prompt(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance, negative_prompt):
         batch_size = len(prompt) if isinstance(prompt, list) else 1
 
@@ -27,11 +27,20 @@ from diffusers.utils import deprecate, logging, BaseOutput
 
 from ..models.pose_adaptor import CameraPoseEncoder
 from ..models.unet import UNet3DConditionModel
+from ..utils.vae_decode import VAEDecoder, get_blend_weights
 
 
 logger = logging.get_logger(__name__)
 
 
+def expand_cfg_batch(x):
+    ## [b ...] -> [2b ...] (uncond, cond) halves for classifier free guidance, a view without copy when b == 1.
+    ## The uncond half comes first: _encode_prompt and fmc.modified_modules.add_traj_feature rely on that order
+    if x.shape[0] == 1:
+        return x.expand(2, *x.shape[1:])
+    return torch.cat([x, x], dim=0)
+
+
 @dataclass
 class AnimationPipelineOutput(BaseOutput):
     videos: Union[torch.Tensor, np.ndarray]
@@ -113,6 +122,7 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
             scheduler=scheduler,
         )
         self.vae_scale_factor = 2 ** (len(self.vae.config.block_out_channels) - 1)
+        self.vae_decode_kwargs = {}
 
     def enable_vae_slicing(self):
         self.vae.enable_slicing()
@@ -235,20 +245,14 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
 
         return text_embeddings
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
-        latents = 1 / 0.18215 * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(self.vae.decode(latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
+    def set_vae_decode_config(self, **vae_decode_kwargs):
+        ## frame_chunk_size / tile_latent_size / tile_overlap / memory_budget_mb of fmc.utils.vae_decode.VAEDecoder
+        self.vae_decode_kwargs = vae_decode_kwargs
+
+    def decode_latents(self, latents, output_writer=None):
         # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.cpu().float().numpy()
-        return video
+        vae_decoder = VAEDecoder(self.vae, **self.vae_decode_kwargs)
+        return vae_decoder.decode(latents, output_writer=output_writer)
 
     def prepare_extra_step_kwargs(self, generator, eta):
         # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
@@ -332,6 +336,7 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
 
         multidiff_total_steps: int = 1,
         multidiff_overlaps: int = 12,
+        output_writer: Optional[Callable[[int, int, np.ndarray], None]] = None,
         **kwargs,
     ):
         # Default height and width to unet
@@ -427,10 +432,11 @@ class AnimationPipeline(DiffusionPipeline, LoraLoaderMixin):
                         callback(i, t, latents)
 
         # Post-processing
-        video = self.decode_latents(latents)
+        # with output_writer the decoded chunks are streamed to it and videos is None
+        video = self.decode_latents(latents, output_writer=output_writer)
 
         # Convert to tensor
-        if output_type == "tensor":
+        if output_type == "tensor" and video is not None:
             video = torch.from_numpy(video)
 
         if not return_dict:
@@ -462,21 +468,6 @@ class CameraObjCtrlPipeline(AnimationPipeline):
             pose_encoder=pose_encoder
         )
 
-    def decode_latents(self, latents):
-        video_length = latents.shape[2]
-        latents = 1 / 0.18215 * latents
-        latents = rearrange(latents, "b c f h w -> (b f) c h w")
-        # video = self.vae.decode(latents).sample
-        video = []
-        for frame_idx in range(latents.shape[0]):
-            video.append(self.vae.decode(latents[frame_idx:frame_idx+1]).sample)
-        video = torch.cat(video)
-        video = rearrange(video, "(b f) c h w -> b c f h w", f=video_length)
-        video = (video / 2 + 0.5).clamp(0, 1)
-        # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-        video = video.cpu().float().numpy()
-        return video
-
     def _encode_prompt(self, prompt, device, num_videos_per_prompt, do_classifier_free_guidance, negative_prompt):
         batch_size = len(prompt) if isinstance(prompt, list) else 1
 
@@ -589,6 +580,7 @@ class CameraObjCtrlPipeline(AnimationPipeline):
         callback_steps: Optional[int] = 1,
         multidiff_total_steps: int = 1,
         multidiff_overlaps: int = 12,
+        output_writer: Optional[Callable[[int, int, np.ndarray], None]] = None,
         **kwargs,
     ):
         # Default height and width to unet
@@ -643,38 +635,44 @@ class CameraObjCtrlPipeline(AnimationPipeline):
 
         # Prepare extra step kwargs.
         extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+
+        # Sliding windows of single_model_length frames, overlapping by multidiff_overlaps
+        assert multidiff_total_steps == 1 or 0 <= multidiff_overlaps < single_model_length
+        window_starts = [multidiff_step * (single_model_length - multidiff_overlaps) for multidiff_step in range(multidiff_total_steps)]
+
+        # with several windows their conditions wait on the CPU and only the running window is on the device
+        window_feature_device = "cpu" if multidiff_total_steps > 1 else device
+
+        def encode_pose(pe):
+            pose_embedding_feature = self.pose_encoder(pe.to(device))       # bf, c, h, w
+            return [rearrange(x, '(b f) c h w -> b c f h w', b=pe.shape[0]).to(window_feature_device) for x in pose_embedding_feature]
+
+        # pose features of every window, the pose encoder only sees one window at a time
         if isinstance(pose_embedding, list):
-            assert all([x.ndim == 5 for x in pose_embedding])
-            bs = pose_embedding[0].shape[0]
-            pose_embedding_features = []
-            for pe in pose_embedding:
-                pose_embedding_feature = self.pose_encoder(pe)
-                pose_embedding_feature = [rearrange(x, '(b f) c h w -> b c f h w', b=bs) for x in pose_embedding_feature]
-                pose_embedding_features.append(pose_embedding_feature)
+            assert all([x.ndim == 5 for x in pose_embedding]) and len(pose_embedding) == multidiff_total_steps
+            pose_embedding_features = [encode_pose(pe) for pe in pose_embedding]
         else:
-            bs = pose_embedding.shape[0]
-            assert pose_embedding.ndim == 5
-            pose_embedding_features = self.pose_encoder(pose_embedding)       # bf, c, h, w
-            pose_embedding_features = [rearrange(x, '(b f) c h w -> b c f h w', b=bs)
-                                       for x in pose_embedding_features]
-            
+            assert pose_embedding.ndim == 5 and pose_embedding.shape[2] == video_length
+            pose_embedding_features = [encode_pose(pose_embedding[:, :, start_idx: start_idx + single_model_length])
+                                       for start_idx in window_starts]
+
+        # traj_features cover the whole video (they may be passed on the CPU) and are kept per window as [b c f h w],
+        # the unet only adds them to the conditional half (see add_traj_feature)
+        if traj_features is not None:
+            assert all([x.shape[2] == video_length for x in traj_features])
+            traj_features = [[x[:, :, start_idx: start_idx + single_model_length].to(window_feature_device) for x in traj_features]
+                             for start_idx in window_starts]
+
+        # frame weights of every window, ramping over the overlaps with its neighbours
+        window_weights = [get_blend_weights(single_model_length, multidiff_overlaps, multidiff_step > 0,
+                                            multidiff_step < multidiff_total_steps - 1, device).view(1, 1, -1, 1, 1)
+                          for multidiff_step in range(multidiff_total_steps)]
+        weight_full = torch.zeros(1, 1, video_length, 1, 1, device=device)
+        for start_idx, window_weight in zip(window_starts, window_weights):
+            weight_full[:, :, start_idx: start_idx + single_model_length] += window_weight
+
         # Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
-        if isinstance(pose_embedding_features[0], list):
-            pose_embedding_features = [[torch.cat([x, x], dim=0) for x in pose_embedding_feature]
-                                       for pose_embedding_feature in pose_embedding_features] \
-                if do_classifier_free_guidance else pose_embedding_features
-        else:
-            pose_embedding_features = [torch.cat([x, x], dim=0) for x in pose_embedding_features] \
-                if do_classifier_free_guidance else pose_embedding_features  # [2b c f h w]
-
-        if traj_features is not None and do_classifier_free_guidance:
-            new_traj_features=[]
-            for idx in range(len(traj_features)):
-                _traj_features = torch.cat([torch.zeros_like(traj_features[idx]), traj_features[idx]], dim=0) 
-                new_traj_features.append(_traj_features)
-            traj_features=new_traj_features
-            
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 
@@ -683,38 +681,31 @@ class CameraObjCtrlPipeline(AnimationPipeline):
                     _traj_features=None
                 else:
                     _traj_features=traj_features
-                    
-                noise_pred_full = torch.zeros_like(latents).to(latents.device)
-                mask_full = torch.zeros_like(latents).to(latents.device)
-                noise_preds = []
-                assert multidiff_total_steps==1
-                
-                for multidiff_step in range(multidiff_total_steps):
-                    start_idx = multidiff_step * (single_model_length - multidiff_overlaps)
-                    latent_partial = latents[:, :, start_idx: start_idx + single_model_length].contiguous()
-                    mask_full[:, :, start_idx: start_idx + single_model_length] += 1
 
-                    if isinstance(pose_embedding, list):
-                        pose_embedding_features_input = pose_embedding_features[multidiff_step]
-                    else:
-                        pose_embedding_features_input = [x[:, :, start_idx: start_idx + single_model_length]
-                                                         for x in pose_embedding_features]
+                # window predictions are accumulated right away, so only one window is alive at a time
+                noise_pred_full = torch.zeros_like(latents)
+
+                for multidiff_step, start_idx in enumerate(window_starts):
+                    latent_partial = latents[:, :, start_idx: start_idx + single_model_length].contiguous()
+                    pose_embedding_features_input = [x.to(device, non_blocking=True) for x in pose_embedding_features[multidiff_step]]
+                    if do_classifier_free_guidance:
+                        pose_embedding_features_input = [expand_cfg_batch(x) for x in pose_embedding_features_input]  # [2b c f h w]
+                    traj_features_input = [x.to(device, non_blocking=True) for x in _traj_features[multidiff_step]] \
+                        if _traj_features is not None else None
 
                     # expand the latents if we are doing classifier free guidance
-                    latent_model_input = torch.cat([latent_partial] * 2) if do_classifier_free_guidance else latent_partial   # [2b c f h w]
+                    latent_model_input = expand_cfg_batch(latent_partial) if do_classifier_free_guidance else latent_partial   # [2b c f h w]
                     latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
 
                     # predict the noise residual
                     noise_pred = self.unet(latent_model_input, t, encoder_hidden_states=text_embeddings,
-                                           pose_embedding_features=pose_embedding_features_input,traj_features=_traj_features).sample.to(dtype=latents_dtype)
+                                           pose_embedding_features=pose_embedding_features_input,traj_features=traj_features_input).sample.to(dtype=latents_dtype)
                     # perform guidance
                     if do_classifier_free_guidance:
                         noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                         noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
-                    noise_preds.append(noise_pred)
-                for pred_idx, noise_pred in enumerate(noise_preds):
-                    start_idx = pred_idx * (single_model_length - multidiff_overlaps)
-                    noise_pred_full[:, :, start_idx: start_idx + single_model_length] += noise_pred / mask_full[:, :, start_idx: start_idx + single_model_length]
+                    noise_pred_full[:, :, start_idx: start_idx + single_model_length] += noise_pred * window_weights[multidiff_step].to(latents_dtype)
+                noise_pred_full = noise_pred_full / weight_full.to(latents_dtype)
 
                 # compute the previous noisy sample x_t -> x_t-1  b c f h w
                 latents = self.scheduler.step(noise_pred_full, t, latents, **extra_step_kwargs).prev_sample
@@ -726,10 +717,11 @@ class CameraObjCtrlPipeline(AnimationPipeline):
                         callback(i, t, latents)
 
         # Post-processing
-        video = self.decode_latents(latents)
+        # with output_writer the decoded chunks are streamed to it and videos is None
+        video = self.decode_latents(latents, output_writer=output_writer)
 
         # Convert to tensor
-        if output_type == "tensor":
+        if output_type == "tensor" and video is not None:
             video = torch.from_numpy(video)
 
         if not return_dict:
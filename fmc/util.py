@@ -214,6 +214,77 @@ def get_traj_features_v2(obj_info_list_list,obj_mask_list_list, omcm,cfg_random_
 
 
 
+def get_object_coverage(obj_masks, obj_valid=None):
+    ## bool [B,F,O,H,W], pixels of each valid object, padded objects cover nothing
+    covered = obj_masks > 0
+    if obj_valid is not None:
+        covered = covered & obj_valid[..., None, None]
+    return covered
+
+
+def get_latent_loss_mask(obj_coverage, latent_hw, dtype):
+    """
+    Union of the objects of each frame, resized to the latent size in one call: obj_coverage [B,F,O,H,W]
+    -> [B,1,F,h,w], same as the per-object loop plus F.interpolate (nearest) of the masked loss.
+    """
+    union_mask = obj_coverage.any(dim=2).to(dtype)
+    b = union_mask.shape[0]
+    union_mask = torch.nn.functional.interpolate(rearrange(union_mask, "b f h w -> (b f) 1 h w"), size=tuple(latent_hw))
+    return rearrange(union_mask, "(b f) c h w -> b c f h w", b=b)
+
+
+def build_traj_feature_map(obj_infos, obj_masks, obj_valid=None, obj_coverage=None):
+    """
+    Batched feature map of get_traj_features_v2 before omcm: obj_infos [B,F,O,12], obj_masks [B,F,O,H,W],
+    obj_valid bool [B,F,O] -> features [B,F,H,W,13] (masked poses and mask, times the mask) and mask [B,F,H,W,1].
+    Where objects overlap the last one in order wins, like the per-object scatter of v2.
+    obj_coverage from get_object_coverage can be passed in when it is already computed for the loss mask.
+    """
+    b, f, O, h, w = obj_masks.shape
+    if O == 0:
+        mask = obj_masks.new_zeros([b, f, h, w, 1])
+        return obj_infos.new_zeros([b, f, h, w, obj_infos.shape[-1] + 1]), mask
+    covered = get_object_coverage(obj_masks, obj_valid) if obj_coverage is None else obj_coverage
+
+    ## index of the last covering object per pixel, -1 where none
+    obj_order = torch.arange(1, O + 1, device=obj_masks.device).view(1, 1, O, 1, 1)
+    winner = (covered * obj_order).amax(dim=2) - 1
+    has_obj = winner >= 0
+    winner = winner.clamp(min=0)
+
+    mask = obj_masks.gather(2, winner[:, :, None]).squeeze(2)
+    mask = torch.where(has_obj, mask, torch.zeros_like(mask))[..., None]  # b f h w 1
+    info = obj_infos.gather(2, winner.view(b, f, h * w, 1).expand(-1, -1, -1, obj_infos.shape[-1]))
+    info = info.view(b, f, h, w, -1)
+
+    features = torch.cat([info * mask, mask], dim=-1) * mask
+    return features, mask
+
+
+def get_traj_features_v3(obj_infos, obj_masks, obj_valid, omcm, cfg_random_null_om, cfg_random_null_om_ratio, local_rank, dtype, obj_coverage=None):
+    """
+    Same output as get_traj_features_v2, from padded tensors (see fmc.data.utils.pad_object_conditions)
+    instead of per sample, per frame lists, without Python loops over frames and objects.
+    """
+    obj_infos = obj_infos.to(device=local_rank, dtype=dtype, non_blocking=True)
+    obj_masks = obj_masks.to(device=local_rank, non_blocking=True).to(dtype)
+    if obj_valid is not None:
+        obj_valid = obj_valid.to(device=local_rank, non_blocking=True)
+
+    features, mask_features = build_traj_feature_map(obj_infos, obj_masks, obj_valid, obj_coverage)
+    if cfg_random_null_om:
+        keep = torch.tensor([random.random() > cfg_random_null_om_ratio for _ in range(features.shape[0])], device=features.device)
+        features = features * keep.view(-1, 1, 1, 1, 1).to(dtype)
+    f = features.shape[1]
+
+    features = rearrange(features, "b f h w c -> (b f) c h w")
+    mask_features = rearrange(mask_features, "b f h w c -> (b f) c h w")
+    traj_features = omcm(features, mask_features)
+    traj_features = [rearrange(traj_feature, "(b f) c h w -> b c f h w", f=f) for traj_feature in traj_features]
+
+    return traj_features
+
+
 def get_traj_features(trajs, omcm):
     b, c, f, h, w = trajs.shape
     trajs = rearrange(trajs, "b c f h w -> (b f) c h w")
@@ -289,4 +360,54 @@ def vis_opt_flow(flow):
     vis_flow = torch.Tensor(vis_flow) # [c, t, h, w]
     vis_flow = vis_flow[None, ...]
 
-    return vis_flow
\ No newline at end of file
+    return vis_flow
+
+
+def benchmark_traj_features(batch_size=2, num_frames=16, num_objects=3, height=256, width=384, iters=20, device="cuda"):
+    ## get_traj_features_v2 on lists against get_traj_features_v3 on padded tensors, omcm left out
+    import time
+    from fmc.data.utils import pad_object_conditions
+
+    identity_omcm = lambda features, mask_features: [features]
+    obj_info_list_list, obj_mask_list_list = [], []
+    for _ in range(batch_size):
+        obj_info_list, obj_mask_list = [], []
+        for _ in range(num_frames):
+            k = random.randint(1, num_objects)
+            obj_info_list.append(np.random.randn(k, 12).astype(np.float32))
+            obj_mask_list.append(torch.rand(k, 1, height, width) * (torch.rand(k, 1, height, width) > 0.7))
+        obj_info_list_list.append(obj_info_list)
+        obj_mask_list_list.append(obj_mask_list)
+
+    def run_v2():
+        return get_traj_features_v2(obj_info_list_list, obj_mask_list_list, identity_omcm, False, 0., [], device, torch.float32)[0]
+
+    def run_v3():
+        obj_infos, obj_masks, _, obj_valid = pad_object_conditions(obj_info_list_list, obj_mask_list_list)
+        return get_traj_features_v3(obj_infos, obj_masks, obj_valid, identity_omcm, False, 0., device, torch.float32)[0]
+
+    max_diff = (run_v2() - run_v3()).abs().max().item()
+    for name, fn in [("v2", run_v2), ("v3", run_v3)]:
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        print(f"get_traj_features_{name}: {(time.perf_counter() - start) / iters * 1000:.2f} ms")
+    print(f"max abs difference: {max_diff:.3e}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_objects", type=int, default=3)
+    parser.add_argument("--sample_size", type=int, nargs=2, default=[256, 384])
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    benchmark_traj_features(args.batch_size, 16, args.num_objects, args.sample_size[0], args.sample_size[1], args.iters, args.device)
@@ -0,0 +1,49 @@
+import torch
+
+
+class PluckerEmbedding(object):
+    """
+    Plücker ray embedding of relative camera poses, computed on the poses' device.
+    Same rays as fmc.data.dataset.ray_condition without flipped frames; the pixel grid of every
+    (H, W, device) is built once and reused.
+    """
+
+    def __init__(self, device=None):
+        self.device = device
+        self._grids = {}
+
+    def get_pixel_grid(self, H, W, device):
+        ## float32 pixel centers (x [H*W], y [H*W])
+        key = (H, W, str(device))
+        if key not in self._grids:
+            ys, xs = torch.meshgrid(
+                torch.arange(H, device=device, dtype=torch.float32) + 0.5,
+                torch.arange(W, device=device, dtype=torch.float32) + 0.5,
+                indexing="ij",
+            )
+            self._grids[key] = (xs.reshape(-1), ys.reshape(-1))
+        return self._grids[key]
+
+    @torch.no_grad()
+    def __call__(self, c2w_rel_poses, intrinsics, sample_size, dtype=None):
+        """
+        c2w_rel_poses [B,F,3,4] (or [B,F,4,4]), intrinsics [B,F,4] (fx, fy, cx, cy) -> [B,F,6,H,W],
+        channels are (o x d, d). Rays are computed in float32 and returned in `dtype` (default the poses' dtype).
+        """
+        device = self.device if self.device is not None else torch.as_tensor(c2w_rel_poses).device
+        c2w = torch.as_tensor(c2w_rel_poses).to(device=device, dtype=torch.float32, non_blocking=True)
+        K = torch.as_tensor(intrinsics).to(device=device, dtype=torch.float32, non_blocking=True)
+        dtype = dtype or torch.as_tensor(c2w_rel_poses).dtype
+        H, W = sample_size
+        B, F = c2w.shape[:2]
+
+        xs, ys = self.get_pixel_grid(H, W, device)
+        fx, fy, cx, cy = K[..., None].unbind(dim=2)  # B,F,1
+        directions = torch.stack([(xs - cx) / fx, (ys - cy) / fy, torch.ones_like(xs).expand(B, F, -1)], dim=2)  # B,F,3,HW
+        directions = directions / directions.norm(dim=2, keepdim=True)
+
+        rays_d = c2w[..., :3, :3] @ directions  # B,F,3,HW
+        rays_o = c2w[..., :3, 3:].expand_as(rays_d)  # B,F,3,HW
+        rays_dxo = torch.linalg.cross(rays_o, rays_d, dim=2)
+        plucker = torch.cat([rays_dxo, rays_d], dim=2)
+        return plucker.reshape(B, F, 6, H, W).to(dtype)
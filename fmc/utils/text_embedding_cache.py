@@ -0,0 +1,125 @@
+import os
+from collections import OrderedDict
+
+import torch
+
+
+class TextEmbeddingCache(object):
+    """
+    LRU cache of frozen CLIP text encoder outputs keyed by caption. Embeddings are kept on the CPU
+    and only the captions missing from the cache are tokenized and encoded, in one batch.
+
+    encoder_device: device the text encoder runs on for misses, e.g. "cpu" to keep it off the GPU.
+    offload_hit_rate: once the hit rate over the last `hit_rate_window` lookups reaches it, the
+        text encoder is moved to the CPU for the remaining misses.
+    cache_path: embeddings are loaded from it at start and written by `save`.
+    """
+
+    def __init__(self, tokenizer, text_encoder, max_size=4096, cache_path=None, encoder_device=None,
+                 offload_hit_rate=None, hit_rate_window=1000):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.max_size = max_size
+        self.cache_path = cache_path
+        self.offload_hit_rate = offload_hit_rate
+        self.hit_rate_window = hit_rate_window
+
+        self.embeddings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._window_hits = 0
+        self._window_lookups = 0
+
+        if encoder_device is not None:
+            self.text_encoder.to(encoder_device)
+        self.encoder_device = next(self.text_encoder.parameters()).device
+
+        if cache_path is not None and os.path.isfile(cache_path):
+            self.load(cache_path)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def get_stats_msg(self):
+        return f"Text cache hit rate: {self.get_hit_rate():.2%} ({len(self)} captions)"
+
+    def _put(self, caption, embedding):
+        self.embeddings[caption] = embedding
+        self.embeddings.move_to_end(caption)
+        while len(self.embeddings) > self.max_size:
+            self.embeddings.popitem(last=False)
+
+    @torch.no_grad()
+    def _encode(self, captions):
+        prompt_ids = self.tokenizer(
+            captions, max_length=self.tokenizer.model_max_length, padding="max_length", truncation=True,
+            return_tensors="pt"
+        ).input_ids.to(self.encoder_device)
+        return self.text_encoder(prompt_ids)[0].cpu()  # b l c
+
+    def _update_window(self, hits, lookups):
+        if self.offload_hit_rate is None:
+            return
+        self._window_hits += hits
+        self._window_lookups += lookups
+        if self._window_lookups < self.hit_rate_window:
+            return
+        if self._window_hits / self._window_lookups >= self.offload_hit_rate and self.encoder_device.type != "cpu":
+            self.offload_encoder()
+        self._window_hits = 0
+        self._window_lookups = 0
+
+    def encode(self, captions, device=None):
+        """
+        Same output as text_encoder(tokenizer(captions).input_ids)[0], [b, l, c] on `device`.
+        """
+        batch_embeddings = {}
+        missing = []
+        for caption in OrderedDict.fromkeys(captions):
+            if caption in self.embeddings:
+                self.embeddings.move_to_end(caption)
+                batch_embeddings[caption] = self.embeddings[caption]
+            else:
+                missing.append(caption)
+        if missing:
+            ## clone so an evicted caption does not keep the whole batch tensor alive
+            for caption, embedding in zip(missing, self._encode(missing)):
+                batch_embeddings[caption] = embedding.clone()
+                self._put(caption, batch_embeddings[caption])
+
+        hits = sum(1 for caption in captions if caption not in missing)
+        self.hits += hits
+        self.misses += len(captions) - hits
+        self._update_window(hits, len(captions))
+
+        return torch.stack([batch_embeddings[caption] for caption in captions]).to(device, non_blocking=True)
+
+    def encoder_to(self, device):
+        ## e.g. for a validation pipeline that runs the text encoder itself
+        self.text_encoder.to(device)
+
+    def restore_encoder(self):
+        self.text_encoder.to(self.encoder_device)
+
+    def offload_encoder(self):
+        self.encoder_device = torch.device("cpu")
+        self.text_encoder.to(self.encoder_device)
+        torch.cuda.empty_cache()
+
+    def save(self, cache_path=None):
+        cache_path = cache_path or self.cache_path
+        if cache_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        captions = list(self.embeddings.keys())
+        embeddings = torch.stack(list(self.embeddings.values())) if captions else None
+        torch.save({"captions": captions, "embeddings": embeddings}, cache_path)
+
+    def load(self, cache_path):
+        state_dict = torch.load(cache_path, map_location="cpu")
+        for caption, embedding in zip(state_dict["captions"], state_dict["embeddings"] if state_dict["captions"] else []):
+            self._put(caption, embedding.clone())
@@ -146,3 +146,34 @@ def format_time(elapsed_time):
         formatted_time += f"{seconds:.2f} seconds"
 
     return formatted_time.strip()
+
+
+def _read_proc_kb(path, field):
+    ## value in kB of `field` in a /proc status-like file, None when unavailable (non-linux or exited process)
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def get_dataloader_worker_memory(data_iter):
+    """
+    Summed RSS and PSS (GB) of the worker processes of a dataloader iterator, None without workers.
+    RSS counts shared pages once per worker while PSS splits them, so copy-on-access growth shows up in PSS.
+    """
+    workers = getattr(data_iter, "_workers", None)
+    if not workers:
+        return None
+    rss, pss = 0, 0
+    for worker in workers:
+        worker_rss = _read_proc_kb(f"/proc/{worker.pid}/status", "VmRSS")
+        worker_pss = _read_proc_kb(f"/proc/{worker.pid}/smaps_rollup", "Pss")
+        if worker_rss is None or worker_pss is None:
+            return None
+        rss += worker_rss
+        pss += worker_pss
+    return rss / (1024 ** 2), pss / (1024 ** 2)
@@ -0,0 +1,148 @@
+import math
+
+import numpy as np
+import torch
+
+
+def get_tile_starts(size, tile_size, overlap):
+    ## start offsets of tiles covering [0, size), the last tile is aligned to the end
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    return list(range(0, size - tile_size, stride)) + [size - tile_size]
+
+
+def get_blend_weights(length, overlap, blend_start, blend_end, device):
+    ## 1d weights of a decoded tile, ramping up / down over `overlap` pixels on the blended sides
+    weights = torch.ones(length, device=device)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+        if blend_start:
+            weights[:overlap] = ramp
+        if blend_end:
+            weights[-overlap:] = torch.minimum(weights[-overlap:], ramp.flip(0))
+    return weights
+
+
+class VAEDecoder(object):
+    """
+    Chunked, optionally tiled, decode of [b c f h w] latents into [0, 1] float32 videos.
+
+    frame_chunk_size: frames per vae.decode call.
+    tile_latent_size: decode frames in (tile_latent_size x tile_latent_size) latent tiles overlapping by
+        tile_overlap latents, blended linearly. Tiles see less context in the vae mid block attention,
+        so this is only worth it when a whole frame does not fit.
+    memory_budget_mb: when frame_chunk_size / tile_latent_size are not given, they are chosen so the
+        estimated decode activations fit; defaults to half of the free CUDA memory.
+    A vae with slicing enabled (enable_vae_slicing) keeps decoding one frame per call, unless frame_chunk_size
+    or memory_budget_mb is set explicitly: then slicing is off for these decode calls.
+    """
+
+    ## rough peak decoder activations per output pixel, in units of block_out_channels[0] elements
+    ACTIVATION_FACTOR = 4
+
+    def __init__(self, vae, frame_chunk_size=None, tile_latent_size=None, tile_overlap=8, memory_budget_mb=None,
+                 scaling_factor=0.18215):
+        self.vae = vae
+        self.frame_chunk_size = frame_chunk_size
+        self.tile_latent_size = tile_latent_size
+        self.tile_overlap = tile_overlap
+        self.memory_budget_mb = memory_budget_mb
+        self.scaling_factor = scaling_factor
+        self.vae_scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+        self.override_slicing = frame_chunk_size is not None or memory_budget_mb is not None
+
+    def get_memory_budget(self, device):
+        if self.memory_budget_mb is not None:
+            return self.memory_budget_mb * 2 ** 20
+        if device.type == "cuda":
+            return torch.cuda.mem_get_info(device)[0] // 2
+        return None
+
+    def get_decode_plan(self, latent_hw, device, dtype):
+        """
+        (frame_chunk_size, tile_latent_size or None) for frames of latent size latent_hw.
+        """
+        frame_chunk_size, tile_latent_size = self.frame_chunk_size, self.tile_latent_size
+        if getattr(self.vae, "use_slicing", False) and not self.override_slicing:
+            return 1, tile_latent_size
+        budget = self.get_memory_budget(device)
+        if budget is None or (frame_chunk_size is not None and tile_latent_size is not None):
+            return frame_chunk_size or 1, tile_latent_size
+
+        element_size = torch.tensor([], dtype=dtype).element_size()
+        bytes_per_pixel = self.ACTIVATION_FACTOR * self.vae.config.block_out_channels[0] * element_size
+        frame_bytes = latent_hw[0] * latent_hw[1] * self.vae_scale_factor ** 2 * bytes_per_pixel
+
+        if tile_latent_size is None and frame_bytes > budget:
+            tile_pixels = math.isqrt(int(budget // bytes_per_pixel))
+            tile_latent_size = max(tile_pixels // self.vae_scale_factor, 2 * self.tile_overlap + 1)
+        if tile_latent_size is not None:
+            tile_h, tile_w = min(tile_latent_size, latent_hw[0]), min(tile_latent_size, latent_hw[1])
+            frame_bytes = tile_h * tile_w * self.vae_scale_factor ** 2 * bytes_per_pixel
+        if frame_chunk_size is None:
+            frame_chunk_size = max(int(budget // frame_bytes), 1)
+        return frame_chunk_size, tile_latent_size
+
+    def vae_decode(self, latents):
+        if not self.override_slicing:
+            return self.vae.decode(latents).sample
+        ## vae slicing would split the frame chunk back into single frames, it is off for the call and restored after
+        use_slicing = getattr(self.vae, "use_slicing", False)
+        self.vae.use_slicing = False
+        try:
+            return self.vae.decode(latents).sample
+        finally:
+            self.vae.use_slicing = use_slicing
+
+    def decode_frames(self, latents, tile_latent_size=None):
+        ## scaled latents [n c h w] -> [n 3 H W] in [-1, 1]
+        if tile_latent_size is None or max(latents.shape[-2:]) <= tile_latent_size:
+            return self.vae_decode(latents)
+
+        h, w = latents.shape[-2:]
+        overlap = min(self.tile_overlap, tile_latent_size // 2)
+        s = self.vae_scale_factor
+        video, weights = None, torch.zeros(1, 1, h * s, w * s, device=latents.device)
+        h_starts, w_starts = get_tile_starts(h, tile_latent_size, overlap), get_tile_starts(w, tile_latent_size, overlap)
+        for y in h_starts:
+            for x in w_starts:
+                tile = self.vae_decode(latents[:, :, y: y + tile_latent_size, x: x + tile_latent_size])
+                if video is None:
+                    video = torch.zeros(latents.shape[0], tile.shape[1], h * s, w * s, device=latents.device)
+                tile_h, tile_w = tile.shape[-2:]
+                weight = get_blend_weights(tile_h, overlap * s, y > 0, y != h_starts[-1], latents.device)[:, None] \
+                    * get_blend_weights(tile_w, overlap * s, x > 0, x != w_starts[-1], latents.device)[None]
+                video[:, :, y * s: y * s + tile_h, x * s: x * s + tile_w] += tile.float() * weight
+                weights[:, :, y * s: y * s + tile_h, x * s: x * s + tile_w] += weight
+        return video / weights
+
+    @torch.no_grad()
+    def iter_decode(self, latents):
+        """
+        Yields (batch_idx, frame_start, video_chunk) for latents [b c f h w], video_chunk is a float32
+        CPU tensor [3, n, H, W] in [0, 1] of frames frame_start ... frame_start + n.
+        """
+        frame_chunk_size, tile_latent_size = self.get_decode_plan(latents.shape[-2:], latents.device, latents.dtype)
+        for batch_idx in range(latents.shape[0]):
+            for frame_start in range(0, latents.shape[2], frame_chunk_size):
+                chunk = latents[batch_idx, :, frame_start: frame_start + frame_chunk_size].transpose(0, 1)
+                video = self.decode_frames(chunk / self.scaling_factor, tile_latent_size)
+                video = (video / 2 + 0.5).clamp(0, 1)
+                yield batch_idx, frame_start, video.transpose(0, 1).float().cpu()
+
+    def decode(self, latents, output_writer=None):
+        """
+        latents [b c f h w] -> float32 numpy video [b 3 f H W] in [0, 1]. With output_writer, every chunk
+        is passed to output_writer(batch_idx, frame_start, video_chunk numpy [3 n H W]) instead and None is returned.
+        """
+        video = None
+        for batch_idx, frame_start, video_chunk in self.iter_decode(latents):
+            video_chunk = video_chunk.numpy()
+            if output_writer is not None:
+                output_writer(batch_idx, frame_start, video_chunk)
+                continue
+            if video is None:
+                video = np.empty((latents.shape[0], video_chunk.shape[0], latents.shape[2], *video_chunk.shape[-2:]), dtype=np.float32)
+            video[batch_idx, :, frame_start: frame_start + video_chunk.shape[1]] = video_chunk
+        return video
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import torch
+
+from fmc.data.utils import (
+    create_pose_matrix_batch,
+    create_relative_matrix_of_cam_batch,
+    create_relative_matrix_of_cam_list,
+    transform_euler_to_matrix,
+    transform_euler_to_matrix_batch,
+    transform_euler_to_matrix_v2,
+    transform_euler_to_matrix_v2_batch,
+)
+
+
+def get_random_poses(num, seed=0):
+    rng = np.random.default_rng(seed)
+    roll_pitch_yaw = rng.uniform(-180, 180, size=(num, 3))
+    xyz = rng.uniform(-10, 10, size=(num, 3))
+    return xyz, roll_pitch_yaw
+
+
+@pytest.mark.parametrize("euler_to_matrix_batch,euler_to_matrix", [
+    (transform_euler_to_matrix_batch, transform_euler_to_matrix),
+    (transform_euler_to_matrix_v2_batch, transform_euler_to_matrix_v2),
+])
+def test_euler_to_matrix_batch(euler_to_matrix_batch, euler_to_matrix):
+    _, roll_pitch_yaw = get_random_poses(64)
+    expected = np.array([euler_to_matrix(*angles) for angles in roll_pitch_yaw])
+
+    np.testing.assert_allclose(euler_to_matrix_batch(roll_pitch_yaw), expected, atol=1e-12)
+    result = euler_to_matrix_batch(torch.from_numpy(roll_pitch_yaw))
+    assert isinstance(result, torch.Tensor) and result.dtype == torch.float64
+    np.testing.assert_allclose(result.numpy(), expected, atol=1e-12)
+
+
+def test_create_pose_matrix_batch():
+    xyz, roll_pitch_yaw = get_random_poses(16)
+    for lib_xyz, lib_roll_pitch_yaw in [(xyz, roll_pitch_yaw), (torch.from_numpy(xyz), torch.from_numpy(roll_pitch_yaw))]:
+        pose = np.asarray(create_pose_matrix_batch(lib_xyz, lib_roll_pitch_yaw))
+        for i in range(len(xyz)):
+            np.testing.assert_allclose(pose[i, :3, :3], transform_euler_to_matrix_v2(*roll_pitch_yaw[i]), atol=1e-12)
+            np.testing.assert_allclose(pose[i, :3, 3], xyz[i])
+            np.testing.assert_array_equal(pose[i, 3], [0, 0, 0, 1])
+
+
+@pytest.mark.parametrize("scale_T", [1, 2.5])
+def test_create_relative_matrix_of_cam_batch(scale_T):
+    xyz, roll_pitch_yaw = get_random_poses(16, seed=1)
+    cam_info = create_pose_matrix_batch(torch.from_numpy(xyz), torch.from_numpy(roll_pitch_yaw))
+    expected = create_relative_matrix_of_cam_list(list(cam_info), scale_T=scale_T)
+
+    result = create_relative_matrix_of_cam_batch(cam_info, scale_T=scale_T)
+    assert result.shape == expected.shape and result.dtype == expected.dtype
+    torch.testing.assert_close(result, expected, rtol=1e-9, atol=1e-9)
+
+    result = create_relative_matrix_of_cam_batch(cam_info.numpy(), scale_T=scale_T)
+    np.testing.assert_allclose(result, expected.numpy(), rtol=1e-9, atol=1e-9)
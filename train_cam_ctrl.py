@@ -29,13 +29,18 @@ from diffusers.models.attention_processor import AttnProcessor
 from transformers import CLIPTextModel, CLIPTokenizer
 
 
-from fmc.utils.util import setup_logger, format_time, save_videos_grid
+from fmc.utils.text_embedding_cache import TextEmbeddingCache
+from fmc.utils.plucker import PluckerEmbedding
+from fmc.utils.util import setup_logger, format_time, get_dataloader_worker_memory, save_videos_grid
 from fmc.pipelines.pipeline_animation import CameraCtrlPipeline
 from fmc.models.unet import UNet3DConditionModelPoseCond
 from fmc.models.pose_adaptor import CameraPoseEncoder, PoseAdaptor
 from fmc.models.attention_processor import AttnProcessor as CustomizedAttnProcessor
-from fmc.data.dataset import UnrealTrajVideoDataset,UnrealTrajLoraDataset,ray_condition
-from fmc.data.utils import create_absolute_matrix_from_ref_cam_list
+from fmc.data.dataset import UnrealTrajVideoDataset,UnrealTrajLoraDataset
+from fmc.data.clip_plan import ClipPlanSampler
+from fmc.data.latent_cache import sample_latents
+from fmc.data.utils import create_absolute_matrix_from_ref_cam_list, pad_object_conditions
+from fmc.util import get_object_coverage, get_latent_loss_mask
 
 
 def save_camera_info_to_txt_file(save_root,abs_camera_info_list,camera_info_batch,obj_info_batch,prompts,img_path_list_list,cam_translation_rescale_factor,obj_translation_rescale_factor):
@@ -74,20 +79,11 @@ def save_camera_info_to_txt_file(save_root,abs_camera_info_list,camera_info_batc
                     
             
             
-def to_plucker_embedding(c2w_rel_poses,intrinsics,sample_size,ori_h=None, ori_w=None,rescale_fxy=True):
-    intrinsics = torch.as_tensor(intrinsics)                 
-    c2w = torch.as_tensor(c2w_rel_poses)                     
-    B, n_frame, _, _ = c2w.shape
-    bottom_row = torch.tensor([0, 0, 0, 1], dtype=c2w.dtype, device=c2w.device)
-    bottom_row = bottom_row.view(1, 1, 1, 4).expand(B, n_frame, 1, 4)
-    c2w = torch.cat([c2w, bottom_row], dim=2)
-
-    flip_flag = torch.zeros(16, dtype=torch.bool, device=c2w.device)
-
-    plucker_embedding = ray_condition(intrinsics, c2w, sample_size[0], sample_size[1], device='cpu',
-                                        flip_flag=flip_flag).permute(0,1, 4, 2, 3).contiguous()
-    
-    return plucker_embedding
+## rays are computed on the poses' device (the training device), pixel grids are cached per sample size
+plucker_embedding_fn = PluckerEmbedding()
+
+def to_plucker_embedding(c2w_rel_poses,intrinsics,sample_size,dtype=None):
+    return plucker_embedding_fn(c2w_rel_poses,intrinsics,sample_size,dtype=dtype)  # B, V, 6, H, W
 
 def init_dist(launcher="slurm", backend='nccl', port=29500, **kwargs):
     """Initializes distributed environment."""
@@ -184,6 +180,7 @@ def main(name: str,
          is_debug=False,
          train_unet=False,
          train_mm=False,
+         text_embedding_cache_kwargs: dict = None,
          ):
     check_min_version("0.10.0.dev0")
 
@@ -219,7 +216,9 @@ def main(name: str,
 
     noise_scheduler = DDIMScheduler(**OmegaConf.to_container(noise_scheduler_kwargs))
 
-    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
+    ## with a latent cache the VAE is only needed to decode validation samples on the main process
+    use_latent_cache = train_data.params.get("latent_cache_root") is not None
+    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae") if is_main_process or not use_latent_cache else None
     tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
     unet = UNet3DConditionModelPoseCond.from_pretrained_2d(pretrained_model_path, subfolder=unet_subfolder,
@@ -256,7 +255,8 @@ def main(name: str,
     else:
         logger.info(f"We do not load pretrained motion module checkpoint")
 
-    vae.requires_grad_(False)
+    if vae is not None:
+        vae.requires_grad_(False)
     text_encoder.requires_grad_(False)
     unet.requires_grad_(False)
 
@@ -326,22 +326,44 @@ def main(name: str,
         eps=adam_epsilon,
     )
 
-    vae.to(local_rank)
+    if vae is not None:
+        vae.to(local_rank)
     text_encoder.to(local_rank)
 
+    ## captions repeat (template grammar, empty cfg captions), their embeddings are looked up instead of re-encoded
+    text_embedding_cache = None
+    if text_embedding_cache_kwargs is not None:
+        text_embedding_cache = TextEmbeddingCache(tokenizer, text_encoder, **text_embedding_cache_kwargs)
+
 
     logger.info(f'Building training datasets')
+    if not train_data.params.get("load_obj_masks", True):
+        assert not apply_masked_loss, "object masks are needed by the masked loss"
     train_dataset = UnrealTrajVideoDataset(**train_data.params)
     
+    if train_dataset.clip_plan is not None:
+        logger.info(f"Clip plan: {len(train_dataset.clip_plan)} rows over {train_dataset.clip_plan.get_seq_num()} sequences, removes {train_dataset.clip_plan.rejection_rate:.2%} of random draws that would be rejected")
+    if train_dataset.metadata_nbytes is not None:
+        logger.info(f"Shared metadata: {train_dataset.metadata_nbytes / (1024 ** 2): .2f} MB packed into numpy buffers")
+
     if launcher!="single":
-        distributed_sampler = DistributedSampler(
-            train_dataset,
-            num_replicas=num_processes,
-            rank=global_rank,
-            shuffle=True,
-            seed=global_seed,
+        if train_dataset.clip_plan is not None:
+            distributed_sampler = ClipPlanSampler(
+                train_dataset.clip_plan,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
+            )
+        else:
+            distributed_sampler = DistributedSampler(
+                train_dataset,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
             
-        )
+            )
 
 
         train_dataloader = torch.utils.data.DataLoader(
@@ -358,7 +380,8 @@ def main(name: str,
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=train_batch_size,
-            shuffle=True,
+            shuffle=train_dataset.clip_plan is None,
+            sampler=ClipPlanSampler(train_dataset.clip_plan,seed=global_seed) if train_dataset.clip_plan is not None else None,
             num_workers=num_workers,
             pin_memory=True,
             drop_last=True,
@@ -453,7 +476,8 @@ def main(name: str,
 
     if is_main_process:
         logger.info("***** Running training *****")
-        logger.info(f"  Num examples = {len(train_dataset)}")
+        ## with a clip plan the sampler draws one plan row per sequence and epoch, len(train_dataset) counts plan rows
+        logger.info(f"  Num examples = {train_dataset.clip_plan.get_seq_num() if train_dataset.clip_plan is not None else len(train_dataset)}")
         logger.info(f"  Num Epochs = {num_train_epochs}")
         logger.info(f"  Instantaneous batch size per device = {train_batch_size}")
         logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
@@ -501,7 +525,7 @@ def main(name: str,
     scaler = torch.cuda.amp.GradScaler() if mixed_precision_training else None
 
     for epoch in range(first_epoch, num_train_epochs):
-        if launcher!="single":
+        if launcher!="single" or train_dataset.clip_plan is not None:
             train_dataloader.sampler.set_epoch(epoch)
         pose_adaptor.train()
 
@@ -523,12 +547,13 @@ def main(name: str,
             else:
                 batch['text']=batch["captions"]
             
-            batch["pixel_values"]=rearrange(batch["videos"], "b c f h w -> b f c h w")
+            if not use_latent_cache:
+                batch["pixel_values"]=rearrange(batch["videos"], "b c f h w -> b f c h w")
             
             if cfg_random_null_text:
                 batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
 
-            if epoch == first_epoch and step == 0 and do_sanity_check:
+            if epoch == first_epoch and step == 0 and do_sanity_check and not use_latent_cache:
                 pixel_values, texts = batch['pixel_values'].cpu(), batch['text']
                 pixel_values = rearrange(pixel_values, "b f c h w -> b c f h w")
                 for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
@@ -537,13 +562,17 @@ def main(name: str,
                                      f"{output_dir}/sanity_check/{'-'.join(text.replace('/', '').split()[:10]) if not text == '' else f'{global_rank}-{idx}'}.gif",
                                      rescale=True)
 
-            pixel_values = batch["pixel_values"].to(local_rank)
-            video_length = pixel_values.shape[1]
-            with torch.no_grad():
-                pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
-                latents = vae.encode(pixel_values).latent_dist.sample()
-                latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
-                latents = latents * 0.18215
+            if use_latent_cache:
+                latents = sample_latents(batch["latent_dists"].to(local_rank, dtype=torch.float32))
+                latents = rearrange(latents, "b f c h w -> b c f h w")
+            else:
+                pixel_values = batch["pixel_values"].to(local_rank)
+                video_length = pixel_values.shape[1]
+                with torch.no_grad():
+                    pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
+                    latents = vae.encode(pixel_values).latent_dist.sample()
+                    latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+                    latents = latents * 0.18215
 
             noise = torch.randn_like(latents)  # [b, c, f, h, w]
             bsz = latents.shape[0]
@@ -553,17 +582,20 @@ def main(name: str,
 
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)  # [b, c, f h, w]
 
-            with torch.no_grad():
-                prompt_ids = tokenizer(
-                    batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True,
-                    return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]  # b l c
+            if text_embedding_cache is not None:
+                encoder_hidden_states = text_embedding_cache.encode(batch['text'], device=latents.device)  # b l c
+            else:
+                with torch.no_grad():
+                    prompt_ids = tokenizer(
+                        batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True,
+                        return_tensors="pt"
+                    ).input_ids.to(latents.device)
+                    encoder_hidden_states = text_encoder(prompt_ids)[0]  # b l c
 
             enable_cmcm=True
             is_cm_condition_null_list=[]
             if enable_cmcm:
-                RT = batch["camera_infos"].to(device=local_rank,dtype=pixel_values.dtype)
+                RT = batch["camera_infos"].to(device=local_rank,dtype=latents.dtype)
                 RT = RT[...] # [b, t, 12]
                 RT=RT.reshape(RT.shape[0],RT.shape[1],3,4)
                 if cfg_random_null_text:
@@ -599,27 +631,9 @@ def main(name: str,
                 sd_loss = torch.nn.functional.mse_loss(model_pred.float(), target.float(), reduction="mean")
                 
                 if apply_masked_loss:
-                    obj_info_list_list=batch['obj_info_list_list']
-                    obj_mask_list_list=batch['obj_mask_list_list']
-                    B=len(obj_info_list_list)
-                    F=len(obj_info_list_list[0])
-                    
-                    H,W=obj_mask_list_list[0][0].shape[-2],obj_mask_list_list[0][0].shape[-1]
-                    mask=torch.zeros([B,F,H,W,1],dtype=pixel_values.dtype).to(local_rank)             
-                    for b_idx,(obj_info_list, obj_mask_list) in enumerate(zip(obj_info_list_list, obj_mask_list_list)):
-                        for f_idx,(obj_info, obj_mask) in enumerate(zip(obj_info_list, obj_mask_list)):
-                            obj_mask=obj_mask.permute(0,2,3,1).to(local_rank)
-                            for _obj_mask in obj_mask:
-                                mask[b_idx][f_idx][_obj_mask[...,0]]=1
-                    
-                    
-                    mask=rearrange(mask,"b f h w c-> (b f) c h w")##B frame c H w
-                    ord_h,ord_w=model_pred.shape[-2],model_pred.shape[-1]
-                    mask = torch.nn.functional.interpolate(
-                        input=mask, size=(ord_h,ord_w)
-                    )
-                    
-                    mask=rearrange(mask,"(b f) c h w -> b c f h w",b=B)##B c frame H w
+                    obj_infos,obj_masks,_,obj_valid=pad_object_conditions(batch['obj_info_list_list'],batch['obj_mask_list_list'])
+                    obj_coverage=get_object_coverage(obj_masks.to(local_rank,non_blocking=True),obj_valid.to(local_rank,non_blocking=True))
+                    mask=get_latent_loss_mask(obj_coverage,model_pred.shape[-2:],latents.dtype)##B c frame H w
                     
                     mask=1-mask## revert
                     
@@ -681,10 +695,14 @@ def main(name: str,
                                                        if k in mm_param_names}
                     
                 torch.save(state_dict, os.path.join(save_path, f"checkpoint-step-{global_step}.ckpt"))
+                if text_embedding_cache is not None:
+                    text_embedding_cache.save()
                 logger.info(f"Saved state to {save_path} (global_step: {global_step})")
 
             if is_main_process and ((global_step ==1+ord_global_step) or (
                     (global_step + 1) % validation_steps == 0 or (global_step + 1) in validation_steps_tuple)):
+                if text_embedding_cache is not None:
+                    text_embedding_cache.encoder_to(local_rank)
 
                 generator = torch.Generator(device=latents.device)
                 generator.manual_seed(global_seed)
@@ -751,10 +769,10 @@ def main(name: str,
                     logger.info(f"Saved real images to {real_save_path}. prompt is {prompt}")
                     
                     
-                    RT = camera_info.unsqueeze(0).to(device=local_rank,dtype=pixel_values.dtype)
+                    RT = camera_info.unsqueeze(0).to(device=local_rank,dtype=latents.dtype)
                     
                     batch_cam_info_list.append(RT.squeeze(0))
-                    abs_camera_info_list.append(abs_camera_info.to(device=local_rank,dtype=pixel_values.dtype))
+                    abs_camera_info_list.append(abs_camera_info.to(device=local_rank,dtype=latents.dtype))
 
                     RT=RT.reshape(RT.shape[0],RT.shape[1],3,4)
                     intrinsics=intrinsics.unsqueeze(0)
@@ -777,6 +795,8 @@ def main(name: str,
                 prompt_save_root=save_path = f"{output_dir}/samples/{global_step}"
             
                 save_camera_info_to_txt_file(prompt_save_root,abs_camera_info_list,batch_cam_info_list,batch_obj_info_list,prompts,img_path_list_list,validation_data.get("cam_translation_rescale_factor"),validation_data.get("obj_translation_rescale_factor"))
+                if text_embedding_cache is not None:
+                    text_embedding_cache.restore_encoder()
 
             if (global_step % logger_interval) == 0 or global_step == 0:
                 gpu_memory = torch.cuda.max_memory_allocated() / (1024 ** 3)
@@ -785,6 +805,11 @@ def main(name: str,
                       f"Iter time: {format_time(iter_end_time - data_end_time)}, " \
                       f"ETA: {format_time((iter_end_time - iter_start_time) * (max_train_steps - global_step))}, " \
                       f"GPU memory: {gpu_memory: .2f} G"
+                worker_memory = get_dataloader_worker_memory(data_iter)
+                if worker_memory is not None:
+                    msg += f", Worker RSS/PSS: {worker_memory[0]: .2f}/{worker_memory[1]: .2f} G"
+                if text_embedding_cache is not None:
+                    msg += f", {text_embedding_cache.get_stats_msg()}"
                 logger.info(msg)
 
             if global_step >= max_train_steps:
@@ -9,6 +9,7 @@ import subprocess
 import json
 import csv
 from pathlib import Path
+from functools import partial
 from omegaconf import OmegaConf
 from typing import Dict, Tuple
 from PIL import Image
@@ -29,16 +30,23 @@ from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version
 from diffusers.models.attention_processor import AttnProcessor
 
-from fmc.utils.util import setup_logger, format_time, save_videos_grid
+from fmc.utils.text_embedding_cache import TextEmbeddingCache
+from fmc.utils.plucker import PluckerEmbedding
+from fmc.utils.util import setup_logger, format_time, get_dataloader_worker_memory, save_videos_grid
 from fmc.pipelines.pipeline_animation_cm_om import CameraObjCtrlPipeline
 from fmc.models.unet_cam_obj import UNet3DConditionModelCamObjCond
 from fmc.models.pose_adaptor import CameraPoseEncoder
-from fmc.models.pose_obj_adaptor import CamObjPoseAdaptor
+from fmc.models.pose_obj_adaptor import CamObjPoseAdaptor, get_pose_cache_keys
 from fmc.models.attention_processor import AttnProcessor as CustomizedAttnProcessor
+from fmc.models.attention_processor import fuse_qkv_projections
 from fmc.data.utils import create_absolute_matrix_from_ref_cam_list
-from fmc.data.dataset import UnrealTrajVideoDataset,UnrealTrajLoraDataset,ray_condition
+from fmc.data.dataset import UnrealTrajVideoDataset,UnrealTrajLoraDataset
+from fmc.data.clip_plan import ClipPlanSampler
+from fmc.data.latent_cache import sample_latents
+from fmc.data.sphere_mask import render_circle_mask_list_list, render_gaussian_circle_masks
 from fmc.adapter import Adapter
-from fmc.util import get_traj_features_v2
+from fmc.util import get_traj_features_v3, get_object_coverage, get_latent_loss_mask
+from fmc.data.utils import pad_object_conditions
 from fmc.modified_modules import (
     Adapted_CrossAttnDownBlock3D_forward, Adapted_DownBlock3D_forward)
 
@@ -77,18 +85,11 @@ def save_camera_info_to_txt_file(save_root,abs_camera_info_list,camera_info_batc
                 f.write(f"{cam_str}\n")
 
             
-def to_plucker_embedding(c2w_rel_poses,intrinsics,sample_size,ori_h=None, ori_w=None,rescale_fxy=True):
-    intrinsics = torch.as_tensor(intrinsics)                  # [B, n_frame, 4]
-    c2w = torch.as_tensor(c2w_rel_poses)                          # [B, n_frame, 3, 4]
-    B, n_frame, _, _ = c2w.shape
-    bottom_row = torch.tensor([0, 0, 0, 1], dtype=c2w.dtype, device=c2w.device)
-    bottom_row = bottom_row.view(1, 1, 1, 4).expand(B, n_frame, 1, 4)
-    c2w = torch.cat([c2w, bottom_row], dim=2)# [B, n_frame, 4, 4]
-    flip_flag = torch.zeros(16, dtype=torch.bool, device=c2w.device)
-    plucker_embedding = ray_condition(intrinsics, c2w, sample_size[0], sample_size[1], device='cpu',
-                                        flip_flag=flip_flag).permute(0,1, 4, 2, 3).contiguous()##B, V, H, W, 6 ->  B, V, 6, H, W
-    
-    return plucker_embedding
+## rays are computed on the poses' device (the training device), pixel grids are cached per sample size
+plucker_embedding_fn = PluckerEmbedding()
+
+def to_plucker_embedding(c2w_rel_poses,intrinsics,sample_size,dtype=None):
+    return plucker_embedding_fn(c2w_rel_poses,intrinsics,sample_size,dtype=dtype)  # B, V, 6, H, W
 
 def init_dist(launcher="slurm", backend='nccl', port=29500, **kwargs):
     """Initializes distributed environment."""
@@ -196,6 +197,11 @@ def main(name: str,
          constant_loss_weight=1,
          train_image_lora=False,
          
+         text_embedding_cache_kwargs: dict = None,
+         padded_collate_kwargs: dict = None,
+         pose_feature_cache_kwargs: dict = None,
+         fuse_pose_qkv=False,
+         vae_decode_kwargs: dict = None,
          ):
     check_min_version("0.10.0.dev0")
     local_rank = init_dist(launcher=launcher, port=port)
@@ -230,7 +236,9 @@ def main(name: str,
 
     noise_scheduler = DDIMScheduler(**OmegaConf.to_container(noise_scheduler_kwargs))
 
-    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
+    ## with a latent cache the VAE is only needed to decode validation samples on the main process
+    use_latent_cache = train_data.params.get("latent_cache_root") is not None
+    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae") if is_main_process or not use_latent_cache else None
     tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
     unet = UNet3DConditionModelCamObjCond.from_pretrained_2d(pretrained_model_path, subfolder=unet_subfolder,
@@ -275,7 +283,10 @@ def main(name: str,
     else:
         logger.info(f"We do not load pretrained motion module checkpoint")
 
-    pose_adaptor = CamObjPoseAdaptor(unet, pose_encoder)
+    ## the frozen camera encoder only depends on the relative poses and intrinsics, its outputs can be reused
+    use_pose_feature_cache = pose_feature_cache_kwargs is not None and not train_cm
+    pose_adaptor = CamObjPoseAdaptor(unet, pose_encoder, pose_feature_cache_kwargs=pose_feature_cache_kwargs if use_pose_feature_cache else None)
+    pose_feature_cache = pose_adaptor.pose_feature_cache
     
     assert pretrained_cm_path is not None
     
@@ -329,7 +340,8 @@ def main(name: str,
             idx += 1
     
     pose_encoder.requires_grad_(False)
-    vae.requires_grad_(False)
+    if vae is not None:
+        vae.requires_grad_(False)
     text_encoder.requires_grad_(False)
 
     trainable_params=[]
@@ -422,6 +434,12 @@ def main(name: str,
         
         logger.info(f"trainable parameter scale: {sum(p.numel() for p in trainable_params) / 1e6:.3f} M")
 
+    if fuse_pose_qkv:
+        ## after all requires_grad changes, trainable projections are not fused
+        fused_num = fuse_qkv_projections(unet)
+        if is_main_process:
+            logger.info(f"fused qkv projections of {fused_num} pose attention processors")
+
     optimizer = torch.optim.AdamW(
         trainable_params,
         lr=learning_rate,
@@ -431,25 +449,52 @@ def main(name: str,
     )
     
 
-    vae.to(local_rank)
+    if vae is not None:
+        vae.to(local_rank)
     text_encoder.to(local_rank)
 
+    ## captions repeat (template grammar, empty cfg captions), their embeddings are looked up instead of re-encoded
+    text_embedding_cache = None
+    if text_embedding_cache_kwargs is not None:
+        text_embedding_cache = TextEmbeddingCache(tokenizer, text_encoder, **text_embedding_cache_kwargs)
+
 
     logger.info(f'Building training datasets')
+    if not train_data.params.get("load_obj_masks", True):
+        assert train_data.params.get("use_sphere_mask", False) and not apply_masked_loss, "object masks are needed by the masked loss and by the trajectory features without use_sphere_mask"
     train_dataset = UnrealTrajVideoDataset(**train_data.params)
     
     if launcher=="single":
         num_workers=0
             
+    if train_dataset.clip_plan is not None:
+        logger.info(f"Clip plan: {len(train_dataset.clip_plan)} rows over {train_dataset.clip_plan.get_seq_num()} sequences, removes {train_dataset.clip_plan.rejection_rate:.2%} of random draws that would be rejected")
+    if train_dataset.metadata_nbytes is not None:
+        logger.info(f"Shared metadata: {train_dataset.metadata_nbytes / (1024 ** 2): .2f} MB packed into numpy buffers")
+
+    ## padded object tensors instead of per frame lists, one shared memory buffer per field
+    collate_fn=UnrealTrajVideoDataset.collate_fn
+    if padded_collate_kwargs is not None:
+        collate_fn=partial(UnrealTrajVideoDataset.padded_collate_fn,**padded_collate_kwargs)
+
     if launcher!="single":
-        distributed_sampler = DistributedSampler(
-            train_dataset,
-            num_replicas=num_processes,
-            rank=global_rank,
-            shuffle=True,
-            seed=global_seed,
+        if train_dataset.clip_plan is not None:
+            distributed_sampler = ClipPlanSampler(
+                train_dataset.clip_plan,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
+            )
+        else:
+            distributed_sampler = DistributedSampler(
+                train_dataset,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
             
-        )
+            )
 
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
@@ -459,17 +504,18 @@ def main(name: str,
             num_workers=num_workers,
             pin_memory=True,
             drop_last=True,
-            collate_fn=UnrealTrajVideoDataset.collate_fn,
+            collate_fn=collate_fn,
         )
     else:
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=train_batch_size,
-            shuffle=True,
+            shuffle=train_dataset.clip_plan is None,
+            sampler=ClipPlanSampler(train_dataset.clip_plan,seed=global_seed) if train_dataset.clip_plan is not None else None,
             num_workers=num_workers,
             pin_memory=True,
             drop_last=True,
-            collate_fn=UnrealTrajVideoDataset.collate_fn,
+            collate_fn=collate_fn,
         )   
 
     if max_train_steps == -1:
@@ -496,6 +542,8 @@ def main(name: str,
             scheduler=noise_scheduler,
             pose_encoder=pose_encoder)
         validation_pipeline.enable_vae_slicing()
+        if vae_decode_kwargs is not None:
+            validation_pipeline.set_vae_decode_config(**vae_decode_kwargs)
 
         with open(validation_data.get("hdri_json_file_path"),"r") as f:
             hdri_json_data=json.load(f)
@@ -562,7 +610,8 @@ def main(name: str,
 
     if is_main_process:
         logger.info("***** Running training *****")
-        logger.info(f"  Num examples = {len(train_dataset)}")
+        ## with a clip plan the sampler draws one plan row per sequence and epoch, len(train_dataset) counts plan rows
+        logger.info(f"  Num examples = {train_dataset.clip_plan.get_seq_num() if train_dataset.clip_plan is not None else len(train_dataset)}")
         logger.info(f"  Num Epochs = {num_train_epochs}")
         logger.info(f"  Instantaneous batch size per device = {train_batch_size}")
         logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
@@ -587,7 +636,7 @@ def main(name: str,
 
     
     for epoch in range(first_epoch, num_train_epochs):
-        if launcher!="single":
+        if launcher!="single" or train_dataset.clip_plan is not None:
             train_dataloader.sampler.set_epoch(epoch)
         pose_adaptor.train()
         omcm.train()
@@ -601,12 +650,13 @@ def main(name: str,
             data_end_time = time.time()
             
             batch['text']=batch["captions"]
-            batch["pixel_values"]=rearrange(batch["videos"], "b c f h w -> b f c h w")
+            if not use_latent_cache:
+                batch["pixel_values"]=rearrange(batch["videos"], "b c f h w -> b f c h w")
             
             if cfg_random_null_text:
                 batch['text'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['text']]
 
-            if epoch == first_epoch and step == 0 and do_sanity_check:
+            if epoch == first_epoch and step == 0 and do_sanity_check and not use_latent_cache:
                 pixel_values, texts = batch['pixel_values'].cpu(), batch['text']
                 pixel_values = rearrange(pixel_values, "b f c h w -> b c f h w")
                 for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
@@ -618,6 +668,8 @@ def main(name: str,
             
             if is_main_process and ((global_step ==ord_global_step) or (
                     (global_step + 1) % validation_steps == 0 or (global_step + 1) in validation_steps_tuple)):
+                if text_embedding_cache is not None:
+                    text_embedding_cache.encoder_to(local_rank)
 
                 generator = torch.Generator(device=local_rank)
                 generator.manual_seed(global_seed)
@@ -754,8 +806,9 @@ def main(name: str,
                     
                     obj_info_list_list=[objs_info_list]
                     obj_mask_list_list=[obj_mask_list]
+                    obj_infos,obj_masks,_,obj_valid=pad_object_conditions(obj_info_list_list,obj_mask_list_list)
                     with torch.no_grad():              
-                        traj_features = get_traj_features_v2(obj_info_list_list,obj_mask_list_list, omcm,False,cfg_random_null_text_ratio,[],local_rank,dtype=torch.float32)
+                        traj_features = get_traj_features_v3(obj_infos,obj_masks,obj_valid, omcm,False,cfg_random_null_text_ratio,local_rank,dtype=torch.float32)
                     
                     
                     generator = torch.Generator(device=local_rank)
@@ -778,14 +831,20 @@ def main(name: str,
                 prompt_save_root=save_path = f"{output_dir}/samples/{global_step}"
             
                 save_camera_info_to_txt_file(prompt_save_root,abs_camera_info_list,batch_cam_info_list,batch_obj_info_list,prompts,img_path_list_list,validation_data.get("cam_translation_rescale_factor"),validation_data.get("obj_translation_rescale_factor"))
+                if text_embedding_cache is not None:
+                    text_embedding_cache.restore_encoder()
 
-            pixel_values = batch["pixel_values"].to(local_rank)
-            video_length = pixel_values.shape[1]
-            with torch.no_grad():
-                pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
-                latents = vae.encode(pixel_values).latent_dist.sample()
-                latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
-                latents = latents * 0.18215
+            if use_latent_cache:
+                latents = sample_latents(batch["latent_dists"].to(local_rank, dtype=torch.float32))
+                latents = rearrange(latents, "b f c h w -> b c f h w")
+            else:
+                pixel_values = batch["pixel_values"].to(local_rank)
+                video_length = pixel_values.shape[1]
+                with torch.no_grad():
+                    pixel_values = rearrange(pixel_values, "b f c h w -> (b f) c h w")
+                    latents = vae.encode(pixel_values).latent_dist.sample()
+                    latents = rearrange(latents, "(b f) c h w -> b c f h w", f=video_length)
+                    latents = latents * 0.18215
 
             noise = torch.randn_like(latents)  # [b, c, f, h, w]
             bsz = latents.shape[0]
@@ -801,17 +860,20 @@ def main(name: str,
 
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)  # [b, c, f h, w]
 
-            with torch.no_grad():
-                prompt_ids = tokenizer(
-                    batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True,
-                    return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]  # b l c
+            if text_embedding_cache is not None:
+                encoder_hidden_states = text_embedding_cache.encode(batch['text'], device=latents.device)  # b l c
+            else:
+                with torch.no_grad():
+                    prompt_ids = tokenizer(
+                        batch['text'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True,
+                        return_tensors="pt"
+                    ).input_ids.to(latents.device)
+                    encoder_hidden_states = text_encoder(prompt_ids)[0]  # b l c
 
             enable_cmcm=True
             is_cm_condition_null_list=[]
             if enable_cmcm:
-                RT = batch["camera_infos"].to(device=local_rank,dtype=pixel_values.dtype)
+                RT = batch["camera_infos"].to(device=local_rank,dtype=latents.dtype)
                 RT = RT[...] # [b, t, 12]
                 RT=RT.reshape(RT.shape[0],RT.shape[1],3,4)
                 if cfg_random_null_text:
@@ -828,19 +890,48 @@ def main(name: str,
             
             
             intrinsics=batch["intrinsics"]
+            ## hashed from the host side poses, hashing RT would sync with the device
+            pose_cache_keys=get_pose_cache_keys(batch["camera_infos"],intrinsics,is_cm_condition_null_list) if use_pose_feature_cache and enable_cmcm else None
             batch["plucker_embedding"]=to_plucker_embedding(RT,intrinsics,train_data.params.sample_size)
             plucker_embedding = batch["plucker_embedding"].to(device=local_rank)  # [b, f, 6, h, w]
             plucker_embedding = rearrange(plucker_embedding, "b f c h w -> b c f h w")  # [b, 6, f h, w]
             
             
          
-            obj_info_list_list=batch['obj_info_list_list']
-            if train_data.params.use_sphere_mask:
-                obj_mask_list_list=batch['circle_mask_list_list']
+            if padded_collate_kwargs is not None:
+                obj_infos,obj_valid=batch['obj_infos'],batch['obj_valid']
+                if train_data.params.use_sphere_mask and not train_data.params.get("render_sphere_mask_in_worker", True):
+                    obj_masks=render_gaussian_circle_masks(batch['circles'].to(local_rank), train_data.params.sample_size)
+                elif train_data.params.use_sphere_mask:
+                    obj_masks=batch['circle_masks']
+                else:
+                    obj_masks=batch['obj_masks']
             else:
-                obj_mask_list_list=batch['obj_mask_list_list']
+                obj_info_list_list=batch['obj_info_list_list']
+                if train_data.params.use_sphere_mask and not train_data.params.get("render_sphere_mask_in_worker", True):
+                    obj_mask_list_list=render_circle_mask_list_list(batch['circle_list_list'], train_data.params.sample_size, device=local_rank)
+                elif train_data.params.use_sphere_mask:
+                    obj_mask_list_list=batch['circle_mask_list_list']
+                else:
+                    obj_mask_list_list=batch['obj_mask_list_list']
+                
+                obj_infos,obj_masks,_,obj_valid=pad_object_conditions(obj_info_list_list,obj_mask_list_list)
+            obj_masks=obj_masks.to(local_rank,non_blocking=True)
+            obj_valid=obj_valid.to(local_rank,non_blocking=True)
+            
+            ## object coverage is computed once per batch, shared by the traj features and (without sphere masks) the loss mask
+            obj_coverage=get_object_coverage(obj_masks,obj_valid)
+            loss_mask=None
+            if apply_masked_loss:
+                if not train_data.params.use_sphere_mask:
+                    loss_coverage=obj_coverage
+                elif padded_collate_kwargs is not None:
+                    loss_coverage=get_object_coverage(batch['obj_masks'].to(local_rank,non_blocking=True),obj_valid)
+                else:
+                    loss_coverage=get_object_coverage(pad_object_conditions(batch['obj_info_list_list'],batch['obj_mask_list_list'])[1].to(local_rank,non_blocking=True),obj_valid)
+                loss_mask=get_latent_loss_mask(loss_coverage,latents.shape[-2:],latents.dtype)
             
-            traj_features = get_traj_features_v2(obj_info_list_list,obj_mask_list_list, omcm,False,cfg_random_null_text_ratio,is_cm_condition_null_list,local_rank,dtype=pixel_values.dtype)
+            traj_features = get_traj_features_v3(obj_infos,obj_masks,obj_valid, omcm,False,cfg_random_null_text_ratio,local_rank,dtype=latents.dtype,obj_coverage=obj_coverage)
 
             
             # if use_constant_loss:
@@ -862,7 +953,8 @@ def main(name: str,
                 model_pred = pose_adaptor(noisy_latents,
                                           timesteps,
                                           encoder_hidden_states=encoder_hidden_states,
-                                          pose_embedding=plucker_embedding,traj_features=traj_features)  # [b c f h w]
+                                          pose_embedding=plucker_embedding,traj_features=traj_features,
+                                          pose_cache_keys=pose_cache_keys)  # [b c f h w]
                 
                 # if use_constant_loss:
                 #     extra_model_pred,model_pred=model_pred.chunk(2,dim=0)
@@ -878,29 +970,7 @@ def main(name: str,
                 sd_loss = torch.nn.functional.mse_loss(model_pred.float(), target.float(), reduction="mean")
                 
                 if apply_masked_loss:
-                    obj_info_list_list=batch['obj_info_list_list']
-                    obj_mask_list_list=batch['obj_mask_list_list']
-                    B=len(obj_info_list_list)
-                    F=len(obj_info_list_list[0])
-                    
-                    H,W=obj_mask_list_list[0][0].shape[-2],obj_mask_list_list[0][0].shape[-1]
-                    mask=torch.zeros([B,F,H,W,1],dtype=pixel_values.dtype).to(local_rank)
-
-                    for b_idx,(obj_info_list, obj_mask_list) in enumerate(zip(obj_info_list_list, obj_mask_list_list)):
-                        for f_idx,(obj_info, obj_mask) in enumerate(zip(obj_info_list, obj_mask_list)):
-                            obj_mask=obj_mask.permute(0,2,3,1).to(local_rank)
-                            
-                            for _obj_mask in obj_mask:
-                                mask[b_idx][f_idx][_obj_mask[...,0]]=1
-                    
-                    
-                    mask=rearrange(mask,"b f h w c-> (b f) c h w")##B frame c H w
-                    ord_h,ord_w=model_pred.shape[-2],model_pred.shape[-1]
-                    mask = torch.nn.functional.interpolate(
-                        input=mask, size=(ord_h,ord_w)
-                    )
-                    
-                    mask=rearrange(mask,"(b f) c h w -> b c f h w",b=B)##B c frame H w
+                    mask=loss_mask ##B c frame H w
                     
                     masked_model_pred = mask *model_pred 
                     masked_target = mask*target
@@ -968,6 +1038,8 @@ def main(name: str,
                 }
 
                 torch.save(omcm_state_dict, os.path.join(save_path, f"omcm-step-{global_step}.ckpt"))
+                if text_embedding_cache is not None:
+                    text_embedding_cache.save()
 
                 if train_image_lora:
                     state_dict = {
@@ -986,6 +1058,13 @@ def main(name: str,
                       f"Iter time: {format_time(iter_end_time - data_end_time)}, " \
                       f"ETA: {format_time((iter_end_time - iter_start_time) * (max_train_steps - global_step))}, " \
                       f"GPU memory: {gpu_memory: .2f} G"
+                worker_memory = get_dataloader_worker_memory(data_iter)
+                if worker_memory is not None:
+                    msg += f", Worker RSS/PSS: {worker_memory[0]: .2f}/{worker_memory[1]: .2f} G"
+                if text_embedding_cache is not None:
+                    msg += f", {text_embedding_cache.get_stats_msg()}"
+                if pose_feature_cache is not None:
+                    msg += f", {pose_feature_cache.get_stats_msg()}"
                 logger.info(msg)
 
             if global_step >= max_train_steps:
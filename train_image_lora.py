@@ -26,8 +26,11 @@ from diffusers.optimization import get_scheduler
 from diffusers.utils import check_min_version
 from diffusers.utils.import_utils import is_xformers_available
 
-from fmc.utils.util import setup_logger, format_time
+from fmc.utils.text_embedding_cache import TextEmbeddingCache
+from fmc.utils.util import setup_logger, format_time, get_dataloader_worker_memory
 from fmc.data.dataset import UnrealTrajLoraDataset
+from fmc.data.clip_plan import ClipPlanSampler
+from fmc.data.latent_cache import sample_latents
 
 def init_dist(launcher="slurm", backend='nccl', port=29500, **kwargs):
     """Initializes distributed environment."""
@@ -107,7 +110,9 @@ def main(name: str,
          global_seed: int = 42,
          logger_interval: int = 10,
 
-         resume_from: str = None
+         resume_from: str = None,
+
+         text_embedding_cache_kwargs: dict = None,
 ):
     check_min_version("0.10.0.dev0")
 
@@ -140,13 +145,16 @@ def main(name: str,
         OmegaConf.save(config, os.path.join(output_dir, 'config.yaml'))
 
     noise_scheduler = DDIMScheduler(**OmegaConf.to_container(noise_scheduler_kwargs))
-    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae")
+    ## with a latent cache the VAE is only needed to decode validation samples on the main process
+    use_latent_cache = train_data.params.get("latent_cache_root") is not None
+    vae = AutoencoderKL.from_pretrained(pretrained_model_path, subfolder="vae") if is_main_process or not use_latent_cache else None
     tokenizer = CLIPTokenizer.from_pretrained(pretrained_model_path, subfolder="tokenizer")
     text_encoder = CLIPTextModel.from_pretrained(pretrained_model_path, subfolder="text_encoder")
     unet = UNet2DConditionModel.from_pretrained(pretrained_model_path, subfolder=unet_subfolder)
 
     unet.requires_grad_(False)
-    vae.requires_grad_(False)
+    if vae is not None:
+        vae.requires_grad_(False)
     text_encoder.requires_grad_(False)
 
     lora_attn_procs = {}
@@ -197,20 +205,40 @@ def main(name: str,
         unet.enable_gradient_checkpointing()
 
 
-    vae.to(local_rank)
+    if vae is not None:
+        vae.to(local_rank)
     text_encoder.to(local_rank)
 
+    ## captions repeat (template grammar, empty cfg captions), their embeddings are looked up instead of re-encoded
+    text_embedding_cache = None
+    if text_embedding_cache_kwargs is not None:
+        text_embedding_cache = TextEmbeddingCache(tokenizer, text_encoder, **text_embedding_cache_kwargs)
+
 
     train_dataset = UnrealTrajLoraDataset(**train_data.params)
     
+    if train_dataset.clip_plan is not None:
+        logger.info(f"Clip plan: {len(train_dataset.clip_plan)} rows over {train_dataset.clip_plan.get_seq_num()} sequences, removes {train_dataset.clip_plan.rejection_rate:.2%} of random draws that would be rejected")
+    if train_dataset.metadata_nbytes is not None:
+        logger.info(f"Shared metadata: {train_dataset.metadata_nbytes / (1024 ** 2): .2f} MB packed into numpy buffers")
+
     if launcher!="single":
-        distributed_sampler = DistributedSampler(
-            train_dataset,
-            num_replicas=num_processes,
-            rank=global_rank,
-            shuffle=True,
-            seed=global_seed,
-        )
+        if train_dataset.clip_plan is not None:
+            distributed_sampler = ClipPlanSampler(
+                train_dataset.clip_plan,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
+            )
+        else:
+            distributed_sampler = DistributedSampler(
+                train_dataset,
+                num_replicas=num_processes,
+                rank=global_rank,
+                shuffle=True,
+                seed=global_seed,
+            )
 
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
@@ -225,7 +253,8 @@ def main(name: str,
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset,
             batch_size=train_batch_size,
-            shuffle=True,
+            shuffle=train_dataset.clip_plan is None,
+            sampler=ClipPlanSampler(train_dataset.clip_plan,seed=global_seed) if train_dataset.clip_plan is not None else None,
 
             num_workers=num_workers,
             pin_memory=True,
@@ -250,10 +279,11 @@ def main(name: str,
     )
 
 
-    validation_pipeline = StableDiffusionPipeline.from_pretrained(pretrained_model_path, unet=unet, vae=vae,
-                                                                  tokenizer=tokenizer, text_encoder=text_encoder,
-                                                                  scheduler=noise_scheduler, safety_checker=None,)
-    validation_pipeline.enable_vae_slicing()
+    if vae is not None:
+        validation_pipeline = StableDiffusionPipeline.from_pretrained(pretrained_model_path, unet=unet, vae=vae,
+                                                                      tokenizer=tokenizer, text_encoder=text_encoder,
+                                                                      scheduler=noise_scheduler, safety_checker=None,)
+        validation_pipeline.enable_vae_slicing()
 
 
     num_update_steps_per_epoch = math.ceil(len(train_dataloader) / gradient_accumulation_steps)
@@ -265,7 +295,8 @@ def main(name: str,
 
     if is_main_process:
         logger.info("***** Running training *****")
-        logger.info(f"  Num examples = {len(train_dataset)}")
+        ## with a clip plan the sampler draws one plan row per sequence and epoch, len(train_dataset) counts plan rows
+        logger.info(f"  Num examples = {train_dataset.clip_plan.get_seq_num() if train_dataset.clip_plan is not None else len(train_dataset)}")
         logger.info(f"  Num Epochs = {num_train_epochs}")
         logger.info(f"  Instantaneous batch size per device = {train_batch_size}")
         logger.info(f"  Total train batch size (w. parallel, distributed & accumulation) = {total_batch_size}")
@@ -299,7 +330,7 @@ def main(name: str,
     scaler = torch.cuda.amp.GradScaler() if mixed_precision_training else None
 
     for epoch in range(first_epoch, num_train_epochs):
-        if launcher!="single":
+        if launcher!="single" or train_dataset.clip_plan is not None:
             train_dataloader.sampler.set_epoch(epoch)
         unet.train()
 
@@ -309,11 +340,12 @@ def main(name: str,
             batch = next(data_iter)
             data_end_time = time.time()
             
-            batch["pixel_values"]=batch["image"]
+            if not use_latent_cache:
+                batch["pixel_values"]=batch["image"]
             if cfg_random_null_text:
                 batch['caption'] = [name if random.random() > cfg_random_null_text_ratio else "" for name in batch['caption']]
 
-            if epoch == first_epoch and step == 0 and do_sanity_check:
+            if epoch == first_epoch and step == 0 and do_sanity_check and not use_latent_cache:
                 pixel_values, texts = batch['pixel_values'].cpu(), batch['caption']
                 for idx, (pixel_value, text) in enumerate(zip(pixel_values, texts)):
                     pixel_value = pixel_value / 2. + 0.5
@@ -322,12 +354,15 @@ def main(name: str,
 
 
          
-            pixel_values = batch["pixel_values"].to(local_rank)
-            with torch.no_grad():
-                latents = vae.encode(pixel_values).latent_dist
-                latents = latents.sample()
+            if use_latent_cache:
+                latents = sample_latents(batch["latent_dist"].to(local_rank, dtype=torch.float32))
+            else:
+                pixel_values = batch["pixel_values"].to(local_rank)
+                with torch.no_grad():
+                    latents = vae.encode(pixel_values).latent_dist
+                    latents = latents.sample()
 
-                latents = latents * 0.18215
+                    latents = latents * 0.18215
 
 
             noise = torch.randn_like(latents)
@@ -342,11 +377,14 @@ def main(name: str,
             noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
 
 
-            with torch.no_grad():
-                prompt_ids = tokenizer(
-                    batch['caption'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
-                ).input_ids.to(latents.device)
-                encoder_hidden_states = text_encoder(prompt_ids)[0]
+            if text_embedding_cache is not None:
+                encoder_hidden_states = text_embedding_cache.encode(batch['caption'], device=latents.device)
+            else:
+                with torch.no_grad():
+                    prompt_ids = tokenizer(
+                        batch['caption'], max_length=tokenizer.model_max_length, padding="max_length", truncation=True, return_tensors="pt"
+                    ).input_ids.to(latents.device)
+                    encoder_hidden_states = text_encoder(prompt_ids)[0]
 
 
             if noise_scheduler.config.prediction_type == "epsilon":
@@ -393,10 +431,14 @@ def main(name: str,
                     "optimizer_state_dict": optimizer.state_dict()
                 }
                 torch.save(state_dict, os.path.join(save_path, f"checkpoint-step-{global_step}.ckpt"))
+                if text_embedding_cache is not None:
+                    text_embedding_cache.save()
                 logger.info(f"Saved state to {save_path} (global_step: {global_step})")
 
 
             if is_main_process and (global_step==1 or global_step % validation_steps == 0 or global_step in validation_steps_tuple):
+                if text_embedding_cache is not None:
+                    text_embedding_cache.encoder_to(local_rank)
                 generator = torch.Generator(device=latents.device)
                 generator.manual_seed(global_seed)
                 
@@ -435,6 +477,8 @@ def main(name: str,
                         print(prompt,file=f)
 
                 logger.info(f"Saved samples to {save_path}")
+                if text_embedding_cache is not None:
+                    text_embedding_cache.restore_encoder()
 
             if (global_step % logger_interval) == 0 or global_step == 0:
                 gpu_memory = torch.cuda.max_memory_allocated() / (1024 ** 3)
@@ -443,6 +487,11 @@ def main(name: str,
                       f"Iter time: {format_time(iter_end_time - data_end_time)}, " \
                       f"ETA: {format_time((iter_end_time - iter_start_time) * (max_train_steps - global_step))}, " \
                       f"GPU memory: {gpu_memory: .2f} G"
+                worker_memory = get_dataloader_worker_memory(data_iter)
+                if worker_memory is not None:
+                    msg += f", Worker RSS/PSS: {worker_memory[0]: .2f}/{worker_memory[1]: .2f} G"
+                if text_embedding_cache is not None:
+                    msg += f", {text_embedding_cache.get_stats_msg()}"
                 logger.info(msg)
 
             if global_step >= max_train_steps: